@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class GhlFrontConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'GHL_Front'
+
+    def ready(self):
+        from . import signals  # noqa: F401
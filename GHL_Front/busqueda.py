@@ -0,0 +1,144 @@
+import threading
+from django.db import connection, transaction
+from django.db.models import Q
+from ghl_middleware.cache_publica import version_agencia
+from ghl_middleware.models import Propiedad
+from ghl_middleware.trigramas import IndiceTrigramas
+from ghl_middleware.zonas import meta_arbol_zonas, normalizar_nombre
+from .models import PropiedadPublica
+from .proyeccion import refrescar_propiedades
+
+# Búsqueda libre sobre PropiedadPublica.texto_busqueda (zona, municipio, provincia,
+# título, descripción y características, ya normalizados):
+#  - Postgres: tsvector (palabras completas, con stemming en español) + pg_trgm
+#    (palabras mal escritas), ambos con índice GIN (migración 0002 de GHL_Front).
+#  - Resto (SQLite en desarrollo): índice de trigramas en memoria por agencia.
+
+POSTGRES = 'postgres'
+MEMORIA = 'memoria'
+
+# Similitud mínima de pg_trgm (word_similarity) para dar por buena una palabra mal escrita
+UMBRAL_POSTGRES = 0.4
+
+
+def motor_por_defecto():
+    return POSTGRES if connection.vendor == 'postgresql' else MEMORIA
+
+# location_id -> versión con la que ya se comprobó que toda la agencia tiene proyección
+_comprobadas = {}
+
+def asegurar_proyeccion(location_id):
+    """
+    Las propiedades sin proyección (o proyectadas antes de existir texto_busqueda)
+    no se encontrarían: se renderizan antes de buscar. Devuelve cuántas había.
+    Las escrituras regeneran la proyección al momento, así que solo hay que
+    comprobarlo una vez por versión de la agencia (la consulta recorre todas sus filas).
+    """
+    version = (version_agencia(location_id), meta_arbol_zonas()[0])
+    if _comprobadas.get(location_id) == version:
+        return 0
+    regeneradas = len(refrescar_propiedades(
+        Propiedad.objects
+        .filter(agencia_id=location_id, estado=Propiedad.estadoPiso.ACTIVO)
+        .filter(Q(publica__isnull=True) | Q(publica__texto_busqueda=""))
+    ))
+    if regeneradas:
+        _indices.pop(location_id, None)
+    _comprobadas[location_id] = version
+    return regeneradas
+
+
+# --- 1. POSTGRES ---
+
+def _sql_postgres(columnas, final=""):
+    return f"""
+        SELECT {columnas}
+        FROM {connection.ops.quote_name(Propiedad._meta.db_table)} p
+        JOIN {connection.ops.quote_name(PropiedadPublica._meta.db_table)} pp ON pp.propiedad_id = p.id
+        WHERE p.agencia_id = %(agencia)s AND p.estado = 'activo'
+          AND (to_tsvector('spanish', pp.texto_busqueda) @@ websearch_to_tsquery('spanish', %(texto)s)
+               OR %(texto)s <%% pp.texto_busqueda)
+        {final}
+    """
+
+def _ejecutar_postgres(sql, parametros):
+    # El umbral de '<%' es un parámetro de sesión: set_config(..., true) lo limita a esta transacción
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute("SELECT set_config('pg_trgm.word_similarity_threshold', %s, true)", [str(UMBRAL_POSTGRES)])
+        cursor.execute(sql, parametros)
+        return cursor.fetchall()
+
+
+# --- 2. MEMORIA ---
+# location_id -> {"version", "indice"}; se reconstruye cuando cambian las propiedades
+# de la agencia o el árbol de zonas (las mismas versiones que la caché de respuestas)
+
+_indices = {}
+_indices_lock = threading.Lock()
+
+def _indice_memoria(location_id):
+    version = (version_agencia(location_id), meta_arbol_zonas()[0])
+    entrada = _indices.get(location_id)
+    if entrada is None or entrada["version"] != version:
+        with _indices_lock:
+            entrada = _indices.get(location_id)
+            if entrada is None or entrada["version"] != version:
+                documentos = (
+                    PropiedadPublica.objects
+                    .filter(propiedad__agencia_id=location_id, propiedad__estado=Propiedad.estadoPiso.ACTIVO)
+                    .values_list('propiedad_id', 'texto_busqueda')
+                    .iterator(chunk_size=2000)
+                )
+                entrada = {"version": version, "indice": IndiceTrigramas(documentos)}
+                _indices[location_id] = entrada
+    return entrada["indice"]
+
+
+# --- 3. RESULTADOS ---
+
+class ResultadosBusqueda:
+    """
+    Secuencia perezosa de pks de propiedades ordenados por relevancia, pensada para el
+    Paginator de DRF: count() y el slice de la página son las únicas consultas.
+    """
+
+    def __init__(self, location_id, texto, motor=None):
+        self.location_id = location_id
+        self.texto = normalizar_nombre(texto)
+        self.motor = motor or motor_por_defecto()
+        asegurar_proyeccion(location_id)
+        self._total = None
+        self._ranking = None
+
+    def _parametros(self):
+        return {'agencia': self.location_id, 'texto': self.texto}
+
+    def _ordenados(self):
+        if self._ranking is None:
+            self._ranking = [pk for pk, _ in _indice_memoria(self.location_id).buscar(self.texto)]
+        return self._ranking
+
+    def count(self):
+        if self._total is None:
+            if self.motor == POSTGRES:
+                self._total = _ejecutar_postgres(_sql_postgres("COUNT(*)"), self._parametros())[0][0]
+            else:
+                self._total = len(self._ordenados())
+        return self._total
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, corte):
+        if not isinstance(corte, slice):
+            return self[corte:corte + 1][0]
+        if self.motor != POSTGRES:
+            return self._ordenados()[corte]
+        inicio = corte.start or 0
+        parametros = dict(self._parametros(), limite=(corte.stop - inicio) if corte.stop is not None else None, inicio=inicio)
+        filas = _ejecutar_postgres(_sql_postgres("p.id", """
+            ORDER BY ts_rank(to_tsvector('spanish', pp.texto_busqueda), websearch_to_tsquery('spanish', %(texto)s))
+                     + word_similarity(%(texto)s, pp.texto_busqueda) DESC, p.id DESC
+            LIMIT %(limite)s OFFSET %(inicio)s
+        """), parametros)
+        return [pk for pk, in filas]
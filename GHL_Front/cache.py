@@ -0,0 +1,73 @@
+import hashlib
+import time
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response, patch_cache_control
+from ghl_middleware.zonas import meta_arbol_zonas
+
+# Segundos que una petición espera a que otra termine de generar la misma respuesta
+ESPERA_MAX = 2.0
+
+
+def _huella_peticion(request):
+    # Mismo host, ruta y parámetros (en cualquier orden) = misma respuesta
+    # (el host cuenta porque los enlaces 'next' del cursor son absolutos)
+    parametros = sorted((clave, valor) for clave, valores in request.GET.lists() for valor in valores)
+    contenido = repr((request.get_host(), request.path, parametros))
+    return hashlib.sha1(contenido.encode()).hexdigest()[:16]
+
+def _cabeceras(response, etag):
+    response['ETag'] = etag
+    patch_cache_control(response, public=True, max_age=settings.FRONT_CACHE_MAX_AGE)
+    return response
+
+def _generar_una_vez(clave, generar):
+    """
+    Protección contra estampidas: cuando caduca una respuesta popular solo una
+    petición la regenera; las demás esperan su resultado en la caché.
+    """
+    candado = f"{clave}:candado"
+    if cache.add(candado, 1, int(ESPERA_MAX * 5)):
+        try:
+            contenido = generar()
+            cache.set(clave, contenido, settings.FRONT_CACHE_TTL)
+            return contenido
+        finally:
+            cache.delete(candado)
+
+    limite = time.monotonic() + ESPERA_MAX
+    while time.monotonic() < limite:
+        time.sleep(0.05)
+        contenido = cache.get(clave)
+        if contenido is not None:
+            return contenido
+    # El que tenía el candado tarda demasiado (o murió): se genera sin cachear
+    return generar()
+
+def respuesta_cacheada(request, prefijo, version, generar):
+    """
+    Devuelve el JSON de 'generar()' cacheado bajo (version, versión del árbol de zonas, petición).
+    El ETag sale de esas mismas versiones, así que un GET condicional recibe
+    un 304 sin tocar la base de datos ni leer la respuesta de la caché.
+    Sin caché compartida las versiones no ven lo que escriben otros procesos
+    (worker, consumidor de la bandeja, otros gunicorn): se genera siempre.
+    """
+    if not settings.CACHE_COMPARTIDA:
+        response = HttpResponse(generar(), content_type="application/json")
+        patch_cache_control(response, public=True, max_age=settings.FRONT_CACHE_MAX_AGE)
+        return response
+
+    version_zonas, _ = meta_arbol_zonas()  # title/location incluyen nombres de zona y municipio
+    etiqueta = f"{prefijo}-{version}-{version_zonas}-{_huella_peticion(request)}"
+    etag = f'"{etiqueta}"'
+
+    no_modificada = get_conditional_response(request, etag=etag)
+    if no_modificada is not None:
+        return _cabeceras(no_modificada, etag)
+
+    clave = f"front:respuesta:{etiqueta}"
+    contenido = cache.get(clave)
+    if contenido is None:
+        contenido = _generar_una_vez(clave, generar)
+    return _cabeceras(HttpResponse(contenido, content_type="application/json"), etag)
@@ -0,0 +1,64 @@
+from decimal import Decimal, InvalidOperation
+from rest_framework.exceptions import ValidationError
+
+# ?features=balcon,garaje -> campo del modelo que ha de valer 'si'
+FEATURES = {
+    'balcon': 'balcon',
+    'garaje': 'garaje',
+    'patio': 'patioInterior',
+    'mascotas': 'animales',
+}
+
+# Filtros numéricos: parámetro -> (lookup, conversor)
+RANGOS = {
+    'price_min': ('precio__gte', Decimal),
+    'price_max': ('precio__lte', Decimal),
+    'beds_min': ('habitaciones__gte', int),
+    'sqm_min': ('metros__gte', int),
+}
+
+# Filtros geográficos por id (admiten varios separados por comas)
+UBICACIONES = {
+    'zona': 'zona_id__in',
+    'municipio': 'zona__municipio_id__in',
+    'provincia': 'zona__municipio__provincia_id__in',
+}
+
+
+def _lista(params, nombre):
+    return [valor.strip() for valor in params.get(nombre, '').split(',') if valor.strip()]
+
+def filtrar_propiedades(queryset, params):
+    """
+    Aplica los filtros de la API pública sobre el queryset de propiedades activas.
+    Todo se traduce a un único WHERE (los índices parciales de Propiedad lo cubren);
+    un parámetro mal formado devuelve 400 en vez de ignorarse en silencio.
+    """
+    filtros = {}
+
+    for nombre, (lookup, conversor) in RANGOS.items():
+        valor = params.get(nombre)
+        if valor in (None, ''):
+            continue
+        try:
+            filtros[lookup] = conversor(valor)
+            # Decimal acepta 'nan' e 'Infinity', que no se pueden comparar en SQL
+            if isinstance(filtros[lookup], Decimal) and not filtros[lookup].is_finite():
+                raise InvalidOperation
+        except (ValueError, InvalidOperation):
+            raise ValidationError({nombre: f"'{valor}' no es un número válido."})
+
+    for nombre, lookup in UBICACIONES.items():
+        ids = _lista(params, nombre)
+        if not ids:
+            continue
+        if not all(valor.isdigit() for valor in ids):
+            raise ValidationError({nombre: "Se esperan ids numéricos separados por comas."})
+        filtros[lookup] = [int(valor) for valor in ids]
+
+    for feature in _lista(params, 'features'):
+        if feature not in FEATURES:
+            raise ValidationError({'features': f"'{feature}' no existe. Opciones: {', '.join(FEATURES)}."})
+        filtros[FEATURES[feature]] = 'si'
+
+    return queryset.filter(**filtros) if filtros else queryset
@@ -0,0 +1,31 @@
+import time
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+from ghl_middleware.models import Propiedad
+from ghl_middleware.zonas import invalidar_arbol_zonas
+from GHL_Front.proyeccion import refrescar_propiedades
+
+
+class Command(BaseCommand):
+    help = (
+        "Genera (o regenera) la proyección PropiedadPublica que sirve la API pública. "
+        "Sin ella las propiedades se renderizan en la primera petición que las pide."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--agencia', help="Solo las propiedades de este location_id")
+        parser.add_argument('--solo-faltan', action='store_true', help="Solo las propiedades sin proyección (o sin texto de búsqueda)")
+
+    def handle(self, *args, **options):
+        queryset = Propiedad.objects.all()
+        if options['agencia']:
+            queryset = queryset.filter(agencia__location_id=options['agencia'])
+        if options['solo_faltan']:
+            queryset = queryset.filter(Q(publica__isnull=True) | Q(publica__texto_busqueda=""))
+
+        inicio = time.perf_counter()
+        generadas = len(refrescar_propiedades(queryset))
+        if generadas:
+            # Las respuestas cacheadas llevan la versión del árbol de zonas: se descartan todas
+            invalidar_arbol_zonas()
+        self.stdout.write(f"🗂️ {generadas} propiedades proyectadas en {time.perf_counter() - inicio:.2f}s")
@@ -0,0 +1,83 @@
+import logging
+import random
+import time
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from ghl_middleware.benchmark import generar_dataset, medir
+from ghl_middleware.models import Propiedad
+from GHL_Front import busqueda
+from GHL_Front.proyeccion import refrescar_propiedades
+
+
+class Command(BaseCommand):
+    help = (
+        "Mide la búsqueda libre de propiedades (tsvector + pg_trgm en Postgres, trigramas en memoria "
+        "en el resto) sobre una agencia sintética: términos exactos, mal escritos y de varias palabras. "
+        "Todo se deshace al terminar."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--propiedades', type=int, default=100_000)
+        parser.add_argument('--zonas', type=int, default=500)
+        parser.add_argument('--muestras', type=int, default=200, help="Nº de búsquedas por tipo")
+        parser.add_argument('--motor', choices=[busqueda.POSTGRES, busqueda.MEMORIA], help="Por defecto, el de la base de datos actual")
+        parser.add_argument('--semilla', type=int, default=42)
+
+    def handle(self, *args, **o):
+        logging.disable(logging.INFO)
+        try:
+            with transaction.atomic():
+                self._ejecutar(o)
+                transaction.set_rollback(True)
+        finally:
+            logging.disable(logging.NOTSET)
+
+    def _ejecutar(self, o):
+        motor = o['motor'] or busqueda.motor_por_defecto()
+        t0 = time.perf_counter()
+        dataset = generar_dataset(1, o['zonas'], o['propiedades'], 0, o['semilla'])
+        loc = dataset["location_ids"][0]
+        self.stdout.write(f"Dataset: {o['propiedades']} propiedades en {o['zonas']} zonas ({time.perf_counter() - t0:.1f}s)")
+
+        t0 = time.perf_counter()
+        refrescar_propiedades(Propiedad.objects.filter(agencia_id=loc))
+        self.stdout.write(f"Proyección y texto de búsqueda: {time.perf_counter() - t0:.1f}s")
+
+        if motor == busqueda.MEMORIA:
+            t0 = time.perf_counter()
+            busqueda._indice_memoria(loc)
+            self.stdout.write(f"Índice de trigramas en memoria: {time.perf_counter() - t0:.2f}s")
+
+        rnd = random.Random(o['semilla'])
+        zonas = rnd.choices(dataset["zonas"], k=o['muestras'])
+        tipos = {
+            "Zona exacta": zonas,
+            "Zona mal escrita": [_errata(rnd, zona) for zona in zonas],
+            "Varias palabras": [f"{rnd.choice(['villa', 'studio', 'apartment'])} {zona} {rnd.choice(['garaje', 'balcon'])}" for zona in zonas],
+        }
+
+        def primera_pagina(texto):
+            resultados = busqueda.ResultadosBusqueda(loc, texto, motor=motor)
+            return resultados.count(), resultados[0:24]
+
+        self.stdout.write(f"Motor: {motor}")
+        for titulo, textos in tipos.items():
+            encontradas = sum(1 for texto in textos if primera_pagina(texto)[0])
+            r = medir(primera_pagina, textos)
+            self.stdout.write(
+                f"{titulo}: p50 {r['p50_ms']:.2f} ms | p95 {r['p95_ms']:.2f} ms | p99 {r['p99_ms']:.2f} ms | "
+                f"{r['queries_media']:.1f} queries/búsqueda | {encontradas}/{len(textos)} con resultados"
+            )
+
+
+def _errata(rnd, texto):
+    """
+    Intercambia dos letras contiguas de una palabra, como un error de tecleo.
+    """
+    palabras = texto.split()
+    i = rnd.randrange(len(palabras))
+    palabra = palabras[i]
+    if len(palabra) > 3:
+        j = rnd.randrange(len(palabra) - 1)
+        palabras[i] = palabra[:j] + palabra[j + 1] + palabra[j] + palabra[j + 2:]
+    return " ".join(palabras)
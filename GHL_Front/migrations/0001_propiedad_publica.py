@@ -0,0 +1,24 @@
+# Generated by Django 4.2.27 on 2026-10-17 19:34
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        ('ghl_middleware', '0017_indices_api_publica'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PropiedadPublica',
+            fields=[
+                ('propiedad', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='publica', serialize=False, to='ghl_middleware.propiedad')),
+                ('contenido', models.TextField(help_text='JSON de la propiedad tal como lo sirve la API pública')),
+                ('actualizado_en', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
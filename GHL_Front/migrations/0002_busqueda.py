@@ -0,0 +1,48 @@
+# Generated by Django 4.2.27 on 2026-10-17 19:38
+
+from django.db import migrations, models
+
+# Índices de la búsqueda (GHL_Front/busqueda.py). Solo existen en Postgres:
+# en SQLite la búsqueda usa el índice de trigramas en memoria.
+INDICES_POSTGRES = [
+    'CREATE EXTENSION IF NOT EXISTS pg_trgm;',
+    # Misma expresión que la consulta (to_tsvector('spanish', texto_busqueda)) para que el planificador la use
+    'CREATE INDEX IF NOT EXISTS "prop_publica_tsv_idx" ON "GHL_Front_propiedadpublica" '
+    'USING gin (to_tsvector(\'spanish\', "texto_busqueda"));',
+    'CREATE INDEX IF NOT EXISTS "prop_publica_trgm_idx" ON "GHL_Front_propiedadpublica" '
+    'USING gin ("texto_busqueda" gin_trgm_ops);',
+]
+BORRAR_INDICES_POSTGRES = [
+    'DROP INDEX IF EXISTS "prop_publica_trgm_idx";',
+    'DROP INDEX IF EXISTS "prop_publica_tsv_idx";',
+]
+
+
+def _ejecutar_en_postgres(sentencias):
+    def operacion(apps, schema_editor):
+        if schema_editor.connection.vendor != 'postgresql':
+            return
+        for sentencia in sentencias:
+            schema_editor.execute(sentencia)
+    return operacion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('GHL_Front', '0001_propiedad_publica'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='propiedadpublica',
+            name='texto_busqueda',
+            field=models.TextField(blank=True, default='', help_text='Zona, municipio, provincia, título y descripción normalizados (ver busqueda.py)'),
+        ),
+        # Las proyecciones existentes quedan con texto_busqueda vacío: se regeneran en la
+        # primera búsqueda de su agencia (o con backfill_propiedades_publicas).
+        migrations.RunPython(
+            _ejecutar_en_postgres(INDICES_POSTGRES),
+            _ejecutar_en_postgres(BORRAR_INDICES_POSTGRES),
+        ),
+    ]
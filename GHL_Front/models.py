@@ -1,3 +1,17 @@
 from django.db import models
+from ghl_middleware.models import Propiedad
 
-# Create your models here.
+
+class PropiedadPublica(models.Model):
+    """
+    Proyección de solo lectura de una Propiedad para la API pública: el JSON que
+    devuelve PropiedadPublicaSerializer, ya renderizado. Se regenera al escribir la
+    propiedad o al renombrar su zona/municipio (ver GHL_Front/signals.py).
+    """
+    propiedad = models.OneToOneField(Propiedad, on_delete=models.CASCADE, primary_key=True, related_name='publica')
+    contenido = models.TextField(help_text="JSON de la propiedad tal como lo sirve la API pública")
+    texto_busqueda = models.TextField(blank=True, default="", help_text="Zona, municipio, provincia, título y descripción normalizados (ver busqueda.py)")
+    actualizado_en = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"PropiedadPublica {self.propiedad_id}"
@@ -0,0 +1,36 @@
+from rest_framework.pagination import CursorPagination, PageNumberPagination
+
+
+class PropiedadCursorPagination(CursorPagination):
+    """
+    Paginación por cursor (keyset): cada página es un WHERE sobre la clave de orden,
+    sin OFFSET, así que la página 100 cuesta lo mismo que la primera.
+    Orden con ?ordering=id|-id|price|-price|sqm|-sqm (por defecto -id).
+    """
+    page_size = 24
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    ordering = '-id'
+
+    # Nombre público -> campos del modelo (el id desempata los valores iguales)
+    ORDENES = {
+        'id': ('id',),
+        '-id': ('-id',),
+        'price': ('precio', 'id'),
+        '-price': ('-precio', '-id'),
+        'sqm': ('metros', 'id'),
+        '-sqm': ('-metros', '-id'),
+    }
+
+    def get_ordering(self, request, queryset, view):
+        return self.ORDENES.get(request.query_params.get('ordering'), (self.ordering,))
+
+
+class BusquedaPagination(PageNumberPagination):
+    """
+    Paginación por número de página para la búsqueda: el orden es por relevancia,
+    que no es una clave estable sobre la que montar un cursor.
+    """
+    page_size = 24
+    page_size_query_param = 'page_size'
+    max_page_size = 100
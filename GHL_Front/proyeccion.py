@@ -0,0 +1,103 @@
+import json
+from itertools import islice
+from rest_framework.renderers import JSONRenderer
+from ghl_middleware.models import Propiedad
+from ghl_middleware.zonas import normalizar_nombre
+from .models import PropiedadPublica
+from .serializers import PropiedadPublicaSerializer
+
+# Propiedades por consulta/INSERT al regenerar la proyección
+LOTE = 500
+
+# Filas por bloque al exportar en streaming
+CHUNK = 2000
+
+
+# --- 1. REGENERACIÓN ---
+
+def texto_busqueda(propiedad, fila):
+    """
+    Texto sobre el que busca /api/properties/search/ (minúsculas y sin acentos).
+    """
+    partes = [fila['title'], fila['description'], *fila['features']]
+    if propiedad.zona:
+        partes += [propiedad.zona.nombre, propiedad.zona.municipio.nombre, propiedad.zona.municipio.provincia.nombre]
+    return normalizar_nombre(" ".join(partes))
+
+def refrescar_propiedades(queryset):
+    """
+    Renderiza (con el serializer, que sigue siendo la única definición del JSON) y
+    guarda la proyección de las propiedades del queryset. Devuelve {pk: contenido}.
+    """
+    contenidos = {}
+    renderer = JSONRenderer()
+    pks = list(queryset.order_by('pk').values_list('pk', flat=True))
+    for inicio in range(0, len(pks), LOTE):
+        propiedades = list(Propiedad.objects.filter(pk__in=pks[inicio:inicio + LOTE]).select_related('zona__municipio__provincia'))
+        filas = PropiedadPublicaSerializer(propiedades, many=True).data
+        proyecciones = [
+            PropiedadPublica(
+                propiedad_id=propiedad.pk,
+                contenido=renderer.render(fila).decode(),
+                texto_busqueda=texto_busqueda(propiedad, fila)
+            )
+            for propiedad, fila in zip(propiedades, filas)
+        ]
+        PropiedadPublica.objects.bulk_create(
+            proyecciones,
+            update_conflicts=True,
+            unique_fields=['propiedad'],
+            update_fields=['contenido', 'texto_busqueda', 'actualizado_en']
+        )
+        contenidos.update((proyeccion.propiedad_id, proyeccion.contenido) for proyeccion in proyecciones)
+    return contenidos
+
+
+# --- 2. LECTURA ---
+
+def contenidos_publicos(propiedades):
+    """
+    JSON ya renderizado de cada propiedad (en el mismo orden). Las propiedades
+    sin proyección (anteriores al backfill) se renderizan en ese momento y se guardan.
+    'propiedades' debe venir con select_related('publica').
+    """
+    contenidos = {}
+    faltan = []
+    for propiedad in propiedades:
+        try:
+            contenidos[propiedad.pk] = propiedad.publica.contenido
+        except PropiedadPublica.DoesNotExist:
+            faltan.append(propiedad.pk)
+    if faltan:
+        contenidos.update(refrescar_propiedades(Propiedad.objects.filter(pk__in=faltan)))
+    return [contenidos[propiedad.pk] for propiedad in propiedades]
+
+def iterar_contenidos(queryset, campos=None, chunk_size=CHUNK):
+    """
+    Como contenidos_publicos(), pero para exportar en streaming: lee (pk, contenido)
+    con .iterator() y solo retiene un bloque de chunk_size filas a la vez.
+    """
+    filas = queryset.values_list('pk', 'publica__contenido').iterator(chunk_size=chunk_size)
+    while True:
+        bloque = list(islice(filas, chunk_size))
+        if not bloque:
+            return
+        faltan = [pk for pk, contenido in bloque if contenido is None]
+        nuevos = refrescar_propiedades(Propiedad.objects.filter(pk__in=faltan)) if faltan else {}
+        contenidos = [nuevos[pk] if contenido is None else contenido for pk, contenido in bloque]
+        yield from (recortar_campos(contenidos, campos) if campos else contenidos)
+
+def recortar_campos(contenidos, campos):
+    """
+    Sparse fieldsets (?fields=) sobre el JSON precalculado: solo aquí hace falta parsearlo.
+    """
+    pedidos = {campo.strip() for campo in campos.split(',') if campo.strip()}
+    renderer = JSONRenderer()
+    recortados = []
+    for contenido in contenidos:
+        fila = json.loads(contenido)
+        recortados.append(renderer.render({clave: valor for clave, valor in fila.items() if clave in pedidos}).decode())
+    return recortados
+
+def lista_json(contenidos):
+    return "[" + ",".join(contenidos) + "]"
@@ -0,0 +1,48 @@
+from django.db.models.signals import post_save, pre_delete, post_delete
+from django.dispatch import receiver
+from ghl_middleware.cache_publica import propiedades_publicas_modificadas
+from ghl_middleware.models import Propiedad, Zona, Municipio, Provincia
+from ghl_middleware.zonas import invalidar_arbol_zonas
+from .proyeccion import refrescar_propiedades
+
+
+# Escrituras de propiedades: señal propia de ghl_middleware, que la envía tanto
+# desde el post_save de Propiedad como desde la ingesta por lotes (bulk_create).
+@receiver(propiedades_publicas_modificadas)
+def propiedades_modificadas(sender, location_id, ghl_contact_ids, **kwargs):
+    refrescar_propiedades(Propiedad.objects.filter(agencia__location_id=location_id, ghl_contact_id__in=ghl_contact_ids))
+
+
+# El título y la ubicación llevan los nombres de zona y municipio, y el texto de
+# búsqueda también el de la provincia. Las respuestas
+# cacheadas dependen de la versión del árbol de zonas: se vuelve a subir tras
+# regenerar, para que nadie cachee la proyección vieja con la versión nueva.
+def _refrescar_ubicacion(queryset):
+    if refrescar_propiedades(queryset):
+        invalidar_arbol_zonas()
+
+@receiver(post_save, sender=Zona)
+def zona_modificada(sender, instance, created, **kwargs):
+    if not created:
+        _refrescar_ubicacion(Propiedad.objects.filter(zona=instance))
+
+@receiver(post_save, sender=Municipio)
+def municipio_modificado(sender, instance, created, **kwargs):
+    if not created:
+        _refrescar_ubicacion(Propiedad.objects.filter(zona__municipio=instance))
+
+@receiver(post_save, sender=Provincia)
+def provincia_modificada(sender, instance, created, **kwargs):
+    if not created:
+        _refrescar_ubicacion(Propiedad.objects.filter(zona__municipio__provincia=instance))
+
+# Al borrar una zona sus propiedades quedan con zona=NULL (un UPDATE sin señales):
+# se apuntan antes del borrado y se regeneran después. Borrar un municipio o una
+# provincia borra sus zonas en cascada, con estas mismas señales.
+@receiver(pre_delete, sender=Zona)
+def zona_por_borrar(sender, instance, **kwargs):
+    instance._propiedades_publicas = list(instance.propiedades.values_list('pk', flat=True))
+
+@receiver(post_delete, sender=Zona)
+def zona_borrada(sender, instance, **kwargs):
+    _refrescar_ubicacion(Propiedad.objects.filter(pk__in=getattr(instance, '_propiedades_publicas', [])))
@@ -1,3 +1,125 @@
-from django.test import TestCase
+import json
+from unittest import mock
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from ghl_middleware.models import Agencia, Provincia, Municipio, Zona, Propiedad
+from .models import PropiedadPublica
 
-# Create your tests here.
+
+class CacheRespuestasTests(TestCase):
+    """
+    Una escritura hecha en otro proceso no sube las versiones de esta caché
+    (se simula anulando _subir): solo con caché compartida se puede cachear.
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.agencia = Agencia.objects.create(location_id="LOC")
+        zona = Zona.objects.create(
+            municipio=Municipio.objects.create(provincia=Provincia.objects.create(nombre="Barcelona"), nombre="Barcelona"),
+            nombre="Gràcia"
+        )
+        self.propiedad = Propiedad.objects.create(agencia=self.agencia, ghl_contact_id="P1", zona=zona, precio=100_000)
+        self.url = "/front/api/properties/?agency_id=LOC"
+
+    def _escribir_desde_otro_proceso(self):
+        with mock.patch("ghl_middleware.cache_publica._subir"):
+            self.propiedad.precio = 200_000
+            self.propiedad.save()
+
+    @override_settings(CACHE_COMPARTIDA=False)
+    def test_sin_cache_compartida_no_se_cachea(self):
+        primera = self.client.get(self.url)
+        self.assertNotIn("ETag", primera)
+        self._escribir_desde_otro_proceso()
+        segunda = self.client.get(self.url)
+        self.assertEqual(segunda.json()["results"][0]["price"], "200000")
+
+    @override_settings(CACHE_COMPARTIDA=True)
+    def test_con_cache_compartida_hay_etag_y_304(self):
+        primera = self.client.get(self.url)
+        self.assertIn("ETag", primera)
+        segunda = self.client.get(self.url, HTTP_IF_NONE_MATCH=primera["ETag"])
+        self.assertEqual(segunda.status_code, 304)
+
+
+class FiltrosTests(TestCase):
+
+    def setUp(self):
+        Agencia.objects.create(location_id="LOC")
+
+    def test_precio_no_finito_es_400(self):
+        for valor in ("nan", "Infinity", "-inf", "abc"):
+            response = self.client.get("/front/api/properties/", {"agency_id": "LOC", "price_min": valor})
+            self.assertEqual(response.status_code, 400, valor)
+            self.assertIn("price_min", response.json())
+
+
+class ListaPaginadaTests(TestCase):
+
+    def test_lista_paginada_por_defecto(self):
+        agencia = Agencia.objects.create(location_id="LOC")
+        Propiedad.objects.bulk_create([Propiedad(agencia=agencia, ghl_contact_id=f"P{i}") for i in range(30)])
+        primera = self.client.get("/front/api/properties/", {"agency_id": "LOC"}).json()
+        self.assertEqual(len(primera["results"]), 24)
+        self.assertIsNotNone(primera["next"])
+        segunda = self.client.get(primera["next"]).json()
+        self.assertEqual(len(segunda["results"]), 6)
+        self.assertIsNone(segunda["next"])
+
+
+class ProyeccionUbicacionTests(TestCase):
+
+    def setUp(self):
+        self.provincia = Provincia.objects.create(nombre="Barcelona")
+        zona = Zona.objects.create(municipio=Municipio.objects.create(provincia=self.provincia, nombre="Badalona"), nombre="Centre")
+        self.propiedad = Propiedad.objects.create(agencia=Agencia.objects.create(location_id="LOC"), ghl_contact_id="P1", zona=zona)
+
+    def _texto(self):
+        return PropiedadPublica.objects.get(propiedad=self.propiedad).texto_busqueda
+
+    def test_renombrar_provincia_refresca_el_texto_de_busqueda(self):
+        self.assertIn("barcelona", self._texto())
+        self.provincia.nombre = "Girona"
+        self.provincia.save()
+        self.assertIn("girona", self._texto())
+        self.assertNotIn("barcelona", self._texto())
+
+    def test_borrar_provincia_deja_la_propiedad_sin_ubicacion(self):
+        self.provincia.delete()
+        self.assertNotIn("badalona", self._texto())
+
+
+# Trozos pequeños para que la respuesta se entregue en varias partes
+@mock.patch("ghl_middleware.streaming.TAMANO_TROZO", 100)
+class ExportacionStreamTests(TestCase):
+
+    def setUp(self):
+        agencia = Agencia.objects.create(location_id="LOC")
+        zona = Zona.objects.create(
+            municipio=Municipio.objects.create(provincia=Provincia.objects.create(nombre="Barcelona"), nombre="Barcelona"),
+            nombre="Gràcia"
+        )
+        for i in range(30):
+            Propiedad.objects.create(agencia=agencia, ghl_contact_id=f"P{i}", zona=zona, precio=100_000 + i)
+
+    def _esperadas(self):
+        respuesta = self.client.get("/front/api/properties/", {"agency_id": "LOC", "page_size": 100}).json()
+        return sorted(respuesta["results"], key=lambda fila: fila["id"])
+
+    def _stream(self, modo):
+        response = self.client.get("/front/api/properties/", {"agency_id": "LOC", "stream": modo})
+        self.assertTrue(response.streaming)
+        return response, b"".join(response.streaming_content).decode()
+
+    def test_stream_json_es_un_array_con_las_mismas_filas(self):
+        response, cuerpo = self._stream("json")
+        self.assertEqual(response["Content-Type"], "application/json")
+        self.assertEqual(sorted(json.loads(cuerpo), key=lambda fila: fila["id"]), self._esperadas())
+
+    def test_stream_ndjson_es_un_objeto_por_linea(self):
+        response, cuerpo = self._stream("ndjson")
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+        self.assertTrue(cuerpo.endswith("\n"))
+        filas = [json.loads(linea) for linea in cuerpo.splitlines()]
+        self.assertEqual(sorted(filas, key=lambda fila: fila["id"]), self._esperadas())
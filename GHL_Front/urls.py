@@ -1,12 +1,15 @@
 from django.urls import path
 # IMPORTANTE: Aquí importamos AMBAS vistas
-from .views import PublicPropertyList, PublicPropertyDetail
+from .views import PublicPropertyList, PublicPropertyDetail, PublicPropertySearch
 
 app_name = 'ghl_front'
 
 urlpatterns = [
     # Ruta para el listado
     path('api/properties/', PublicPropertyList.as_view(), name='public_properties'),
+
+    # Búsqueda libre y con errores de escritura (antes que el detalle: 'search' no es un id)
+    path('api/properties/search/', PublicPropertySearch.as_view(), name='public_property_search'),
     
     # Ruta para el detalle (Esta es la que daba error por no estar importada)
     path('api/properties/<str:ghl_contact_id>/', PublicPropertyDetail.as_view(), name='public_property_detail'),
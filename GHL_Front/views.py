@@ -1,11 +1,59 @@
+import json
 from rest_framework import generics
+from rest_framework.response import Response
 from ghl_middleware.models import Propiedad
 from .serializers import PropiedadPublicaSerializer
+from .pagination import PropiedadCursorPagination, BusquedaPagination
+from .filtros import filtrar_propiedades
+from .cache import respuesta_cacheada
+from .proyeccion import contenidos_publicos, recortar_campos, lista_json
+from .proyeccion import iterar_contenidos
+from .busqueda import ResultadosBusqueda
+from .models import PropiedadPublica
+from ghl_middleware.cache_publica import version_agencia, version_propiedad
+from ghl_middleware.streaming import modo_stream, respuesta_stream
 
 class PublicPropertyList(generics.ListAPIView):
     serializer_class = PropiedadPublicaSerializer
     authentication_classes = [] # API abierta
     permission_classes = []
+    pagination_class = PropiedadCursorPagination
+
+    def list(self, request, *args, **kwargs):
+        modo = modo_stream(request)
+        if modo:
+            # ?stream=1 / ?stream=ndjson: exportación completa sin paginar ni cachear,
+            # con memoria constante por grande que sea la agencia
+            filas = iterar_contenidos(self.filter_queryset(self.get_queryset()), request.query_params.get('fields'))
+            return respuesta_stream(filas, modo)
+
+        agency_id = request.query_params.get('agency_id')
+        if not agency_id:
+            return super().list(request, *args, **kwargs)
+        # Respuesta cacheada por agencia: se invalida al escribir cualquier propiedad suya
+        return respuesta_cacheada(
+            request, 'props', version_agencia(agency_id),
+            lambda: self._json(request, *args, **kwargs)
+        )
+
+    def _json(self, request, *args, **kwargs):
+        # JSON precalculado (PropiedadPublica): sin serializer ni joins de zona por fila
+        queryset = self.filter_queryset(self.get_queryset()).select_related('publica').only(
+            'id', 'precio', 'metros', 'publica__contenido'
+        )
+        # Siempre paginada (24 por defecto, ?page_size hasta 100): la lista completa
+        # de una agencia solo sale por ?stream=1
+        page = self.paginate_queryset(queryset)
+        contenidos = contenidos_publicos(page)
+        campos = request.query_params.get('fields')
+        if campos:
+            contenidos = recortar_campos(contenidos, campos)
+        # Mismo sobre que CursorPagination.get_paginated_response
+        return '{"next":%s,"previous":%s,"results":%s}' % (
+            json.dumps(self.paginator.get_next_link()),
+            json.dumps(self.paginator.get_previous_link()),
+            lista_json(contenidos)
+        )
 
     def get_queryset(self):
         # VERSIÓN SIMPLE:
@@ -13,8 +61,17 @@ class PublicPropertyList(generics.ListAPIView):
         agency_id = self.request.query_params.get('agency_id')
 
         if agency_id:
-            # Filtramos propiedades de esa agencia que estén activas
-            return Propiedad.objects.filter(agencia__location_id=agency_id, estado='activo')
+            # Filtramos propiedades de esa agencia que estén activas.
+            # Las filas salen de la proyección PropiedadPublica; zona y municipio solo los
+            # necesita el serializer cuando falta la proyección (ver proyeccion.py)
+            queryset = Propiedad.objects.filter(agencia__location_id=agency_id, estado='activo')
+            # Filtros del buscador (?price_min=&beds_min=&zona=&features=...): el front ya no filtra en el cliente
+            queryset = filtrar_propiedades(queryset, self.request.query_params)
+            ordering = self.request.query_params.get('ordering')
+            if ordering in PropiedadCursorPagination.ORDENES:
+                # La paginación por cursor aplica su propio orden; esto cubre el ?stream=1
+                queryset = queryset.order_by(*PropiedadCursorPagination.ORDENES[ordering])
+            return queryset
         
         # Si no pasan ID, devolvemos vacío para no mezclar datos
         return Propiedad.objects.none()
@@ -23,8 +80,54 @@ class PublicPropertyDetail(generics.RetrieveAPIView):
     """
     Vista para obtener el detalle de una sola propiedad usando su GHL Contact ID.
     """
-    queryset = Propiedad.objects.filter(estado='activo')
+    queryset = Propiedad.objects.filter(estado='activo').select_related('publica')
     serializer_class = PropiedadPublicaSerializer
     lookup_field = 'ghl_contact_id'  # IMPORTANTE: Buscamos por el ID de GHL, no el ID numérico de Django
     authentication_classes = []
     permission_classes = []
+
+    def retrieve(self, request, *args, **kwargs):
+        ghl_contact_id = kwargs[self.lookup_field]
+        return respuesta_cacheada(
+            request, 'prop', version_propiedad(ghl_contact_id),
+            lambda: self._json(request, *args, **kwargs)
+        )
+
+    def _json(self, request, *args, **kwargs):
+        contenido, = contenidos_publicos([self.get_object()])
+        campos = request.query_params.get('fields')
+        return recortar_campos([contenido], campos)[0] if campos else contenido
+
+class PublicPropertySearch(generics.ListAPIView):
+    """
+    Búsqueda libre: /api/properties/search/?agency_id=ABC-123&q=atico gracia barcelona
+    Tolera palabras mal escritas ('grasia') y devuelve las propiedades ordenadas por relevancia.
+    """
+    authentication_classes = []
+    permission_classes = []
+    pagination_class = BusquedaPagination
+
+    def list(self, request, *args, **kwargs):
+        agency_id = request.query_params.get('agency_id')
+        texto = request.query_params.get('q', '').strip()
+        if not agency_id or not texto:
+            return Response({'count': 0, 'next': None, 'previous': None, 'results': []})
+        return respuesta_cacheada(
+            request, 'buscar', version_agencia(agency_id),
+            lambda: self._json(request, agency_id, texto)
+        )
+
+    def _json(self, request, agency_id, texto):
+        pks = self.paginate_queryset(ResultadosBusqueda(agency_id, texto))
+        contenidos = dict(PropiedadPublica.objects.filter(pk__in=pks).values_list('propiedad_id', 'contenido'))
+        contenidos = [contenidos[pk] for pk in pks if pk in contenidos]
+        campos = request.query_params.get('fields')
+        if campos:
+            contenidos = recortar_campos(contenidos, campos)
+        # Mismo sobre que PageNumberPagination.get_paginated_response
+        return '{"count":%d,"next":%s,"previous":%s,"results":%s}' % (
+            self.paginator.page.paginator.count,
+            json.dumps(self.paginator.get_next_link()),
+            json.dumps(self.paginator.get_previous_link()),
+            lista_json(contenidos)
+        )
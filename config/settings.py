@@ -86,6 +86,37 @@ DATABASES = {
 }
 
 
+# --- CACHÉ ---
+# Con REDIS_URL la caché se comparte entre todos los procesos (web, worker...).
+# Sin ella cada proceso usa su propia caché en memoria: las invalidaciones solo
+# se ven en el proceso que las hace. Por eso lo que depende de invalidaciones
+# entre procesos (caché de respuestas de GHL_Front, árbol de zonas con ETag, índice
+# de matching en memoria) solo se activa con CACHE_COMPARTIDA.
+CACHE_COMPARTIDA = bool(os.environ.get('REDIS_URL'))
+if CACHE_COMPARTIDA:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.environ['REDIS_URL'],
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+
+# Segundos que se guarda el árbol provincia/municipio/zona serializado (con CACHE_COMPARTIDA).
+ZONAS_CACHE_TTL = int(os.environ.get('ZONAS_CACHE_TTL', 3600))
+
+# API pública de propiedades (GHL_Front): segundos que se guarda cada respuesta en la caché
+# (se invalida sola al escribir propiedades) y max-age que se envía a navegadores y CDNs.
+# Sin CACHE_COMPARTIDA no se cachea nada en el servidor ni se envía ETag.
+FRONT_CACHE_TTL = int(os.environ.get('FRONT_CACHE_TTL', 3600))
+FRONT_CACHE_MAX_AGE = int(os.environ.get('FRONT_CACHE_MAX_AGE', 60))
+
+
 # Password validation
 AUTH_PASSWORD_VALIDATORS = [
     { 'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator', },
@@ -168,6 +199,30 @@ GHL_CLIENT_SECRET = os.environ.get('GHL_CLIENT_SECRET', '')
 # URL de redirección (debe coincidir con la del Marketplace)
 GHL_REDIRECT_URI = os.environ.get('GHL_REDIRECT_URI', 'http://localhost:8000/api/oauth/callback/')
 
+# Ventana (segundos) en la que los syncs de asociaciones de una misma propiedad
+# se fusionan en una sola tarea con el último target set.
+GHL_SYNC_COALESCE_SECONDS = int(os.environ.get('GHL_SYNC_COALESCE_SECONDS', 5))
+
+# Máximo de llamadas simultáneas a GHL por location al sincronizar asociaciones.
+GHL_SYNC_MAX_CONCURRENCY = int(os.environ.get('GHL_SYNC_MAX_CONCURRENCY', 10))
+
+# Agencias a las que se envían los desplegables de zona a la vez (sync_zonas.py).
+GHL_ZONAS_SYNC_CONCURRENCY = int(os.environ.get('GHL_ZONAS_SYNC_CONCURRENCY', 4))
+
+# Segundos que un access_token se sirve desde memoria sin volver a leer GHLToken.
+GHL_TOKEN_CACHE_TTL = int(os.environ.get('GHL_TOKEN_CACHE_TTL', 300))
+
+# Índice de matching en memoria (requiere numpy y CACHE_COMPARTIDA): se usa en las agencias
+# con al menos este nº de clientes. 0 lo desactiva y todo el matching va por SQL.
+GHL_MATCH_INDEX_MIN_CLIENTES = int(os.environ.get('GHL_MATCH_INDEX_MIN_CLIENTES', 0))
+
+# Segundos tras los que el índice de una agencia se reconstruye entero desde la base de datos.
+GHL_MATCH_INDEX_TTL = int(os.environ.get('GHL_MATCH_INDEX_TTL', 3600))
+
+# Modo bandeja: los webhooks de propiedad/cliente guardan el payload en WebhookInbox
+# y responden 202 al momento; los procesa manage.py run_inbox_consumer.
+GHL_WEBHOOK_INBOX = os.environ.get('GHL_WEBHOOK_INBOX', 'False') == 'True'
+
 # Scopes
 GHL_SCOPES = [
     'contacts.readonly',
@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Agencia, Propiedad, Cliente, GHLToken, Zona, Municipio, Provincia
+from .models import Agencia, Propiedad, Cliente, GHLToken, Zona, Municipio, Provincia, TareaGHL, WebhookInbox
 
 # Esto hace que aparezcan en el panel y se vean bonitos con columnas
 
@@ -10,6 +10,8 @@ admin.site.register(GHLToken)
 admin.site.register(Zona)
 admin.site.register(Municipio)
 admin.site.register(Provincia)
+admin.site.register(TareaGHL)
+admin.site.register(WebhookInbox)
 # @admin.register(Agencia)
 # class AgenciaAdmin(admin.ModelAdmin):
 #     # Agregué 'active' que pusimos en el modelo
@@ -0,0 +1,145 @@
+import threading
+import time
+from django.conf import settings
+from django.db import transaction
+from .models import Provincia, Municipio, Zona, AmbitoGeografico, AmbitoZona
+from .zonas import meta_arbol_zonas, normalizar_nombre, existe_nombre
+
+# Interés geográfico a cualquier nivel del árbol Provincia -> Municipio -> Zona.
+# Cada nodo tiene un AmbitoGeografico y la tabla de cierre AmbitoZona guarda, para
+# cada ámbito, todas las zonas que cubre. Así "Provincia X" casa con sus zonas con
+# una sola join indexada (cliente -> ámbito -> zona), sin listas zona__in enormes.
+
+# nivel -> (modelo del nodo, campo de AmbitoGeografico que lo apunta)
+NODOS = {
+    AmbitoGeografico.Nivel.PROVINCIA: (Provincia, 'provincia'),
+    AmbitoGeografico.Nivel.MUNICIPIO: (Municipio, 'municipio'),
+    AmbitoGeografico.Nivel.ZONA: (Zona, 'zona'),
+}
+LOTE = 500
+
+
+# --- 1. MANTENIMIENTO DE LOS ÁMBITOS Y DE LA TABLA DE CIERRE ---
+
+def _asegurar_nodos(nivel, ids=None):
+    """
+    Crea los ámbitos que falten para esos nodos (o para todos los del nivel).
+    Devuelve {id del nodo: pk del ámbito}.
+    """
+    modelo, campo = NODOS[nivel]
+    ambitos = AmbitoGeografico.objects.filter(nivel=nivel)
+    nodos = modelo.objects.all()
+    if ids is not None:
+        ambitos = ambitos.filter(**{f"{campo}_id__in": ids})
+        nodos = nodos.filter(pk__in=ids)
+    existentes = dict(ambitos.values_list(f"{campo}_id", 'pk'))
+
+    faltan = [pk for pk in nodos.values_list('pk', flat=True) if pk not in existentes]
+    if faltan:
+        AmbitoGeografico.objects.bulk_create(
+            [AmbitoGeografico(nivel=nivel, **{f"{campo}_id": pk}) for pk in faltan],
+            batch_size=LOTE, ignore_conflicts=True
+        )
+        existentes.update(ambitos.filter(**{f"{campo}_id__in": faltan}).values_list(f"{campo}_id", 'pk'))
+    return existentes
+
+def sincronizar_ambitos(zonas_ids=None):
+    """
+    Crea los ámbitos que falten y recalcula las filas de cierre de 'zonas_ids'
+    (las de la zona, su municipio y su provincia). Sin argumentos lo hace con
+    todo el árbol, para los caminos que no lanzan señales (bulk_create).
+    """
+    zonas = Zona.objects.all() if zonas_ids is None else Zona.objects.filter(pk__in=zonas_ids)
+    filas = list(zonas.values_list('pk', 'municipio_id', 'municipio__provincia_id'))
+
+    with transaction.atomic():
+        if zonas_ids is None:
+            # También las provincias y municipios que aún no tienen zonas
+            provincias = _asegurar_nodos(AmbitoGeografico.Nivel.PROVINCIA)
+            municipios = _asegurar_nodos(AmbitoGeografico.Nivel.MUNICIPIO)
+            por_zona = _asegurar_nodos(AmbitoGeografico.Nivel.ZONA)
+            AmbitoZona.objects.all().delete()
+        else:
+            provincias = _asegurar_nodos(AmbitoGeografico.Nivel.PROVINCIA, {fila[2] for fila in filas})
+            municipios = _asegurar_nodos(AmbitoGeografico.Nivel.MUNICIPIO, {fila[1] for fila in filas})
+            por_zona = _asegurar_nodos(AmbitoGeografico.Nivel.ZONA, [fila[0] for fila in filas])
+            AmbitoZona.objects.filter(zona_id__in=zonas_ids).delete()
+
+        AmbitoZona.objects.bulk_create([
+            AmbitoZona(ambito_id=ambito_id, zona_id=zona_id)
+            for zona_id, municipio_id, provincia_id in filas
+            for ambito_id in (por_zona[zona_id], municipios[municipio_id], provincias[provincia_id])
+        ], batch_size=LOTE, ignore_conflicts=True)
+    return len(filas)
+
+def asegurar_ambito(nivel, nodo_id):
+    """
+    Ámbito de un solo nodo (provincia o municipio recién creado, aún sin zonas).
+    """
+    return _asegurar_nodos(nivel, [nodo_id])[nodo_id]
+
+
+# --- 2. RESOLUTOR DE NOMBRES EN MEMORIA ---
+# GHL manda el interés del cliente como lista de nombres. Un nombre sin prefijo es
+# una zona (como siempre); si no hay ninguna zona con ese nombre, se prueba con
+# municipios y después con provincias. 'Municipio: Barcelona' o 'Provincia: Barcelona'
+# fuerzan el nivel (Barcelona es las dos cosas).
+# nivel -> nombre normalizado -> [pks de ámbito], recargado con la versión del árbol
+# o, como el de zonas.py, cuando un nombre desconocido sí está en la base de datos.
+
+_resolutor = {"version": None, "cargado_en": 0.0, "mapa": {}}
+_resolutor_lock = threading.Lock()
+
+def _mapa_ambitos(forzar=False):
+    version, _ = meta_arbol_zonas()
+    caducado = time.monotonic() - _resolutor["cargado_en"] > settings.ZONAS_CACHE_TTL
+    if forzar or _resolutor["version"] != version or caducado:
+        with _resolutor_lock:
+            if forzar or _resolutor["version"] != version or time.monotonic() - _resolutor["cargado_en"] > settings.ZONAS_CACHE_TTL:
+                mapa = {nivel: {} for nivel in NODOS}
+                filas = AmbitoGeografico.objects.order_by('pk').values_list(
+                    'pk', 'nivel', 'provincia__nombre', 'municipio__nombre', 'zona__nombre'
+                )
+                for pk, nivel, provincia, municipio, zona in filas:
+                    mapa[nivel].setdefault(normalizar_nombre(provincia or municipio or zona), []).append(pk)
+                _resolutor.update(version=version, cargado_en=time.monotonic(), mapa=mapa)
+    return _resolutor["mapa"]
+
+def _candidatos(mapa, nombre):
+    """
+    ([pks de ámbito], [niveles en los que se ha buscado], nombre sin el prefijo de nivel).
+    """
+    nivel, _, resto = str(nombre).partition(":")
+    nivel = normalizar_nombre(nivel)
+    if resto and nivel in mapa:
+        return mapa[nivel].get(normalizar_nombre(resto), []), [nivel], resto
+    clave = normalizar_nombre(nombre)
+    candidatos = (
+        mapa[AmbitoGeografico.Nivel.ZONA].get(clave)
+        or mapa[AmbitoGeografico.Nivel.MUNICIPIO].get(clave)
+        or mapa[AmbitoGeografico.Nivel.PROVINCIA].get(clave, [])
+    )
+    return candidatos, list(NODOS), nombre
+
+def resolver_ambitos(nombres):
+    """
+    Pks de los ámbitos que nombran 'nombres'. Los desconocidos se ignoran.
+    """
+    mapa = _mapa_ambitos()
+    ids = []
+    for nombre in nombres:
+        candidatos, niveles, texto = _candidatos(mapa, nombre)
+        if not candidatos and any(existe_nombre(NODOS[nivel][0], texto) for nivel in niveles):
+            # Creado en otro proceso después de cargar el mapa
+            mapa = _mapa_ambitos(forzar=True)
+            candidatos, _, _ = _candidatos(mapa, nombre)
+        for pk in candidatos:
+            if pk not in ids:
+                ids.append(pk)
+    return ids
+
+def etiqueta_ambito(nivel, nombre):
+    """
+    Texto de la opción del desplegable de GHL que resolver_ambitos() lee como ese ámbito.
+    """
+    return nombre if nivel == AmbitoGeografico.Nivel.ZONA else f"{AmbitoGeografico.Nivel(nivel).label}: {nombre}"
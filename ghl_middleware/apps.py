@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class GhlMiddlewareConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'ghl_middleware'
+
+    def ready(self):
+        from . import signals  # noqa: F401
@@ -0,0 +1,205 @@
+import math
+import random
+import time
+from contextlib import contextmanager
+from unittest import mock
+import requests
+from django.db import connection
+from django.db.models import Q
+from django.test.utils import CaptureQueriesContext
+from .models import Agencia, GHLToken, Provincia, Municipio, Zona, AmbitoGeografico, Propiedad, Cliente
+from .ghl_service import GHLClient
+from .zonas import invalidar_arbol_zonas
+from .ambitos import sincronizar_ambitos
+
+# Utilidades compartidas por los comandos bench_* : generador de datos sintéticos,
+# payloads con la forma real de los webhooks de GHL y medición de latencias/queries.
+
+PREFIJO = "BENCH"
+LOTE = 2000
+
+
+def generar_dataset(agencias=1, zonas=50, propiedades=1000, clientes=1000, semilla=42):
+    """
+    Crea agencias, zonas, propiedades y clientes sintéticos con bulk_create.
+    Devuelve un dict con lo necesario para generar payloads después.
+    """
+    rnd = random.Random(semilla)
+
+    provincia = Provincia.objects.create(nombre=f"{PREFIJO} Provincia {semilla}")
+    municipios = Municipio.objects.bulk_create([
+        Municipio(provincia=provincia, nombre=f"{PREFIJO} Municipio {i:03d}")
+        for i in range(max(1, zonas // 10))
+    ])
+    zonas_objs = Zona.objects.bulk_create([
+        Zona(municipio=municipios[i % len(municipios)], nombre=f"{PREFIJO} Zona {i:04d}")
+        for i in range(zonas)
+    ])
+    zonas_objs = list(Zona.objects.filter(municipio__provincia=provincia).order_by('pk'))
+    # bulk_create no lanza señales: ámbitos, árbol y resolutor a mano
+    sincronizar_ambitos([z.pk for z in zonas_objs])
+    invalidar_arbol_zonas()
+    ambito_zona = dict(AmbitoGeografico.objects.filter(zona__in=zonas_objs).values_list('zona_id', 'pk'))
+    ambitos_municipio = list(AmbitoGeografico.objects.filter(municipio__provincia=provincia).values_list('pk', flat=True))
+
+    location_ids = [f"{PREFIJO}-LOC-{semilla}-{i}" for i in range(agencias)]
+    Agencia.objects.bulk_create([
+        Agencia(location_id=loc, nombre=f"Agencia {loc}", association_type_id=f"{PREFIJO}-ASSOC")
+        for loc in location_ids
+    ])
+    GHLToken.objects.bulk_create([
+        GHLToken(location_id=loc, access_token="bench", refresh_token="bench", token_type="Bearer", scope="", expires_in=10**8)
+        for loc in location_ids
+    ])
+
+    def si_no(p):
+        return "si" if rnd.random() < p else "no"
+
+    Propiedad.objects.bulk_create([
+        Propiedad(
+            agencia_id=location_ids[i % agencias],
+            ghl_contact_id=f"{PREFIJO}-P-{i}",
+            precio=rnd.randrange(80_000, 900_000, 5_000),
+            zona=rnd.choice(zonas_objs),
+            habitaciones=rnd.randint(0, 6),
+            estado=rnd.choices(["activo", "vendido", "noficial"], [0.8, 0.15, 0.05])[0],
+            metros=rnd.randint(30, 300),
+            animales=si_no(0.5), balcon=si_no(0.5), garaje=si_no(0.3), patioInterior=si_no(0.2),
+            imagenesUrl=[f"https://img.example.com/{i}/{n}.jpg" for n in range(rnd.randint(0, 4))],
+        )
+        for i in range(propiedades)
+    ], batch_size=LOTE)
+
+    def pref2(p):
+        return "si" if rnd.random() < p else "ind"
+
+    Cliente.objects.bulk_create([
+        Cliente(
+            agencia_id=location_ids[i % agencias],
+            ghl_contact_id=f"{PREFIJO}-C-{i}",
+            nombre=f"Comprador {i}",
+            presupuesto_maximo=rnd.randrange(100_000, 1_000_000, 5_000),
+            habitaciones_minimas=rnd.randint(0, 4),
+            metrosMinimo=rnd.choice([0, 0, 40, 60, 80, 100]),
+            animales=si_no(0.3), balcon=pref2(0.3), garaje=pref2(0.2), patioInterior=pref2(0.1),
+        )
+        for i in range(clientes)
+    ], batch_size=LOTE)
+
+    # Uno de cada diez compradores busca en todo un municipio; el resto, en 1-4 zonas
+    AmbitoInteres = Cliente.ambitos_interes.through
+    ids_clientes = Cliente.objects.filter(agencia_id__in=location_ids).values_list('pk', flat=True)
+    AmbitoInteres.objects.bulk_create([
+        AmbitoInteres(cliente_id=pk, ambitogeografico_id=ambito_id)
+        for pk in ids_clientes
+        for ambito_id in (
+            [rnd.choice(ambitos_municipio)] if rnd.random() < 0.1
+            else [ambito_zona[z.pk] for z in rnd.sample(zonas_objs, k=min(len(zonas_objs), rnd.randint(1, 4)))]
+        )
+    ], batch_size=LOTE, ignore_conflicts=True)
+
+    return {
+        "location_ids": location_ids,
+        "zonas": [z.nombre for z in zonas_objs],
+        "ambitos": list(AmbitoGeografico.objects.filter(
+            Q(provincia=provincia) | Q(municipio__provincia=provincia) | Q(zona__in=zonas_objs)
+        ).values_list('pk', flat=True)),
+        "propiedades": propiedades,
+        "clientes": clientes,
+    }
+
+
+# --- PAYLOADS CON LA FORMA DE GHL ---
+
+def _clave_ghl(nombre):
+    # GHL manda las opciones de los desplegables como key: "Sant Andreu" -> "sant_andreu"
+    return nombre.lower().strip().replace(" ", "_")
+
+def payload_propiedad(rnd, dataset, indice):
+    loc = dataset["location_ids"][indice % len(dataset["location_ids"])]
+    return {
+        "id": f"{PREFIJO}-P-{indice}",
+        "location": {"id": loc},
+        "customData": {
+            "location_id": loc,
+            "contact_id": f"{PREFIJO}-P-{indice}",
+            "precio": f"${rnd.randrange(80_000, 900_000, 5_000):,}",
+            "habitaciones": str(rnd.randint(0, 6)),
+            "metros": str(rnd.randint(30, 300)),
+            "estado": rnd.choices(["a_la_venta", "vendido", "no_es_oficial"], [0.85, 0.1, 0.05])[0],
+            "zona": _clave_ghl(rnd.choice(dataset["zonas"])),
+            "animales": rnd.choice(["si", "no"]),
+            "balcon": rnd.choice(["si", "no"]),
+            "garaje": rnd.choice(["si", "no"]),
+            "patioInterior": rnd.choice(["si", "no"]),
+            "imagenesUrl": [{"url": f"https://img.example.com/{indice}/{n}.jpg"} for n in range(rnd.randint(0, 4))],
+        },
+    }
+
+def payload_cliente(rnd, dataset, indice):
+    loc = dataset["location_ids"][indice % len(dataset["location_ids"])]
+    zonas = rnd.sample(dataset["zonas"], k=min(len(dataset["zonas"]), rnd.randint(1, 4)))
+    return {
+        "id": f"{PREFIJO}-C-{indice}",
+        "location": {"id": loc},
+        "customData": {
+            "location_id": loc,
+            "full_name": f"Comprador {indice}",
+            "presupuesto": str(rnd.randrange(100_000, 1_000_000, 5_000)),
+            "habitaciones": str(rnd.randint(0, 4)),
+            "metros": str(rnd.choice([0, 40, 60, 80, 100])),
+            "zona_interes": ", ".join(zonas),
+            "animales": rnd.choice(["si", "no"]),
+            "balcon": rnd.choice(["si", "indiferente"]),
+            "garaje": rnd.choice(["si", "indiferente"]),
+            "patioInterior": rnd.choice(["si", "indiferente"]),
+        },
+    }
+
+
+# --- STUB DE GHL Y MEDICIÓN ---
+
+@contextmanager
+def ghl_simulado():
+    """
+    Sustituye la capa HTTP de GHL por respuestas 200 vacías: el benchmark nunca sale a la red.
+    """
+    def falso_request(self, method, url, **kwargs):
+        response = requests.Response()
+        response.status_code = 200
+        response._content = b'{"relations": [], "associationTypes": []}'
+        return response
+
+    with mock.patch.object(GHLClient, "request", falso_request):
+        yield
+
+def percentil(valores, p):
+    if not valores:
+        return 0.0
+    ordenados = sorted(valores)
+    return ordenados[max(0, math.ceil(p / 100 * len(ordenados)) - 1)]
+
+def medir(funcion, argumentos):
+    """
+    Ejecuta funcion(arg) para cada argumento midiendo latencia y nº de queries.
+    """
+    latencias, queries = [], []
+    inicio = time.perf_counter()
+    for arg in argumentos:
+        with CaptureQueriesContext(connection) as ctx:
+            t0 = time.perf_counter()
+            funcion(arg)
+            latencias.append(time.perf_counter() - t0)
+        queries.append(len(ctx))
+        # El log de queries es un deque acotado que avisa al llenarse; solo nos interesa el recuento
+        connection.queries_log.clear()
+    total = time.perf_counter() - inicio
+    return {
+        "n": len(latencias),
+        "p50_ms": percentil(latencias, 50) * 1000,
+        "p95_ms": percentil(latencias, 95) * 1000,
+        "p99_ms": percentil(latencias, 99) * 1000,
+        "queries_media": sum(queries) / len(queries) if queries else 0,
+        "queries_max": max(queries) if queries else 0,
+        "rps": len(latencias) / total if total else 0,
+    }
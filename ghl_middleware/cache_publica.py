@@ -0,0 +1,60 @@
+import time
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.dispatch import Signal
+
+# Versiones de lo que publica la API pública de propiedades (GHL_Front).
+# Las respuestas se cachean bajo la versión vigente: invalidar es subir la versión,
+# sin tener que localizar ni borrar las claves de cada combinación de filtros.
+# Igual que el árbol de zonas, arrancan en un timestamp en ms para que una clave
+# perdida nunca vuelva a un valor ya usado (y a un ETag antiguo).
+
+# Se envía con location_id y ghl_contact_ids al escribir propiedades (también desde
+# los bulk_create de la ingesta). GHL_Front la usa para regenerar su proyección.
+propiedades_publicas_modificadas = Signal()
+
+
+def _clave_agencia(location_id):
+    return f"front:agencia:{location_id}:v"
+
+def _clave_propiedad(ghl_contact_id):
+    return f"front:propiedad:{ghl_contact_id}:v"
+
+def _version(clave):
+    version = cache.get(clave)
+    if version is None:
+        cache.add(clave, int(time.time() * 1000), None)
+        version = cache.get(clave) or int(time.time() * 1000)
+    return version
+
+def version_agencia(location_id):
+    """
+    Versión del listado de una agencia: cambia con cualquier escritura de sus propiedades.
+    """
+    return _version(_clave_agencia(location_id))
+
+def version_propiedad(ghl_contact_id):
+    """
+    Versión del detalle de una propiedad (el detalle se busca por ghl_contact_id, sin agencia).
+    """
+    return _version(_clave_propiedad(ghl_contact_id))
+
+def _subir(claves):
+    # Un get_many y un set_many aunque sean miles de registros (un lote de webhooks)
+    actuales = cache.get_many(claves)
+    ahora = int(time.time() * 1000)
+    cache.set_many({clave: max(actuales.get(clave, 0) + 1, ahora) for clave in claves}, None)
+
+def invalidar_propiedades_publicas(location_id, ghl_contact_ids):
+    """
+    Avisa de la escritura (proyección de GHL_Front) e invalida el listado de la
+    agencia y el detalle de esas propiedades.
+    """
+    ghl_contact_ids = list(ghl_contact_ids)
+    propiedades_publicas_modificadas.send(sender=None, location_id=location_id, ghl_contact_ids=ghl_contact_ids)
+    claves = [_clave_agencia(location_id)] + [_clave_propiedad(pk) for pk in ghl_contact_ids]
+    _subir(claves)
+    if connection.in_atomic_block:
+        # Una petición entre la escritura y el commit cachearía los datos viejos
+        # con la versión nueva: se vuelve a subir al confirmar la transacción
+        transaction.on_commit(lambda: _subir(claves))
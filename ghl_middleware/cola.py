@@ -0,0 +1,221 @@
+import logging
+import random
+from datetime import timedelta
+from django.db import transaction, IntegrityError
+from django.db.models import F, Q
+from django.utils import timezone
+from .models import TareaGHL
+
+logger = logging.getLogger(__name__)
+
+# Backoff exponencial entre reintentos: 10s, 20s, 40s... con tope de 15 min
+BACKOFF_BASE_SEGUNDOS = 10
+BACKOFF_MAX_SEGUNDOS = 900
+
+
+def encolar(tipo, location_id="", payload=None, retraso=0):
+    """
+    Inserta una tarea pendiente. Es lo único que hacen ahora los webhooks:
+    el trabajo real lo ejecuta el worker en otro proceso.
+    """
+    tarea = TareaGHL.objects.create(
+        tipo=tipo,
+        location_id=location_id or "",
+        payload=payload or {},
+        ejecutar_despues=timezone.now() + timedelta(seconds=retraso)
+    )
+    logger.info(f"📬 Tarea encolada: {tarea}")
+    return tarea
+
+def encolar_coalescido(tipo, clave, location_id="", payload=None, ventana=0, fusionar=None):
+    """
+    Igual que encolar(), pero si ya hay una tarea pendiente con la misma clave
+    se reutiliza sustituyendo su payload por el nuevo (el último gana), o por
+    fusionar(payload_pendiente, payload_nuevo) si se indica.
+    La primera tarea de la ráfaga espera 'ventana' segundos antes de poder
+    ejecutarse, para dar tiempo a que lleguen los webhooks repetidos.
+    """
+    # El UniqueConstraint parcial garantiza una sola pendiente por clave;
+    # si dos peticiones la crean a la vez, la perdedora reintenta y fusiona.
+    for _ in range(3):
+        try:
+            with transaction.atomic():
+                existente = (
+                    TareaGHL.objects
+                    .select_for_update()
+                    .filter(clave=clave, estado=TareaGHL.Estado.PENDIENTE)
+                    .first()
+                )
+                if existente:
+                    existente.payload = fusionar(existente.payload, payload or {}) if fusionar else (payload or {})
+                    existente.save(update_fields=['payload', 'updated_at'])
+                    logger.info(f"🧩 Tarea fusionada: {existente}")
+                    return existente
+
+                tarea = TareaGHL.objects.create(
+                    tipo=tipo,
+                    clave=clave,
+                    location_id=location_id or "",
+                    payload=payload or {},
+                    ejecutar_despues=timezone.now() + timedelta(seconds=ventana)
+                )
+                logger.info(f"📬 Tarea encolada: {tarea}")
+                return tarea
+        except IntegrityError:
+            continue
+    raise RuntimeError(f"No se pudo encolar la tarea con clave {clave}")
+
+def encolar_coalescidos(tipo, tareas, location_id="", ventana=0, fusionar=None):
+    """
+    Versión por lotes de encolar_coalescido(): 'tareas' es {clave: payload}.
+    Un SELECT, un bulk_update y un bulk_create para todo el lote.
+    """
+    for _ in range(3):
+        try:
+            with transaction.atomic():
+                ahora = timezone.now()
+                existentes = list(
+                    TareaGHL.objects
+                    .select_for_update()
+                    .filter(clave__in=list(tareas), estado=TareaGHL.Estado.PENDIENTE)
+                )
+                for tarea in existentes:
+                    nuevo = tareas[tarea.clave] or {}
+                    tarea.payload = fusionar(tarea.payload, nuevo) if fusionar else nuevo
+                    tarea.updated_at = ahora
+                TareaGHL.objects.bulk_update(existentes, ['payload', 'updated_at'], batch_size=500)
+
+                claves_existentes = {tarea.clave for tarea in existentes}
+                nuevas = TareaGHL.objects.bulk_create([
+                    TareaGHL(
+                        tipo=tipo,
+                        clave=clave,
+                        location_id=location_id or "",
+                        payload=payload or {},
+                        ejecutar_despues=ahora + timedelta(seconds=ventana)
+                    )
+                    for clave, payload in tareas.items() if clave not in claves_existentes
+                ], batch_size=500)
+                logger.info(f"📬 Lote encolado: {len(nuevas)} tareas nuevas, {len(existentes)} fusionadas")
+                return len(nuevas) + len(existentes)
+        except IntegrityError:
+            continue
+    raise RuntimeError(f"No se pudo encolar el lote de {len(tareas)} tareas")
+
+def reclamar(limite, lease_segundos):
+    """
+    Reclama hasta 'limite' tareas listas con SELECT ... FOR UPDATE SKIP LOCKED,
+    de forma que varios workers nunca cojan la misma fila.
+    También recupera tareas 'en_curso' cuyo lease ha caducado (worker caído).
+    Una tarea pendiente no se reclama mientras otra con su misma clave siga en
+    curso, para no sincronizar el mismo registro dos veces en paralelo.
+    """
+    ahora = timezone.now()
+    with transaction.atomic():
+        # Una tarea que tumba al worker una y otra vez no se reclama indefinidamente
+        TareaGHL.objects.filter(
+            estado=TareaGHL.Estado.EN_CURSO,
+            bloqueada_hasta__lt=ahora,
+            intentos__gte=F('max_intentos')
+        ).update(
+            estado=TareaGHL.Estado.FALLIDA,
+            bloqueada_hasta=None,
+            ultimo_error="Lease caducado con los intentos agotados",
+            updated_at=ahora
+        )
+
+        claves_en_curso = (
+            TareaGHL.objects
+            .filter(estado=TareaGHL.Estado.EN_CURSO, bloqueada_hasta__gte=ahora)
+            .exclude(clave="")
+            .values('clave')
+        )
+        ids = list(
+            TareaGHL.objects
+            .select_for_update(skip_locked=True)
+            .filter(
+                Q(estado=TareaGHL.Estado.PENDIENTE, ejecutar_despues__lte=ahora) |
+                Q(estado=TareaGHL.Estado.EN_CURSO, bloqueada_hasta__lt=ahora)
+            )
+            .exclude(Q(estado=TareaGHL.Estado.PENDIENTE) & Q(clave__in=claves_en_curso))
+            .order_by('ejecutar_despues')
+            .values_list('id', flat=True)[:limite]
+        )
+        if not ids:
+            return []
+
+        TareaGHL.objects.filter(id__in=ids).update(
+            estado=TareaGHL.Estado.EN_CURSO,
+            intentos=F('intentos') + 1,
+            bloqueada_hasta=ahora + timedelta(seconds=lease_segundos),
+            updated_at=ahora
+        )
+    return list(TareaGHL.objects.filter(id__in=ids).order_by('ejecutar_despues'))
+
+def completar(tarea):
+    TareaGHL.objects.filter(pk=tarea.pk).update(
+        estado=TareaGHL.Estado.COMPLETADA,
+        bloqueada_hasta=None,
+        ultimo_error="",
+        updated_at=timezone.now()
+    )
+
+def reintentar_o_fallar(tarea, error, fusionar=None):
+    """
+    Devuelve la tarea a 'pendiente' con backoff exponencial (con jitter),
+    o la marca como 'fallida' si ya agotó sus intentos.
+    Si mientras se ejecutaba se encoló otra pendiente con su misma clave, no puede
+    haber dos: su payload se fusiona en esa (con 'fusionar', como encolar_coalescido;
+    sin él gana el de la pendiente, que es el más reciente) y esta se da por completada.
+    """
+    ahora = timezone.now()
+    if tarea.intentos >= tarea.max_intentos:
+        logger.error(f"❌ {tarea} agotó sus {tarea.max_intentos} intentos: {error}")
+        TareaGHL.objects.filter(pk=tarea.pk).update(
+            estado=TareaGHL.Estado.FALLIDA,
+            bloqueada_hasta=None,
+            ultimo_error=str(error),
+            updated_at=ahora
+        )
+        return
+
+    espera = min(BACKOFF_BASE_SEGUNDOS * 2 ** (tarea.intentos - 1), BACKOFF_MAX_SEGUNDOS)
+    espera = espera * random.uniform(0.8, 1.2)
+    # Igual que en encolar_coalescido: si otra pendiente aparece entre el SELECT
+    # y el UPDATE, el UniqueConstraint salta y se vuelve a intentar fusionando
+    for _ in range(3):
+        try:
+            with transaction.atomic():
+                pendiente = None
+                if tarea.clave:
+                    pendiente = (
+                        TareaGHL.objects
+                        .select_for_update()
+                        .filter(clave=tarea.clave, estado=TareaGHL.Estado.PENDIENTE)
+                        .exclude(pk=tarea.pk)
+                        .first()
+                    )
+                if pendiente:
+                    pendiente.payload = fusionar(tarea.payload, pendiente.payload) if fusionar else pendiente.payload
+                    pendiente.save(update_fields=['payload', 'updated_at'])
+                    logger.warning(f"⚠️ {tarea} falló (intento {tarea.intentos}), fusionada en {pendiente}: {error}")
+                    TareaGHL.objects.filter(pk=tarea.pk).update(
+                        estado=TareaGHL.Estado.COMPLETADA,
+                        bloqueada_hasta=None,
+                        ultimo_error=f"Fusionada en la tarea #{pendiente.pk} tras fallar: {error}",
+                        updated_at=ahora
+                    )
+                    return
+
+                logger.warning(f"⚠️ {tarea} falló (intento {tarea.intentos}), reintento en {espera:.0f}s: {error}")
+                TareaGHL.objects.filter(pk=tarea.pk).update(
+                    estado=TareaGHL.Estado.PENDIENTE,
+                    bloqueada_hasta=None,
+                    ejecutar_despues=ahora + timedelta(seconds=espera),
+                    ultimo_error=str(error),
+                    updated_at=ahora
+                )
+                return
+        except IntegrityError:
+            continue
+    raise RuntimeError(f"No se pudo devolver a la cola {tarea}")
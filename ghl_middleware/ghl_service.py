@@ -1 +1,177 @@
+import logging
+import random
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
 
+logger = logging.getLogger(__name__)
+
+GHL_BASE_URL = "https://services.leadconnectorhq.com"
+GHL_API_VERSION = "2021-07-28"
+
+# Límite "burst" documentado por GHL: 100 peticiones cada 10 s por location.
+# Se usa hasta que las cabeceras X-RateLimit-* de la respuesta digan otra cosa.
+RATE_LIMIT_MAX = 100
+RATE_LIMIT_INTERVALO_SEGUNDOS = 10
+
+
+class TokenBucket:
+    """
+    Cubo de tokens de una location. consumir() bloquea hasta que hay hueco,
+    en lugar de los time.sleep() fijos que había antes en cada llamada.
+    """
+    def __init__(self, capacidad=RATE_LIMIT_MAX, intervalo=RATE_LIMIT_INTERVALO_SEGUNDOS):
+        self.capacidad = float(capacidad)
+        self.tasa = capacidad / intervalo
+        self.tokens = float(capacidad)
+        self.actualizado = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _rellenar(self):
+        ahora = time.monotonic()
+        self.tokens = min(self.capacidad, self.tokens + (ahora - self.actualizado) * self.tasa)
+        self.actualizado = ahora
+
+    def consumir(self):
+        while True:
+            with self.lock:
+                self._rellenar()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                espera = (1 - self.tokens) / self.tasa
+            time.sleep(espera)
+
+    def ajustar(self, maximo=None, restantes=None, intervalo_ms=None):
+        """Sincroniza el cubo con lo que GHL dice que nos queda."""
+        with self.lock:
+            self._rellenar()
+            if maximo and intervalo_ms:
+                self.capacidad = float(maximo)
+                self.tasa = maximo / (intervalo_ms / 1000)
+            if restantes is not None:
+                self.tokens = min(self.tokens, float(restantes))
+
+    def pausar(self, segundos):
+        """Tras un 429 nadie de esta location vuelve a llamar hasta pasados 'segundos'."""
+        with self.lock:
+            self._rellenar()
+            self.tokens = min(self.tokens, 0) - segundos * self.tasa
+
+
+class GHLClient:
+    """
+    Cliente HTTP compartido para la API de GHL.
+    - Una requests.Session con pool keep-alive por proceso (sin handshake TLS por llamada).
+    - Un TokenBucket por location alimentado con las cabeceras X-RateLimit-*.
+    - Reintentos de 429/5xx y errores de red con backoff exponencial y jitter.
+    """
+    def __init__(self, pool_size=20, max_reintentos=3, timeout=10, backoff_base=0.5, backoff_max=20):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.max_reintentos = max_reintentos
+        self.timeout = timeout
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def bucket(self, location_id):
+        with self._lock:
+            if location_id not in self._buckets:
+                self._buckets[location_id] = TokenBucket()
+            return self._buckets[location_id]
+
+    def _backoff(self, intento):
+        espera = min(self.backoff_base * 2 ** intento, self.backoff_max)
+        return random.uniform(0, espera)  # "full jitter"
+
+    def _leer_rate_limit(self, location_id, response):
+        h = response.headers
+        try:
+            maximo = int(h["X-RateLimit-Max"]) if "X-RateLimit-Max" in h else None
+            restantes = int(h["X-RateLimit-Remaining"]) if "X-RateLimit-Remaining" in h else None
+            intervalo_ms = int(h["X-RateLimit-Interval-Milliseconds"]) if "X-RateLimit-Interval-Milliseconds" in h else None
+        except ValueError:
+            return
+        if maximo or restantes is not None:
+            self.bucket(location_id).ajustar(maximo, restantes, intervalo_ms)
+
+        diarias = h.get("X-RateLimit-Daily-Remaining")
+        if diarias is not None and diarias.isdigit() and int(diarias) < 1000:
+            logger.warning(f"⚠️ Quedan {diarias} peticiones diarias a GHL para {location_id}")
+
+    def request(self, method, url, access_token=None, location_id=None, headers=None, reintentos=None, **kwargs):
+        """
+        Hace la petición y devuelve el Response (aunque sea un error HTTP).
+        'url' puede ser absoluta o una ruta relativa a GHL_BASE_URL.
+        Solo lanza excepción si fallan todos los intentos por error de red.
+        """
+        if not url.startswith("http"):
+            url = f"{GHL_BASE_URL}{url}"
+        cabeceras = {"Version": GHL_API_VERSION, "Accept": "application/json"}
+        if access_token:
+            cabeceras["Authorization"] = f"Bearer {access_token}"
+        cabeceras.update(headers or {})
+        kwargs.setdefault("timeout", self.timeout)
+        reintentos = self.max_reintentos if reintentos is None else reintentos
+
+        for intento in range(reintentos + 1):
+            if location_id:
+                self.bucket(location_id).consumir()
+
+            try:
+                response = self.session.request(method, url, headers=cabeceras, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if intento >= reintentos:
+                    raise
+                espera = self._backoff(intento)
+                logger.warning(f"⚠️ Error de red con GHL ({e}), reintento en {espera:.1f}s")
+                time.sleep(espera)
+                continue
+
+            if location_id:
+                self._leer_rate_limit(location_id, response)
+
+            if response.status_code == 429 or response.status_code >= 500:
+                if intento >= reintentos:
+                    return response
+                retry_after = response.headers.get("Retry-After", "")
+                espera = float(retry_after) if retry_after.replace(".", "", 1).isdigit() else self._backoff(intento)
+                logger.warning(f"⚠️ GHL respondió {response.status_code} en {method} {url}, reintento en {espera:.1f}s")
+                if response.status_code == 429 and location_id:
+                    # El cubo frena a todos los hilos de la location, incluido este
+                    self.bucket(location_id).pausar(espera)
+                else:
+                    time.sleep(espera)
+                continue
+
+            return response
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request("PUT", url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request("DELETE", url, **kwargs)
+
+
+_cliente = None
+_cliente_lock = threading.Lock()
+
+def get_ghl_client():
+    """Devuelve el GHLClient del proceso (se crea la primera vez)."""
+    global _cliente
+    if _cliente is None:
+        with _cliente_lock:
+            if _cliente is None:
+                _cliente = GHLClient()
+    return _cliente
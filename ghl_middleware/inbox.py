@@ -0,0 +1,127 @@
+import hashlib
+import json
+import logging
+import random
+from datetime import timedelta
+from django.db import transaction
+from django.utils import timezone
+from .cola import BACKOFF_BASE_SEGUNDOS, BACKOFF_MAX_SEGUNDOS
+from .ingesta import datos_propiedad, datos_cliente, ingerir_propiedades, ingerir_clientes, procesar_lote
+from .models import WebhookInbox
+
+logger = logging.getLogger(__name__)
+
+MAX_INTENTOS = 5
+
+# tipo -> (traductor del payload, ingesta por lotes)
+PROCESADORES = {
+    WebhookInbox.Tipo.PROPIEDAD: (datos_propiedad, ingerir_propiedades),
+    WebhookInbox.Tipo.CLIENTE: (datos_cliente, ingerir_clientes),
+}
+
+
+# --- 1. RECEPCIÓN (lo que hacen los webhooks en modo bandeja) ---
+
+def clave_idempotencia(data, cabecera=None):
+    """
+    La cabecera Idempotency-Key si viene; si no, el sha256 del payload canónico
+    (los reenvíos de GHL repiten exactamente el mismo cuerpo).
+    """
+    if cabecera:
+        return cabecera[:128]
+    contenido = json.dumps(data, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(contenido.encode()).hexdigest()
+
+def guardar_en_bandeja(tipo, data, cabecera=None):
+    """
+    Guarda el payload crudo con un solo INSERT. Si ya hay una entrada pendiente con
+    la misma clave (reenvío), el INSERT no hace nada.
+    Un reenvío que llega cuando el original ya se procesó vuelve a procesarse,
+    pero la detección de cambios de la ingesta lo convierte en un no-op.
+    """
+    traductor, _ = PROCESADORES[tipo]
+    WebhookInbox.objects.bulk_create([
+        WebhookInbox(
+            tipo=tipo,
+            clave_idempotencia=clave_idempotencia(data, cabecera),
+            location_id=traductor(data)[0] or "",
+            payload=data
+        )
+    ], ignore_conflicts=True)
+
+
+# --- 2. CONSUMO (lo que hace run_inbox_consumer) ---
+
+def _reintentar_o_fallar(entradas, error, ahora):
+    for entrada in entradas:
+        entrada.intentos += 1
+        entrada.ultimo_error = str(error)
+        if entrada.intentos >= MAX_INTENTOS:
+            entrada.estado = WebhookInbox.Estado.FALLIDO
+            entrada.procesado_en = ahora
+        else:
+            espera = min(BACKOFF_BASE_SEGUNDOS * 2 ** (entrada.intentos - 1), BACKOFF_MAX_SEGUNDOS)
+            entrada.procesar_despues = ahora + timedelta(seconds=espera * random.uniform(0.8, 1.2))
+    WebhookInbox.objects.bulk_update(
+        entradas, ['intentos', 'ultimo_error', 'estado', 'procesado_en', 'procesar_despues']
+    )
+
+def procesar_bandeja(limite=500):
+    """
+    Reclama hasta 'limite' entradas pendientes (SELECT ... FOR UPDATE SKIP LOCKED,
+    así varios consumidores nunca cogen la misma) y las procesa agrupadas por tipo
+    y agencia con la misma ingesta que los webhooks por lotes.
+    Devuelve el nº de entradas reclamadas.
+    """
+    ahora = timezone.now()
+    with transaction.atomic():
+        entradas = list(
+            WebhookInbox.objects
+            .select_for_update(skip_locked=True)
+            .filter(estado=WebhookInbox.Estado.PENDIENTE, procesar_despues__lte=ahora)
+            .order_by('id')[:limite]
+        )
+
+        # Por orden de llegada: si un registro se repite en el lote, gana el último
+        grupos = {}
+        for entrada in entradas:
+            grupos.setdefault((entrada.tipo, entrada.location_id), []).append(entrada)
+
+        for (tipo, location_id), grupo in grupos.items():
+            traductor, ingerir = PROCESADORES[tipo]
+            try:
+                # Savepoint por grupo: un fallo no deshace lo ya procesado de otras agencias
+                with transaction.atomic():
+                    resultado = procesar_lote(
+                        [entrada.payload for entrada in grupo], traductor, ingerir,
+                        fechas=[entrada.recibido_en for entrada in grupo]
+                    )
+            except Exception as e:
+                logger.exception(f"❌ Error procesando {len(grupo)} webhooks de {tipo} de {location_id}")
+                _reintentar_o_fallar(grupo, e, ahora)
+                continue
+
+            # Registros inválidos o agencia desconocida: reintentar no sirve de nada
+            errores = {error['indice']: error['error'] for error in resultado['errores'] if 'indice' in error}
+            error_agencia = next((error['error'] for error in resultado['errores'] if 'location_id' in error), None)
+            for indice, entrada in enumerate(grupo):
+                error = errores.get(indice) or error_agencia
+                entrada.intentos += 1
+                entrada.estado = WebhookInbox.Estado.FALLIDO if error else WebhookInbox.Estado.PROCESADO
+                entrada.ultimo_error = error or ""
+                entrada.procesado_en = ahora
+            WebhookInbox.objects.bulk_update(grupo, ['intentos', 'estado', 'ultimo_error', 'procesado_en'])
+
+    if entradas:
+        logger.info(f"📨 Bandeja: {len(entradas)} webhooks procesados en {len(grupos)} lotes")
+    return len(entradas)
+
+def purgar_bandeja(horas):
+    """
+    Borra las entradas procesadas hace más de 'horas'. Las fallidas se conservan para revisarlas.
+    """
+    limite = timezone.now() - timedelta(hours=horas)
+    borradas, _ = WebhookInbox.objects.filter(
+        estado=WebhookInbox.Estado.PROCESADO, procesado_en__lt=limite
+    ).delete()
+    return borradas
@@ -0,0 +1,298 @@
+import logging
+import threading
+import time
+from decimal import Decimal
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+from .models import Propiedad, Cliente
+from .zonas import meta_arbol_zonas
+
+try:
+    import numpy as np
+except ImportError:  # numpy es opcional: sin él siempre se usa el matching SQL
+    np = None
+
+logger = logging.getLogger(__name__)
+
+# Índice de matching en memoria: los compradores de cada agencia grande se guardan
+# en arrays columnares y emparejar una propiedad es una sola operación de máscaras.
+#
+# Sincronización entre procesos: cada agencia tiene en caché un contador de versión.
+# Cada cambio de un cliente lo sube y deja el pk del cliente en la clave de esa
+# versión; un proceso con una versión antigua solo recarga esos clientes. Si falta
+# alguna clave, hay una invalidación total o cambió el árbol de zonas, se reconstruye.
+
+AmbitoInteresThrough = Cliente.ambitos_interes.through
+
+PREFERENCIAS = ['animales', 'balcon', 'garaje', 'patioInterior']
+CAMPOS_CLIENTE = ['pk', 'presupuesto_maximo', 'habitaciones_minimas', 'metrosMinimo'] + PREFERENCIAS
+
+# Valor de cambio que obliga a reconstruir el índice entero
+CAMBIO_TOTAL = "*"
+# Con más cambios pendientes que esto sale más barato reconstruir
+MAX_CAMBIOS_INCREMENTALES = 500
+
+
+def disponible():
+    # Las versiones y los cambios viajan por la caché: con una por proceso, los demás
+    # procesos emparejarían contra un índice viejo y guardarían matches erróneos
+    return np is not None and settings.GHL_MATCH_INDEX_MIN_CLIENTES > 0 and settings.CACHE_COMPARTIDA
+
+def _centimos(valor):
+    return int(Decimal(str(valor or 0)).quantize(Decimal("0.01")) * 100)
+
+def _ampliar(array, capacidad):
+    nuevo = np.zeros((capacidad,) + array.shape[1:], dtype=array.dtype)
+    nuevo[:len(array)] = array
+    return nuevo
+
+
+# --- 1. ÍNDICE DE UNA AGENCIA ---
+
+class IndiceAgencia:
+    """
+    Compradores de una agencia en arrays columnares (una fila por cliente).
+    Las zonas de interés (los ámbitos ya expandidos con la tabla de cierre) van en
+    una máscara de bits de 64 zonas por columna.
+    """
+
+    def __init__(self, filas, zonas_por_cliente):
+        capacidad = max(len(filas), 16)
+        self.n = 0
+        self.fila = {}       # pk del cliente -> fila
+        self.bit_zona = {}   # zona_id -> posición del bit
+        self.pk = np.zeros(capacidad, dtype=np.int64)
+        self.vivo = np.zeros(capacidad, dtype=bool)
+        self.presupuesto = np.zeros(capacidad, dtype=np.int64)  # en céntimos, comparación exacta
+        self.habitaciones = np.zeros(capacidad, dtype=np.int64)
+        self.metros = np.zeros(capacidad, dtype=np.int64)
+        self.quiere = {campo: np.zeros(capacidad, dtype=bool) for campo in PREFERENCIAS}
+        self.zonas = np.zeros((capacidad, 1), dtype=np.uint64)
+        for valores in filas:
+            self.escribir(valores, zonas_por_cliente.get(valores['pk'], ()))
+
+    def _crecer(self):
+        capacidad = len(self.pk) * 2
+        for nombre in ('pk', 'vivo', 'presupuesto', 'habitaciones', 'metros', 'zonas'):
+            setattr(self, nombre, _ampliar(getattr(self, nombre), capacidad))
+        self.quiere = {campo: _ampliar(array, capacidad) for campo, array in self.quiere.items()}
+
+    def _bit(self, zona_id):
+        posicion = self.bit_zona.get(zona_id)
+        if posicion is None:
+            posicion = self.bit_zona[zona_id] = len(self.bit_zona)
+            if posicion // 64 >= self.zonas.shape[1]:
+                self.zonas = np.hstack([self.zonas, np.zeros((len(self.zonas), 1), dtype=np.uint64)])
+        return divmod(posicion, 64)
+
+    def escribir(self, valores, zonas_ids):
+        """
+        Inserta o sobrescribe la fila del cliente con los valores de CAMPOS_CLIENTE.
+        """
+        i = self.fila.get(valores['pk'])
+        if i is None:
+            if self.n == len(self.pk):
+                self._crecer()
+            i = self.fila[valores['pk']] = self.n
+            self.n += 1
+        self.pk[i] = valores['pk']
+        self.vivo[i] = True
+        self.presupuesto[i] = _centimos(valores['presupuesto_maximo'])
+        self.habitaciones[i] = valores['habitaciones_minimas'] or 0
+        self.metros[i] = valores['metrosMinimo'] or 0
+        for campo in PREFERENCIAS:
+            self.quiere[campo][i] = valores[campo] == Cliente.Preferencias2.SI
+        self.zonas[i] = 0
+        for zona_id in zonas_ids:
+            columna, bit = self._bit(zona_id)
+            self.zonas[i, columna] |= np.uint64(1) << np.uint64(bit)
+
+    def quitar(self, cliente_id):
+        i = self.fila.get(cliente_id)
+        if i is not None:
+            self.vivo[i] = False
+
+    def clientes_para_propiedad(self, propiedad):
+        """
+        Pks de los clientes que encajan con la propiedad (mismas reglas que matching.clientes_para_propiedad).
+        """
+        n = self.n
+        mascara = self.vivo[:n] & (self.presupuesto[:n] >= _centimos(propiedad.precio))
+        mascara &= self.habitaciones[:n] <= (propiedad.habitaciones or 0)
+        mascara &= self.metros[:n] <= (propiedad.metros or 0)
+        for campo in PREFERENCIAS:
+            if getattr(propiedad, campo) != Propiedad.Preferencias1.SI:
+                mascara &= ~self.quiere[campo][:n]
+
+        # Igual que el SQL: sin zona (o con una que nadie cubre) no hay clientes
+        if propiedad.zona_id in self.bit_zona:
+            columna, bit = self._bit(propiedad.zona_id)
+            mascara &= ((self.zonas[:n, columna] >> np.uint64(bit)) & np.uint64(1)).astype(bool)
+        else:
+            return []
+        return self.pk[:n][mascara].tolist()
+
+
+def _cargar_clientes(agencia_id, clientes_ids=None):
+    """
+    (filas, {cliente_id: [zona_ids]}) de la agencia, o solo de esos clientes. Dos consultas.
+    Los ámbitos se expanden a zonas con la tabla de cierre en la misma consulta.
+    """
+    clientes = Cliente.objects.filter(agencia_id=agencia_id)
+    zonas = AmbitoInteresThrough.objects.filter(cliente__agencia_id=agencia_id)
+    if clientes_ids is not None:
+        clientes = clientes.filter(pk__in=clientes_ids)
+        zonas = zonas.filter(cliente_id__in=clientes_ids)
+
+    zonas_por_cliente = {}
+    for cliente_id, zona_id in zonas.values_list('cliente_id', 'ambitogeografico__cierre__zona_id'):
+        # zona_id es None si el ámbito aún no cubre ninguna zona (provincia vacía)
+        if zona_id is not None:
+            zonas_por_cliente.setdefault(cliente_id, []).append(zona_id)
+    return list(clientes.values(*CAMPOS_CLIENTE)), zonas_por_cliente
+
+
+# --- 2. VERSIONES Y CAMBIOS (COMPARTIDOS ENTRE PROCESOS) ---
+
+def _clave_version(agencia_id):
+    return f"indice_match:v:{agencia_id}"
+
+def _clave_cambio(agencia_id, version):
+    return f"indice_match:cambio:{agencia_id}:{version}"
+
+def version_indice(agencia_id):
+    clave = _clave_version(agencia_id)
+    version = cache.get(clave)
+    if version is None:
+        # Arranca en un timestamp en ms: si la clave se pierde, la nueva versión nunca coincide con una vieja
+        cache.add(clave, int(time.time() * 1000), None)
+        version = cache.get(clave) or int(time.time() * 1000)
+    return version
+
+def registrar_cambios(agencia_id, clientes_ids):
+    """
+    Anota que esos clientes cambiaron: los índices de todos los procesos los recargarán.
+    """
+    clientes_ids = list(clientes_ids)
+    if not disponible() or not clientes_ids:
+        return
+    _registrar(agencia_id, clientes_ids)
+    if connection.in_atomic_block:
+        # Otro proceso podría recargar esos clientes antes del commit y quedarse
+        # con los datos viejos: se vuelven a anotar al confirmar la transacción
+        transaction.on_commit(lambda: _registrar(agencia_id, clientes_ids))
+
+def _registrar(agencia_id, clientes_ids):
+    version_indice(agencia_id)
+    try:
+        # incr es atómico: cada cambio tiene su propia versión aunque haya varios procesos
+        version = cache.incr(_clave_version(agencia_id), len(clientes_ids))
+    except ValueError:
+        # La clave desapareció entre medias: la versión nueva ya obliga a reconstruir
+        return
+    primera = version - len(clientes_ids) + 1
+    cache.set_many(
+        {_clave_cambio(agencia_id, primera + i): pk for i, pk in enumerate(clientes_ids)},
+        settings.GHL_MATCH_INDEX_TTL
+    )
+
+def invalidar_indice(agencia_id):
+    """
+    Obliga a reconstruir el índice de la agencia en todos los procesos.
+    """
+    registrar_cambios(agencia_id, [CAMBIO_TOTAL])
+
+
+# --- 3. ÍNDICES DEL PROCESO ---
+# agencia_id -> {"version", "zonas", "construido_en", "indice"}; indice=None si la agencia
+# es demasiado pequeña para que compense (se vuelve a mirar al caducar).
+
+_indices = {}
+_indices_locks = {}
+_indices_locks_lock = threading.Lock()
+
+def _lock_agencia(agencia_id):
+    with _indices_locks_lock:
+        return _indices_locks.setdefault(agencia_id, threading.Lock())
+
+def _construir(agencia_id, version, version_zonas):
+    t0 = time.perf_counter()
+    filas, zonas_por_cliente = _cargar_clientes(agencia_id)
+    indice = None
+    if len(filas) >= settings.GHL_MATCH_INDEX_MIN_CLIENTES:
+        indice = IndiceAgencia(filas, zonas_por_cliente)
+        logger.info(f"🧮 Índice de matching de {agencia_id}: {len(filas)} clientes ({time.perf_counter() - t0:.2f}s)")
+    _indices[agencia_id] = {
+        "version": version, "zonas": version_zonas, "construido_en": time.monotonic(), "indice": indice
+    }
+
+def _aplicar_cambios(agencia_id, entrada, version):
+    """
+    Lleva el índice a 'version' recargando solo los clientes cambiados. False si no se puede.
+    """
+    pendientes = version - entrada["version"]
+    if entrada["indice"] is None or pendientes < 0 or pendientes > MAX_CAMBIOS_INCREMENTALES:
+        return False
+    claves = [_clave_cambio(agencia_id, v) for v in range(entrada["version"] + 1, version + 1)]
+    cambios = cache.get_many(claves)
+    if len(cambios) != len(claves) or CAMBIO_TOTAL in cambios.values():
+        return False
+
+    clientes_ids = set(cambios.values())
+    filas, zonas_por_cliente = _cargar_clientes(agencia_id, clientes_ids)
+    for valores in filas:
+        entrada["indice"].escribir(valores, zonas_por_cliente.get(valores['pk'], ()))
+    # Los que ya no están en la base de datos se han borrado
+    for cliente_id in clientes_ids - {valores['pk'] for valores in filas}:
+        entrada["indice"].quitar(cliente_id)
+    entrada["version"] = version
+    return True
+
+def _indice_vigente(agencia_id):
+    version = version_indice(agencia_id)
+    version_zonas, _ = meta_arbol_zonas()
+    entrada = _indices.get(agencia_id)
+    if entrada is None or entrada["zonas"] != version_zonas \
+            or time.monotonic() - entrada["construido_en"] > settings.GHL_MATCH_INDEX_TTL:
+        _construir(agencia_id, version, version_zonas)
+    elif entrada["version"] != version and entrada["indice"] is not None:
+        if not _aplicar_cambios(agencia_id, entrada, version):
+            _construir(agencia_id, version, version_zonas)
+    return _indices[agencia_id]["indice"]
+
+def clientes_match_ids(propiedad):
+    """
+    Pks de los clientes que encajan con la propiedad según el índice en memoria,
+    o None si el índice no aplica (sin numpy, desactivado o agencia pequeña):
+    en ese caso hay que usar el SQL.
+    """
+    if not disponible():
+        return None
+    with _lock_agencia(propiedad.agencia_id):
+        indice = _indice_vigente(propiedad.agencia_id)
+        if indice is None:
+            return None
+        return indice.clientes_para_propiedad(propiedad)
+
+
+# --- 4. VERIFICACIÓN CONTRA EL SQL ---
+
+def verificar_indice(agencia_id, propiedades=None):
+    """
+    Compara el índice con matching.clientes_para_propiedad (el oráculo) para las
+    propiedades activas de la agencia. Devuelve [(propiedad_pk, faltan, sobran)] con las discrepancias.
+    """
+    from .matching import clientes_para_propiedad
+
+    if propiedades is None:
+        propiedades = Propiedad.objects.filter(agencia_id=agencia_id, estado=Propiedad.estadoPiso.ACTIVO)
+    discrepancias = []
+    for propiedad in propiedades:
+        esperados = set(clientes_para_propiedad(propiedad).values_list('pk', flat=True))
+        obtenidos = clientes_match_ids(propiedad)
+        if obtenidos is None:
+            raise RuntimeError(f"El índice de matching no aplica a la agencia {agencia_id}")
+        if set(obtenidos) != esperados:
+            discrepancias.append((propiedad.pk, esperados - set(obtenidos), set(obtenidos) - esperados))
+    return discrepancias
@@ -0,0 +1,462 @@
+import hashlib
+import json
+import logging
+from datetime import datetime, timezone as dt_timezone
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from .models import Agencia, Propiedad, Cliente
+from .indice_match import registrar_cambios
+from .cache_publica import invalidar_propiedades_publicas
+from .matching import (
+    AmbitoInteresThrough, CAMPOS_MATCH_PROPIEDAD, CAMPOS_MATCH_CLIENTE, IGUAL, MIXTO,
+    valores_match, direccion_cambio_propiedad, direccion_cambio_cliente,
+    reemplazar_matches, interesados_por_propiedad
+)
+from .tasks import sync_associations_lote
+from .zonas import resolver_zona
+from .ambitos import resolver_ambitos
+
+logger = logging.getLogger(__name__)
+
+# Filas por INSERT en los upserts masivos
+LOTE = 500
+# Máximo de registros aceptados en una sola petición de lote
+MAX_REGISTROS_LOTE = 5000
+
+# Campos que el upsert sobrescribe (además de la zona, que se trata aparte)
+CAMPOS_PROPIEDAD = ['precio', 'habitaciones', 'estado', 'animales', 'metros', 'balcon', 'garaje', 'patioInterior', 'imagenesUrl']
+CAMPOS_CLIENTE = ['nombre', 'presupuesto_maximo', 'habitaciones_minimas', 'animales', 'metrosMinimo', 'balcon', 'garaje', 'patioInterior']
+
+
+# --- 1. TRADUCCIÓN DE LOS PAYLOADS DE GHL ---
+
+def clean_currency(value):
+    if not value: return 0.0
+    try: return float(str(value).replace('$', '').replace(',', '').strip())
+    except ValueError: return 0.0
+
+def clean_int(value):
+    if not value: return 0
+    try: return int(float(str(value)))
+    except ValueError: return 0
+
+def preferenciasTraductor1(value):
+    mapa = {
+        "si": Cliente.Preferencias1.SI,
+        "no": Cliente.Preferencias1.NO,
+    }
+    value = (value or "").lower()
+    return mapa.get(value, Cliente.Preferencias1.NO)
+
+def preferenciasTraductor2(value):
+    mapa = {
+        "si": Cliente.Preferencias2.SI,
+        "indiferente": Cliente.Preferencias2.IND
+    }
+    value = (value or "").lower()
+    return mapa.get(value, Cliente.Preferencias2.IND)
+
+def estadoPropTrad(value):
+    mapa = {
+        "vendido": Propiedad.estadoPiso.VENDIDO,
+        "a la venta": Propiedad.estadoPiso.ACTIVO,
+        "no es oficial": Propiedad.estadoPiso.NoOficial
+    }
+    value = str(value or "").replace("_"," ").lower()
+    return mapa.get(value, Propiedad.estadoPiso.NoOficial)
+
+def guardadorURL(value):
+    lista = []
+    if value and value != "null":
+        if isinstance(value, list):
+            lista = [data.get('url') for data in value if isinstance(data, dict) and data.get('url')]
+    return lista
+
+def datos_propiedad(data):
+    """
+    Payload del webhook de propiedad -> (location_id, ghl_record_id, campos, nombre_zona).
+    """
+    custom_data = data.get('customData', {})
+    location_data = data.get('location', {})
+    location_id = location_data.get('id') or custom_data.get('location_id')
+    ghl_record_id = custom_data.get('contact_id') or data.get('id')
+
+    campos = {
+        'precio': clean_currency(custom_data.get('precio') or data.get('precio')),
+        'habitaciones': clean_int(custom_data.get('habitaciones') or data.get('habitaciones')),
+        'estado': estadoPropTrad(custom_data.get("estado")),
+        'animales': preferenciasTraductor1(custom_data.get('animales')),
+        'metros': clean_int(custom_data.get('metros')),
+        'balcon': preferenciasTraductor1(custom_data.get('balcon')),
+        'garaje': preferenciasTraductor1(custom_data.get('garaje')),
+        'patioInterior': preferenciasTraductor1(custom_data.get('patioInterior')),
+        'imagenesUrl':guardadorURL(custom_data.get('imagenesUrl')),
+    }
+    return location_id, ghl_record_id, campos, custom_data.get("zona")
+
+def datos_cliente(data):
+    """
+    Payload del webhook de cliente -> (location_id, ghl_contact_id, campos, zonas_interes).
+    'zonas_interes' son nombres de zona, municipio o provincia (ver ambitos.resolver_ambitos).
+    """
+    custom_data = data.get('customData', {})
+    location_data = data.get('location', {})
+    location_id = location_data.get('id') or custom_data.get('location_id')
+    ghl_contact_id = data.get('id') or custom_data.get('contact_id')
+
+    campos = {
+        # nombre es NOT NULL: sin full_name, un solo registro tumbaría todo el lote
+        'nombre': custom_data.get('full_name') or Cliente._meta.get_field('nombre').default,
+        'presupuesto_maximo': clean_currency(custom_data.get('presupuesto') or data.get('presupuesto')),
+        'habitaciones_minimas': clean_int(custom_data.get('habitaciones') or data.get('habitaciones_min')),
+        'animales': preferenciasTraductor1(custom_data.get('animales')),
+        'metrosMinimo': clean_int(custom_data.get('metros')),
+        'balcon': preferenciasTraductor2(custom_data.get('balcon')),
+        'garaje': preferenciasTraductor2(custom_data.get('garaje')),
+        'patioInterior': preferenciasTraductor2(custom_data.get('patioInterior')),
+    }
+    return location_id, ghl_contact_id, campos, custom_data.get("zona_interes")
+
+
+# --- 2. VERSIONADO DE ENTREGAS ---
+# GHL reenvía y desordena webhooks. Cada registro guarda la huella de los campos
+# aplicados y la fecha de esa versión: una entrega idéntica o más antigua que lo
+# guardado se descarta antes de cualquier matching o llamada a GHL.
+
+DUPLICADO = "duplicado"
+OBSOLETO = "obsoleto"
+
+CAMPOS_FECHA = ('dateUpdated', 'date_updated', 'updatedAt')
+# Lo que hay que leer de lo guardado para decidir
+CAMPOS_VERSION = ['pk', 'payload_hash', 'ghl_updated_at']
+
+def _parsear_fecha(valor):
+    if isinstance(valor, (int, float)) and not isinstance(valor, bool):
+        # Epoch en milisegundos (lo habitual en GHL) o en segundos
+        return datetime.fromtimestamp(valor / 1000 if valor > 1e11 else valor, tz=dt_timezone.utc)
+    if isinstance(valor, str) and valor.strip():
+        try:
+            fecha = parse_datetime(valor.strip())
+        except ValueError:
+            return None
+        if fecha and timezone.is_naive(fecha):
+            fecha = timezone.make_aware(fecha, dt_timezone.utc)
+        return fecha
+    return None
+
+def fecha_payload(data, por_defecto=None):
+    """
+    Fecha de la versión que trae el payload: dateUpdated de GHL si viene y, si no,
+    'por_defecto' (la fecha de entrega; ahora si no se indica).
+    """
+    custom_data = data.get('customData', {}) or {}
+    for origen in (data, custom_data):
+        for campo in CAMPOS_FECHA:
+            fecha = _parsear_fecha(origen.get(campo))
+            if fecha:
+                return fecha
+    return por_defecto or timezone.now()
+
+def huella_payload(campos, zona):
+    """
+    sha256 de los campos traducidos (no del payload crudo, que cambia en cada envío).
+    """
+    contenido = json.dumps([campos, zona], sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(contenido.encode()).hexdigest()
+
+def motivo_descarte(antes, huella, fecha):
+    """
+    OBSOLETO si lo guardado es de una versión posterior, DUPLICADO si ya tiene
+    exactamente estos campos, o None si la entrega hay que aplicarla.
+    'antes' son los valores guardados (con CAMPOS_VERSION) o None si es nuevo.
+    """
+    if antes is None:
+        return None
+    if antes['ghl_updated_at'] and fecha < antes['ghl_updated_at']:
+        return OBSOLETO
+    if antes['payload_hash'] == huella:
+        return DUPLICADO
+    return None
+
+def _adelanta_version(antes, fecha):
+    # Un duplicado más reciente adelanta la fecha guardada: así una versión
+    # intermedia que llegue tarde se reconoce como obsoleta
+    return antes['ghl_updated_at'] is None or fecha > antes['ghl_updated_at']
+
+def comprobar_entrega(modelo, antes, huella, fecha):
+    """
+    Versión para un solo registro: devuelve el motivo de descarte (o None) y,
+    si es un duplicado más reciente, adelanta la fecha guardada.
+    """
+    motivo = motivo_descarte(antes, huella, fecha)
+    if motivo == DUPLICADO and _adelanta_version(antes, fecha):
+        modelo.objects.filter(pk=antes['pk']).update(ghl_updated_at=fecha)
+    return motivo
+
+def upsert_versionado(modelo, agencia, record_id, campos, huella, fecha, campos_antes=()):
+    """
+    Upsert de un solo registro con su versión. Lo guardado se lee con la fila bloqueada
+    (select_for_update) en la misma transacción que la escritura: dos entregas a la vez
+    se aplican una detrás de otra y la más antigua se descarta. Si el registro es nuevo
+    y otra entrega lo crea a la vez, se vuelve a leer ya creado.
+    Devuelve (antes, objeto, motivo); si la entrega se descarta, objeto es None.
+    """
+    for _ in range(3):
+        try:
+            with transaction.atomic():
+                antes = (
+                    modelo.objects
+                    .select_for_update()
+                    .filter(agencia=agencia, ghl_contact_id=record_id)
+                    .values(*CAMPOS_VERSION, *campos_antes)
+                    .first()
+                )
+                motivo = comprobar_entrega(modelo, antes, huella, fecha)
+                if motivo:
+                    return antes, None, motivo
+
+                campos = dict(campos, payload_hash=huella, ghl_updated_at=fecha)
+                if antes:
+                    objeto, _ = modelo.objects.update_or_create(agencia=agencia, ghl_contact_id=record_id, defaults=campos)
+                else:
+                    objeto = modelo.objects.create(agencia=agencia, ghl_contact_id=record_id, **campos)
+                return antes, objeto, None
+        except IntegrityError:
+            continue
+    raise RuntimeError(f"No se pudo guardar {modelo.__name__} {record_id}")
+
+def _filtrar_entregas(modelo, registros, antes):
+    """
+    Separa las entregas a aplicar de las descartadas en un lote.
+    Devuelve ({id: (campos, zona, fecha, huella)}, nº de descartadas).
+    """
+    aplicables, adelantar = {}, []
+    for record_id, (campos, zona, fecha) in registros.items():
+        huella = huella_payload(campos, zona)
+        previo = antes.get(record_id)
+        motivo = motivo_descarte(previo, huella, fecha)
+        if motivo is None:
+            aplicables[record_id] = (campos, zona, fecha, huella)
+        elif motivo == DUPLICADO and _adelanta_version(previo, fecha):
+            adelantar.append(modelo(pk=previo['pk'], ghl_updated_at=fecha))
+    if adelantar:
+        modelo.objects.bulk_update(adelantar, ['ghl_updated_at'], batch_size=LOTE)
+    return aplicables, len(registros) - len(aplicables)
+
+
+# --- 3. INGESTA POR LOTES ---
+# Un upsert masivo por agencia, el matching de todo el lote en una sola join
+# (reemplazar_matches) y una única sincronización encolada por propiedad afectada.
+# Como en upsert_versionado(), las filas existentes se leen bloqueadas y las nuevas
+# se insertan sin "upsert": si otra entrega las crea a la vez, el lote se repite.
+
+def _con_reintentos(ingerir, agencia, registros):
+    for _ in range(3):
+        try:
+            return ingerir(agencia, registros)
+        except IntegrityError:
+            continue
+    raise RuntimeError(f"No se pudo ingerir el lote de {len(registros)} registros de {agencia.location_id}")
+
+def _upsert_lote(modelo, objetos, antes, update_fields):
+    modelo.objects.bulk_create([o for o in objetos if o.ghl_contact_id not in antes], batch_size=LOTE)
+    modelo.objects.bulk_create(
+        [o for o in objetos if o.ghl_contact_id in antes],
+        batch_size=LOTE,
+        update_conflicts=True,
+        unique_fields=['agencia', 'ghl_contact_id'],
+        update_fields=update_fields
+    )
+
+def _encolar_syncs(agencia, cambios, completas=()):
+    """
+    Una sincronización por propiedad: conjunto completo para las de 'completas'
+    y delta (add/remove) para el resto de las que tengan cambios. Todas se
+    encolan juntas. Devuelve el nº de sincronizaciones encoladas.
+    """
+    completas = set(completas)
+    afectadas = completas | set(cambios)
+    if not afectadas:
+        return 0
+    if not agencia.association_type_id:
+        logger.warning(f"⚠️ Agencia {agencia.location_id} no tiene 'association_type_id'. Cruzado saltado.")
+        return 0
+
+    # Tres consultas en total para traducir pks a ids de GHL
+    props_ghl = dict(Propiedad.objects.filter(pk__in=afectadas).values_list('pk', 'ghl_contact_id'))
+    clientes_ids = set()
+    for añadidos, quitados in cambios.values():
+        clientes_ids |= añadidos | quitados
+    clientes_ghl = dict(Cliente.objects.filter(pk__in=clientes_ids).values_list('pk', 'ghl_contact_id'))
+    objetivos = interesados_por_propiedad(list(completas)) if completas else {}
+
+    syncs = []
+    for prop_pk in afectadas:
+        if prop_pk in completas:
+            syncs.append({'origin_record_id': props_ghl[prop_pk], 'target_ids_list': objetivos[prop_pk]})
+        else:
+            añadidos, quitados = cambios[prop_pk]
+            syncs.append({
+                'origin_record_id': props_ghl[prop_pk],
+                'add_ids': [clientes_ghl[pk] for pk in añadidos],
+                'remove_ids': [clientes_ghl[pk] for pk in quitados],
+            })
+    return sync_associations_lote(agencia.location_id, agencia.association_type_id, syncs)
+
+def ingerir_propiedades(agencia, registros):
+    """
+    Upsert masivo de propiedades de una agencia. 'registros' es {ghl_record_id: (campos, nombre_zona, fecha)}.
+    Devuelve un resumen con los recuentos.
+    """
+    return _con_reintentos(_ingerir_propiedades, agencia, registros)
+
+def _ingerir_propiedades(agencia, registros):
+    with transaction.atomic():
+        antes = {
+            valores.pop('ghl_contact_id'): valores
+            for valores in Propiedad.objects.select_for_update().filter(agencia=agencia, ghl_contact_id__in=list(registros)).values('ghl_contact_id', *CAMPOS_VERSION, *CAMPOS_MATCH_PROPIEDAD)
+        }
+        recibidas = len(registros)
+        registros, descartadas = _filtrar_entregas(Propiedad, registros, antes)
+        ids = list(registros)
+
+        objetos = []
+        for ghl_record_id, (campos, nombre_zona, fecha, huella) in registros.items():
+            zona_id = resolver_zona(nombre_zona) if nombre_zona else None
+            if zona_id is None and ghl_record_id in antes:
+                # Igual que el webhook individual: sin zona válida se conserva la que tenía
+                zona_id = antes[ghl_record_id]['zona_id']
+            objetos.append(Propiedad(
+                agencia=agencia, ghl_contact_id=ghl_record_id, zona_id=zona_id,
+                payload_hash=huella, ghl_updated_at=fecha, **campos
+            ))
+
+        _upsert_lote(Propiedad, objetos, antes, CAMPOS_PROPIEDAD + ['zona', 'payload_hash', 'ghl_updated_at'])
+        invalidar_propiedades_publicas(agencia.location_id, ids)
+        # Con update_conflicts, bulk_create no rellena los pk: se releen en una consulta
+        pks = dict(Propiedad.objects.filter(agencia=agencia, ghl_contact_id__in=ids).values_list('ghl_contact_id', 'pk'))
+
+        # Mismas reglas que el webhook individual: solo las activas con cambios relevantes
+        direcciones = {}
+        for propiedad in objetos:
+            if propiedad.estado != Propiedad.estadoPiso.ACTIVO:
+                continue
+            direccion = direccion_cambio_propiedad(
+                antes.get(propiedad.ghl_contact_id), valores_match(propiedad, CAMPOS_MATCH_PROPIEDAD)
+            )
+            if direccion != IGUAL:
+                direcciones[pks[propiedad.ghl_contact_id]] = direccion
+
+        cambios = reemplazar_matches(agencia.pk, propiedades_ids=list(direcciones)) if direcciones else {}
+        syncs = _encolar_syncs(agencia, cambios, completas=[pk for pk, d in direcciones.items() if d == MIXTO])
+
+    actualizadas = len([record_id for record_id in ids if record_id in antes])
+    return {
+        'recibidas': recibidas,
+        'descartadas': descartadas,
+        'creadas': len(ids) - actualizadas,
+        'actualizadas': actualizadas,
+        'rematcheadas': len(direcciones),
+        'syncs_encolados': syncs,
+    }
+
+def ingerir_clientes(agencia, registros):
+    """
+    Upsert masivo de clientes de una agencia. 'registros' es {ghl_contact_id: (campos, zonas_interes, fecha)}.
+    Devuelve un resumen con los recuentos.
+    """
+    return _con_reintentos(_ingerir_clientes, agencia, registros)
+
+def _ingerir_clientes(agencia, registros):
+    with transaction.atomic():
+        antes = {
+            valores.pop('ghl_contact_id'): valores
+            for valores in Cliente.objects.select_for_update().filter(agencia=agencia, ghl_contact_id__in=list(registros)).values('ghl_contact_id', *CAMPOS_VERSION, *CAMPOS_MATCH_CLIENTE)
+        }
+        recibidos = len(registros)
+        registros, descartados = _filtrar_entregas(Cliente, registros, antes)
+        ids = list(registros)
+
+        ambitos_antes = {}
+        filas = AmbitoInteresThrough.objects.filter(cliente_id__in=[antes[i]['pk'] for i in ids if i in antes]).values_list('cliente_id', 'ambitogeografico_id')
+        for cliente_id, ambito_id in filas:
+            ambitos_antes.setdefault(cliente_id, set()).add(ambito_id)
+
+        objetos = [
+            Cliente(agencia=agencia, ghl_contact_id=ghl_contact_id, payload_hash=huella, ghl_updated_at=fecha, **campos)
+            for ghl_contact_id, (campos, _, fecha, huella) in registros.items()
+        ]
+        _upsert_lote(Cliente, objetos, antes, CAMPOS_CLIENTE + ['payload_hash', 'ghl_updated_at'])
+        pks = dict(Cliente.objects.filter(agencia=agencia, ghl_contact_id__in=ids).values_list('ghl_contact_id', 'pk'))
+
+        direcciones, ambitos_nuevos = {}, {}
+        for cliente in objetos:
+            pk = pks[cliente.ghl_contact_id]
+            previo = antes.get(cliente.ghl_contact_id)
+            previos = ambitos_antes.get(previo['pk'], set()) if previo else set()
+            zona_nombre = registros[cliente.ghl_contact_id][1]
+            nuevos = set(resolver_ambitos(str(zona_nombre).split(","))) if zona_nombre else previos
+            if nuevos != previos:
+                ambitos_nuevos[pk] = nuevos
+            direccion = direccion_cambio_cliente(previo, valores_match(cliente, CAMPOS_MATCH_CLIENTE), previos, nuevos)
+            if direccion != IGUAL:
+                direcciones[pk] = direccion
+
+        if ambitos_nuevos:
+            AmbitoInteresThrough.objects.filter(cliente_id__in=ambitos_nuevos.keys()).delete()
+            AmbitoInteresThrough.objects.bulk_create(
+                [AmbitoInteresThrough(cliente_id=pk, ambitogeografico_id=ambito_id) for pk, ambitos in ambitos_nuevos.items() for ambito_id in ambitos],
+                batch_size=LOTE
+            )
+
+        # bulk_create y los cambios directos en la tabla intermedia no lanzan señales
+        registrar_cambios(agencia.pk, direcciones.keys())
+        cambios = reemplazar_matches(agencia.pk, clientes_ids=list(direcciones)) if direcciones else {}
+        syncs = _encolar_syncs(agencia, cambios)
+
+    actualizados = len([ghl_contact_id for ghl_contact_id in ids if ghl_contact_id in antes])
+    return {
+        'recibidos': recibidos,
+        'descartados': descartados,
+        'creados': len(ids) - actualizados,
+        'actualizados': actualizados,
+        'rematcheados': len(direcciones),
+        'syncs_encolados': syncs,
+    }
+
+def procesar_lote(registros, traductor, ingerir, fechas=None):
+    """
+    Traduce una lista de payloads con 'traductor' (datos_propiedad / datos_cliente),
+    los agrupa por agencia y llama a 'ingerir' una vez por agencia. Si un id se
+    repite gana la versión más reciente (a igualdad, la última). 'fechas' son las
+    fechas de entrega de cada payload, para los que no traen dateUpdated.
+    Los registros inválidos se devuelven en 'errores'.
+    """
+    ahora = timezone.now()
+    por_agencia, errores = {}, []
+    for indice, data in enumerate(registros):
+        if not isinstance(data, dict):
+            errores.append({'indice': indice, 'error': 'Registro inválido'})
+            continue
+        location_id, record_id, campos, zona = traductor(data)
+        if not location_id:
+            errores.append({'indice': indice, 'error': 'Missing location_id'})
+        elif not record_id:
+            errores.append({'indice': indice, 'error': 'Missing Record ID'})
+        else:
+            fecha = fecha_payload(data, fechas[indice] if fechas else ahora)
+            previo = por_agencia.setdefault(location_id, {}).get(record_id)
+            if previo is None or fecha >= previo[2]:
+                por_agencia[location_id][record_id] = (campos, zona, fecha)
+
+    agencias = Agencia.objects.in_bulk(list(por_agencia))
+    resultados = {}
+    for location_id, registros_agencia in por_agencia.items():
+        if location_id not in agencias:
+            errores.append({'location_id': location_id, 'error': 'Agencia no encontrada'})
+            continue
+        resultados[location_id] = ingerir(agencias[location_id], registros_agencia)
+        logger.info(f"📦 Lote de {location_id}: {resultados[location_id]}")
+
+    return {'status': 'success' if not errores else 'partial', 'agencias': resultados, 'errores': errores}
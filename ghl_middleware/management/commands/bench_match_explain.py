@@ -0,0 +1,94 @@
+import logging
+import random
+import time
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from ghl_middleware.benchmark import generar_dataset, medir
+from ghl_middleware.matching import clientes_para_propiedad, propiedades_para_cliente
+from ghl_middleware.models import Propiedad, Cliente
+
+# Índices añadidos en las migraciones 0014 y 0019 para el matching
+INDICES_MATCHING = [
+    "prop_match_activo_idx",
+    "cliente_match_idx",
+    "cli_ambito_int_ambito_cli_idx",
+    "ambito_zona_zona_idx",
+    "cli_prop_int_prop_cli_idx",
+]
+
+TABLAS = [
+    "ghl_middleware_propiedad",
+    "ghl_middleware_cliente",
+    "ghl_middleware_cliente_ambitos_interes",
+    "ghl_middleware_ambitozona",
+    "ghl_middleware_cliente_propiedades_interes",
+]
+
+
+class Command(BaseCommand):
+    help = (
+        "Compara los planes (EXPLAIN) y tiempos de las queries de matching con y sin "
+        "los índices de matching. Todo se deshace al terminar."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--zonas', type=int, default=200)
+        parser.add_argument('--propiedades', type=int, default=100_000)
+        parser.add_argument('--clientes', type=int, default=100_000)
+        parser.add_argument('--muestras', type=int, default=50, help="Nº de propiedades y de clientes a emparejar")
+        parser.add_argument('--semilla', type=int, default=42)
+
+    def handle(self, *args, **o):
+        logging.disable(logging.INFO)
+        try:
+            with transaction.atomic():
+                self._ejecutar(o)
+                transaction.set_rollback(True)
+        finally:
+            logging.disable(logging.NOTSET)
+
+    def _analyze(self):
+        with connection.cursor() as cursor:
+            for tabla in TABLAS:
+                cursor.execute(f'ANALYZE "{tabla}"')
+
+    def _ejecutar(self, o):
+        t0 = time.perf_counter()
+        dataset = generar_dataset(1, o['zonas'], o['propiedades'], o['clientes'], o['semilla'])
+        self._analyze()
+        self.stdout.write(f"Dataset: {o['propiedades']} propiedades, {o['clientes']} clientes ({time.perf_counter() - t0:.1f}s)")
+
+        rnd = random.Random(o['semilla'])
+        loc = dataset["location_ids"][0]
+        ids_prop = list(Propiedad.objects.filter(agencia_id=loc, estado='activo').values_list('pk', flat=True))
+        ids_cli = list(Cliente.objects.filter(agencia_id=loc).values_list('pk', flat=True))
+        propiedades = list(Propiedad.objects.filter(pk__in=rnd.sample(ids_prop, min(o['muestras'], len(ids_prop)))))
+        clientes = list(Cliente.objects.filter(pk__in=rnd.sample(ids_cli, min(o['muestras'], len(ids_cli)))))
+
+        despues = self._medir(propiedades, clientes)
+
+        sid = transaction.savepoint()
+        with connection.cursor() as cursor:
+            for nombre in INDICES_MATCHING:
+                cursor.execute(f'DROP INDEX IF EXISTS "{nombre}"')
+        self._analyze()
+        antes = self._medir(propiedades, clientes)
+        transaction.savepoint_rollback(sid)
+
+        for titulo, resultado in (("SIN índices de matching", antes), ("CON índices de matching", despues)):
+            self.stdout.write(f"\n===== {titulo} =====")
+            for consulta, (plan, r) in resultado.items():
+                self.stdout.write(f"\n--- {consulta}: p50 {r['p50_ms']:.2f} ms | p95 {r['p95_ms']:.2f} ms | p99 {r['p99_ms']:.2f} ms")
+                self.stdout.write(plan)
+
+    def _medir(self, propiedades, clientes):
+        return {
+            "clientes_para_propiedad": (
+                clientes_para_propiedad(propiedades[0]).values_list('id', 'ghl_contact_id').explain(),
+                medir(lambda p: list(clientes_para_propiedad(p).values_list('id', 'ghl_contact_id')), propiedades),
+            ),
+            "propiedades_para_cliente": (
+                propiedades_para_cliente(clientes[0]).values_list('id', flat=True).explain(),
+                medir(lambda c: list(propiedades_para_cliente(c).values_list('id', flat=True)), clientes),
+            ),
+        }
@@ -0,0 +1,86 @@
+import logging
+import random
+import time
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.test.utils import override_settings
+from ghl_middleware import indice_match
+from ghl_middleware.benchmark import generar_dataset, medir
+from ghl_middleware.matching import clientes_para_propiedad
+from ghl_middleware.models import Propiedad, Cliente
+
+
+class Command(BaseCommand):
+    help = (
+        "Compara el índice de matching en memoria con el SQL: verifica que den los mismos "
+        "clientes para todas las propiedades (también tras cambios incrementales) y mide latencias. "
+        "Todo se deshace al terminar."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--zonas', type=int, default=200)
+        parser.add_argument('--propiedades', type=int, default=2000)
+        parser.add_argument('--clientes', type=int, default=50_000)
+        parser.add_argument('--muestras', type=int, default=200, help="Nº de propiedades a emparejar en la medición")
+        parser.add_argument('--cambios', type=int, default=100, help="Clientes a modificar para probar la actualización incremental")
+        parser.add_argument('--semilla', type=int, default=42)
+
+    def handle(self, *args, **o):
+        if indice_match.np is None:
+            raise CommandError("numpy no está instalado: el índice de matching no está disponible")
+
+        logging.disable(logging.INFO)
+        try:
+            # Se fuerza el índice para la agencia sintética sea cual sea su tamaño
+            # (un solo proceso: la caché local basta)
+            with override_settings(GHL_MATCH_INDEX_MIN_CLIENTES=1, CACHE_COMPARTIDA=True), transaction.atomic():
+                self._ejecutar(o)
+                transaction.set_rollback(True)
+        finally:
+            logging.disable(logging.NOTSET)
+
+    def _ejecutar(self, o):
+        t0 = time.perf_counter()
+        dataset = generar_dataset(1, o['zonas'], o['propiedades'], o['clientes'], o['semilla'])
+        loc = dataset["location_ids"][0]
+        self.stdout.write(f"Dataset: {o['propiedades']} propiedades, {o['clientes']} clientes ({time.perf_counter() - t0:.1f}s)")
+
+        t0 = time.perf_counter()
+        indice_match.invalidar_indice(loc)
+        propiedades = list(Propiedad.objects.filter(agencia_id=loc, estado=Propiedad.estadoPiso.ACTIVO))
+        indice_match.clientes_match_ids(propiedades[0])
+        self.stdout.write(f"Construcción del índice: {time.perf_counter() - t0:.2f}s")
+
+        self._verificar(loc, propiedades, "tras construir")
+
+        # Cambios incrementales por el ORM (como los webhooks): señales -> recarga solo de esos clientes
+        rnd = random.Random(o['semilla'])
+        # Ámbitos de cualquier nivel (zona, municipio y provincia) del árbol sintético
+        ambitos_ids = dataset["ambitos"]
+        clientes = list(Cliente.objects.filter(agencia_id=loc).order_by('?')[:o['cambios']])
+        for cliente in clientes[: len(clientes) // 2]:
+            cliente.presupuesto_maximo = rnd.randrange(80_000, 900_000, 5_000)
+            cliente.habitaciones_minimas = rnd.randint(0, 4)
+            cliente.save()
+            cliente.ambitos_interes.set(rnd.sample(ambitos_ids, rnd.randint(0, 4)))
+        for cliente in clientes[len(clientes) // 2:]:
+            cliente.delete()
+        self._verificar(loc, propiedades, f"tras {len(clientes)} cambios incrementales")
+
+        muestra = rnd.sample(propiedades, min(o['muestras'], len(propiedades)))
+        for titulo, r in (
+            ("SQL (clientes_para_propiedad)", medir(lambda p: list(clientes_para_propiedad(p).values_list('pk', flat=True)), muestra)),
+            ("Índice en memoria", medir(indice_match.clientes_match_ids, muestra)),
+        ):
+            self.stdout.write(
+                f"{titulo}: p50 {r['p50_ms']:.2f} ms | p95 {r['p95_ms']:.2f} ms | p99 {r['p99_ms']:.2f} ms | "
+                f"{r['queries_media']:.1f} queries/match"
+            )
+
+    def _verificar(self, loc, propiedades, momento):
+        discrepancias = indice_match.verificar_indice(loc, propiedades)
+        if discrepancias:
+            for prop_pk, faltan, sobran in discrepancias[:10]:
+                self.stderr.write(f"Propiedad {prop_pk}: faltan {sorted(faltan)[:10]} | sobran {sorted(sobran)[:10]}")
+            raise CommandError(f"El índice no coincide con el SQL en {len(discrepancias)} propiedades ({momento})")
+        self.stdout.write(f"✅ Índice == SQL en {len(propiedades)} propiedades ({momento})")
@@ -0,0 +1,74 @@
+import logging
+import random
+import time
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.test import Client
+from ghl_middleware.benchmark import generar_dataset, payload_propiedad, payload_cliente, ghl_simulado, medir
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark de WebhookPropiedadView y WebhookClienteView con datos sintéticos. "
+        "Todo se ejecuta dentro de una transacción que se deshace al final."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--agencias', type=int, default=1)
+        parser.add_argument('--zonas', type=int, default=50)
+        parser.add_argument('--propiedades', type=int, default=1000)
+        parser.add_argument('--clientes', type=int, default=1000)
+        parser.add_argument('--peticiones', type=int, default=200, help="Webhooks a reproducir de cada tipo")
+        parser.add_argument('--nuevos', type=float, default=0.2, help="Fracción de webhooks que crean registros nuevos")
+        parser.add_argument('--semilla', type=int, default=42)
+
+    def handle(self, *args, **o):
+        if not 0 <= o['nuevos'] <= 1:
+            raise CommandError("--nuevos debe estar entre 0 y 1")
+
+        # Los webhooks loguean el payload completo en INFO: eso no es lo que queremos medir
+        logging.disable(logging.INFO)
+        try:
+            with ghl_simulado(), transaction.atomic():
+                self._ejecutar(o)
+                transaction.set_rollback(True)
+        finally:
+            logging.disable(logging.NOTSET)
+
+    def _ejecutar(self, o):
+        t0 = time.perf_counter()
+        dataset = generar_dataset(o['agencias'], o['zonas'], o['propiedades'], o['clientes'], o['semilla'])
+        self.stdout.write(
+            f"Dataset: {o['agencias']} agencias, {o['zonas']} zonas, {o['propiedades']} propiedades, "
+            f"{o['clientes']} clientes ({time.perf_counter() - t0:.1f}s)"
+        )
+
+        rnd = random.Random(o['semilla'])
+        client = Client()
+
+        def indices(total):
+            # Mezcla de actualizaciones de registros existentes y altas nuevas
+            return [
+                total + i if rnd.random() < o['nuevos'] else rnd.randrange(total)
+                for i in range(o['peticiones'])
+            ]
+
+        escenarios = [
+            ("propiedad", "/webhooks/propiedad/", payload_propiedad, o['propiedades']),
+            ("cliente", "/webhooks/cliente/", payload_cliente, o['clientes']),
+        ]
+
+        self.stdout.write(f"{'webhook':<12}{'n':>6}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'queries':>10}{'q max':>8}{'req/s':>10}")
+        for nombre, url, generador, total in escenarios:
+            payloads = [generador(rnd, dataset, i) for i in indices(total)]
+
+            def enviar(payload):
+                response = client.post(url, payload, content_type="application/json")
+                if response.status_code >= 400:
+                    raise CommandError(f"{url} respondió {response.status_code}: {response.content[:200]}")
+
+            r = medir(enviar, payloads)
+            self.stdout.write(
+                f"{nombre:<12}{r['n']:>6}{r['p50_ms']:>10.1f}{r['p95_ms']:>10.1f}{r['p99_ms']:>10.1f}"
+                f"{r['queries_media']:>10.1f}{r['queries_max']:>8}{r['rps']:>10.1f}"
+            )
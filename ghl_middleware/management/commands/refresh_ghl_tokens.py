@@ -0,0 +1,73 @@
+import logging
+import signal
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from django.utils import timezone
+from ghl_middleware.models import GHLToken
+from ghl_middleware.utils import refrescar_token_si_caduca
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Refresca por adelantado los tokens de GHL que caducan pronto, para que los webhooks nunca tengan que hacerlo."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--horizon', type=int, default=3600, help="Refresca los tokens que caducan en menos de N segundos")
+        parser.add_argument('--concurrency', type=int, default=4, help="Nº máximo de refrescos en paralelo")
+        parser.add_argument('--loop', action='store_true', help="Modo demonio: repite el escaneo cada --interval segundos")
+        parser.add_argument('--interval', type=int, default=300, help="Segundos entre escaneos en modo --loop")
+
+    def handle(self, *args, **options):
+        self.parar = False
+        signal.signal(signal.SIGTERM, self._parar)
+        signal.signal(signal.SIGINT, self._parar)
+
+        while True:
+            self.escanear(options['horizon'], options['concurrency'])
+            if not options['loop']:
+                break
+            # Espera interrumpible para que SIGTERM no tenga que esperar al intervalo entero
+            fin = time.monotonic() + options['interval']
+            while not self.parar and time.monotonic() < fin:
+                time.sleep(1)
+            if self.parar:
+                break
+
+    def _parar(self, signum, frame):
+        self.parar = True
+
+    def escanear(self, horizonte, concurrencia):
+        limite = timezone.now() + timedelta(seconds=horizonte)
+        # La tabla tiene una fila por agencia: filtrar en Python es más simple que
+        # sumar intervalos en SQL de forma portable.
+        candidatos = [
+            t.location_id
+            for t in GHLToken.objects.only('location_id', 'updated_at', 'expires_in')
+            if t.updated_at + timedelta(seconds=t.expires_in) <= limite
+        ]
+        if not candidatos:
+            logger.info("✅ Ningún token de GHL caduca dentro del horizonte")
+            return
+
+        logger.info(f"🔄 Refrescando {len(candidatos)} tokens de GHL...")
+        with ThreadPoolExecutor(max_workers=concurrencia) as pool:
+            resultados = list(pool.map(lambda loc: self._refrescar(loc, horizonte), candidatos))
+
+        fallidos = [loc for loc, ok in zip(candidatos, resultados) if not ok]
+        logger.info(f"✅ Tokens refrescados: {len(candidatos) - len(fallidos)} | ❌ Fallidos: {len(fallidos)}")
+        for loc in fallidos:
+            logger.error(f"❌ No se pudo refrescar el token de {loc}")
+
+    def _refrescar(self, location_id, horizonte):
+        close_old_connections()
+        try:
+            return refrescar_token_si_caduca(location_id, horizonte) is not None
+        except Exception:
+            logger.exception(f"❌ Excepción refrescando el token de {location_id}")
+            return False
+        finally:
+            close_old_connections()
@@ -0,0 +1,66 @@
+import logging
+import time
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from ghl_middleware.matching import reemplazar_matches, MatchThrough, AmbitoInteresThrough
+from ghl_middleware.models import Agencia, Propiedad, Cliente, AmbitoZona
+from ghl_middleware.tasks import sync_associations_lote
+
+logger = logging.getLogger(__name__)
+
+# Tablas que intervienen en la join de matching
+TABLAS_MATCHING = [Propiedad, Cliente, AmbitoInteresThrough, AmbitoZona, MatchThrough]
+
+
+class Command(BaseCommand):
+    help = (
+        "Recalcula todos los matches propiedad×cliente de una agencia con una sola join, "
+        "reemplaza la tabla de matches en una transacción y encola los cambios para GHL."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('location_id', help="location_id de la agencia en GHL")
+        parser.add_argument('--no-sync', action='store_true', help="Solo recalcula en local, sin encolar nada hacia GHL")
+        parser.add_argument('--no-analyze', action='store_true', help="No actualiza las estadísticas del planificador antes de la join")
+
+    def handle(self, *args, **options):
+        location_id = options['location_id']
+        agencia = Agencia.objects.filter(location_id=location_id).first()
+        if not agencia:
+            raise CommandError(f"No existe ninguna agencia con location_id {location_id}")
+
+        inicio = time.perf_counter()
+        if not options['no_analyze']:
+            # Tras una importación las estadísticas están desfasadas y el planificador
+            # recorre clientes por presupuesto en vez de entrar por zona (10x más lento)
+            with connection.cursor() as cursor:
+                for modelo in TABLAS_MATCHING:
+                    cursor.execute(f"ANALYZE {connection.ops.quote_name(modelo._meta.db_table)}")
+        cambios = reemplazar_matches(agencia.pk)
+        duracion = time.perf_counter() - inicio
+
+        añadidos = sum(len(a) for a, _ in cambios.values())
+        quitados = sum(len(q) for _, q in cambios.values())
+        self.stdout.write(
+            f"🔁 {location_id}: +{añadidos} / -{quitados} matches en {len(cambios)} propiedades ({duracion:.2f}s)"
+        )
+
+        if options['no_sync'] or not cambios:
+            return
+        if not agencia.association_type_id:
+            logger.warning(f"⚠️ Agencia {location_id} no tiene 'association_type_id'. Sincronización con GHL saltada.")
+            return
+
+        # Dos consultas para traducir pks a ids de GHL, en vez de una por propiedad
+        props_ghl = dict(Propiedad.objects.filter(pk__in=cambios.keys()).values_list('pk', 'ghl_contact_id'))
+        clientes_ghl = dict(Cliente.objects.filter(agencia=agencia).values_list('pk', 'ghl_contact_id'))
+
+        sync_associations_lote(location_id, agencia.association_type_id, [
+            {
+                'origin_record_id': props_ghl[prop_pk],
+                'add_ids': [clientes_ghl[pk] for pk in añadidos_prop],
+                'remove_ids': [clientes_ghl[pk] for pk in quitados_prop],
+            }
+            for prop_pk, (añadidos_prop, quitados_prop) in cambios.items()
+        ])
+        self.stdout.write(f"📬 {len(cambios)} sincronizaciones encoladas para GHL")
@@ -0,0 +1,63 @@
+import logging
+import signal
+import time
+from concurrent.futures import ThreadPoolExecutor
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from ghl_middleware.cola import reclamar, completar, reintentar_o_fallar
+from ghl_middleware.tasks import HANDLERS, FUSIONES
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Worker que consume la cola de tareas GHL (TareaGHL) con concurrencia acotada."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=4, help="Nº máximo de tareas ejecutándose a la vez")
+        parser.add_argument('--poll', type=float, default=1.0, help="Segundos de espera cuando no hay tareas")
+        parser.add_argument('--lease', type=int, default=300, help="Segundos que una tarea queda reclamada antes de darla por perdida")
+        parser.add_argument('--once', action='store_true', help="Procesa lo que haya pendiente y termina")
+
+    def handle(self, *args, **options):
+        concurrency = options['concurrency']
+        self.parar = False
+        signal.signal(signal.SIGTERM, self._parar)
+        signal.signal(signal.SIGINT, self._parar)
+
+        logger.info(f"👷 Worker GHL arrancado (concurrencia={concurrency})")
+        en_curso = set()
+
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            while not self.parar:
+                en_curso = {f for f in en_curso if not f.done()}
+                libres = concurrency - len(en_curso)
+
+                tareas = reclamar(libres, options['lease']) if libres > 0 else []
+                for tarea in tareas:
+                    en_curso.add(pool.submit(self._ejecutar, tarea))
+
+                if not tareas:
+                    if options['once'] and not en_curso:
+                        break
+                    time.sleep(options['poll'])
+
+        logger.info("👋 Worker GHL detenido")
+
+    def _parar(self, signum, frame):
+        logger.info("🛑 Señal recibida, terminando las tareas en curso...")
+        self.parar = True
+
+    def _ejecutar(self, tarea):
+        close_old_connections()
+        try:
+            handler = HANDLERS.get(tarea.tipo)
+            if handler is None:
+                raise ValueError(f"Tipo de tarea desconocido: {tarea.tipo}")
+            handler(tarea)
+            completar(tarea)
+        except Exception as e:
+            logger.exception(f"❌ Error ejecutando {tarea}")
+            reintentar_o_fallar(tarea, e, fusionar=FUSIONES.get(tarea.tipo))
+        finally:
+            close_old_connections()
@@ -0,0 +1,51 @@
+import logging
+import signal
+import time
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from ghl_middleware.inbox import procesar_bandeja, purgar_bandeja
+
+logger = logging.getLogger(__name__)
+
+# Cada cuánto se borran las entradas ya procesadas
+INTERVALO_PURGA_SEGUNDOS = 600
+
+
+class Command(BaseCommand):
+    help = (
+        "Consumidor de la bandeja de webhooks (WebhookInbox): procesa las entradas pendientes "
+        "por lotes de agencia y purga las ya procesadas."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--lote', type=int, default=500, help="Máximo de webhooks reclamados por iteración")
+        parser.add_argument('--poll', type=float, default=1.0, help="Segundos de espera cuando la bandeja está vacía")
+        parser.add_argument('--retencion', type=int, default=24, help="Horas que se conservan las entradas procesadas")
+        parser.add_argument('--once', action='store_true', help="Procesa lo que haya pendiente y termina")
+
+    def handle(self, *args, **options):
+        self.parar = False
+        signal.signal(signal.SIGTERM, self._parar)
+        signal.signal(signal.SIGINT, self._parar)
+
+        logger.info(f"📨 Consumidor de la bandeja de webhooks arrancado (lote={options['lote']})")
+        ultima_purga = 0.0
+        while not self.parar:
+            close_old_connections()
+            if time.monotonic() - ultima_purga > INTERVALO_PURGA_SEGUNDOS:
+                borradas = purgar_bandeja(options['retencion'])
+                if borradas:
+                    logger.info(f"🧹 {borradas} webhooks procesados purgados de la bandeja")
+                ultima_purga = time.monotonic()
+
+            if procesar_bandeja(options['lote']):
+                continue
+            if options['once']:
+                break
+            time.sleep(options['poll'])
+
+        logger.info("👋 Consumidor de la bandeja detenido")
+
+    def _parar(self, signum, frame):
+        logger.info("🛑 Señal recibida, terminando el lote en curso...")
+        self.parar = True
@@ -0,0 +1,319 @@
+import logging
+from decimal import Decimal
+from django.db import transaction
+from django.db.models import F, Q
+from .models import Propiedad, Cliente, AmbitoZona
+from .indice_match import clientes_match_ids
+
+logger = logging.getLogger(__name__)
+
+# Tabla intermedia de Cliente.propiedades_interes (cliente_id, propiedad_id)
+MatchThrough = Cliente.propiedades_interes.through
+# Tabla intermedia de Cliente.ambitos_interes (cliente_id, ambitogeografico_id)
+AmbitoInteresThrough = Cliente.ambitos_interes.through
+
+
+# --- 1. CONSULTAS DE MATCH ---
+
+def clientes_para_propiedad(propiedad):
+    """
+    Queryset de clientes de la agencia que encajan con la propiedad.
+    Zona de la propiedad -> ámbitos que la cubren (tabla de cierre) -> clientes.
+    Una propiedad sin zona no casa con nadie, igual que en pares_match().
+    """
+    if propiedad.zona_id is None:
+        return Cliente.objects.none()
+    return Cliente.objects.filter(
+        Q(animales = Cliente.Preferencias1.NO) if propiedad.animales == Propiedad.Preferencias1.NO else Q(),
+        Q(balcon = Cliente.Preferencias2.IND) if propiedad.balcon == Propiedad.Preferencias1.NO else Q(),
+        Q(garaje = Cliente.Preferencias2.IND) if propiedad.garaje == Propiedad.Preferencias1.NO else Q(),
+        Q(patioInterior = Cliente.Preferencias2.IND) if propiedad.patioInterior == Propiedad.Preferencias1.NO else Q(),
+
+        agencia_id=propiedad.agencia_id,
+        ambitos_interes__in=AmbitoZona.objects.filter(zona_id=propiedad.zona_id).values('ambito_id'),
+        presupuesto_maximo__gte=propiedad.precio,
+        habitaciones_minimas__lte=propiedad.habitaciones,
+        metrosMinimo__lte=propiedad.metros
+    ).distinct()
+
+def propiedades_para_cliente(cliente):
+    """
+    Queryset de propiedades activas de la agencia que encajan con el cliente.
+    """
+    return Propiedad.objects.filter(
+        Q(animales = Propiedad.Preferencias1.SI) if cliente.animales == Cliente.Preferencias1.SI else Q(),
+        Q(balcon = Propiedad.Preferencias1.SI) if cliente.balcon == Cliente.Preferencias2.SI else Q(),
+        Q(garaje = Propiedad.Preferencias1.SI) if cliente.garaje == Cliente.Preferencias2.SI else Q(),
+        Q(patioInterior = Propiedad.Preferencias1.SI) if cliente.patioInterior == Cliente.Preferencias2.SI else Q(),
+
+        agencia_id=cliente.agencia_id,
+        precio__lte=cliente.presupuesto_maximo,
+        habitaciones__gte=cliente.habitaciones_minimas,
+        metros__gte = cliente.metrosMinimo,
+        estado=Propiedad.estadoPiso.ACTIVO,
+        zona__in = AmbitoZona.objects.filter(
+            ambito_id__in=AmbitoInteresThrough.objects.filter(cliente_id=cliente.pk).values('ambitogeografico_id')
+        ).values('zona_id')
+    ).distinct()
+
+
+# --- 2. PERSISTENCIA DE MATCHES (DIFF + BULK) ---
+
+def _aplicar_diff(columna_fija, valor_fijo, columna_variable, nuevos_ids):
+    """
+    Deja en la tabla intermedia exactamente los pares (valor_fijo, nuevos_ids).
+    Un único SELECT del estado actual, un DELETE y un bulk_create.
+    Devuelve (añadidos, quitados) como sets de ids de la columna variable.
+    """
+    nuevos_ids = set(nuevos_ids)
+
+    with transaction.atomic():
+        actuales = set(
+            MatchThrough.objects
+            .filter(**{columna_fija: valor_fijo})
+            .values_list(columna_variable, flat=True)
+        )
+        añadidos = nuevos_ids - actuales
+        quitados = actuales - nuevos_ids
+
+        if quitados:
+            MatchThrough.objects.filter(
+                **{columna_fija: valor_fijo, f"{columna_variable}__in": quitados}
+            ).delete()
+
+        if añadidos:
+            MatchThrough.objects.bulk_create(
+                [MatchThrough(**{columna_fija: valor_fijo, columna_variable: pk}) for pk in añadidos],
+                ignore_conflicts=True
+            )
+
+    return añadidos, quitados
+
+def guardar_matches_propiedad(propiedad, clientes_ids):
+    """
+    Sustituye los interesados de la propiedad por 'clientes_ids'.
+    Devuelve (clientes_añadidos, clientes_quitados).
+    """
+    return _aplicar_diff('propiedad_id', propiedad.pk, 'cliente_id', clientes_ids)
+
+def guardar_matches_cliente(cliente, propiedades_ids):
+    """
+    Sustituye las propiedades de interés del cliente por 'propiedades_ids'.
+    Devuelve (propiedades_añadidas, propiedades_quitadas).
+    """
+    return _aplicar_diff('cliente_id', cliente.pk, 'propiedad_id', propiedades_ids)
+
+def interesados_por_propiedad(propiedades_ids):
+    """
+    Devuelve {propiedad_id: [ghl_contact_id de sus interesados]} en una sola consulta.
+    """
+    resultado = {pk: [] for pk in propiedades_ids}
+    filas = (
+        MatchThrough.objects
+        .filter(propiedad_id__in=resultado.keys())
+        .values_list('propiedad_id', 'cliente__ghl_contact_id')
+    )
+    for propiedad_id, contact_id in filas:
+        resultado[propiedad_id].append(contact_id)
+    return resultado
+
+
+# --- 3. MATCHING INCREMENTAL ---
+# Antes de recalcular se compara el registro guardado con el entrante:
+# - IGUAL: ningún campo relevante cambió -> no se hace matching.
+# - AMPLIA: todos los cambios solo pueden AÑADIR matches (p. ej. bajada de precio).
+# - RESTRINGE: todos los cambios solo pueden QUITAR matches.
+# - MIXTO: hay cambios en ambos sentidos (o registro nuevo) -> recálculo completo.
+
+IGUAL = "igual"
+AMPLIA = "amplia"
+RESTRINGE = "restringe"
+MIXTO = "mixto"
+
+def _dinero(valor):
+    return Decimal(str(valor or 0)).quantize(Decimal("0.01"))
+
+# Para cada campo, una clave que crece cuando el cambio amplía el conjunto de matches
+AMPLITUD_PROPIEDAD = {
+    'precio': lambda v: -_dinero(v),
+    'habitaciones': lambda v: v,
+    'metros': lambda v: v,
+    'animales': lambda v: v == Propiedad.Preferencias1.SI,
+    'balcon': lambda v: v == Propiedad.Preferencias1.SI,
+    'garaje': lambda v: v == Propiedad.Preferencias1.SI,
+    'patioInterior': lambda v: v == Propiedad.Preferencias1.SI,
+}
+AMPLITUD_CLIENTE = {
+    'presupuesto_maximo': lambda v: _dinero(v),
+    'habitaciones_minimas': lambda v: -v,
+    'metrosMinimo': lambda v: -v,
+    'animales': lambda v: v != Cliente.Preferencias1.SI,
+    'balcon': lambda v: v != Cliente.Preferencias2.SI,
+    'garaje': lambda v: v != Cliente.Preferencias2.SI,
+    'patioInterior': lambda v: v != Cliente.Preferencias2.SI,
+}
+CAMPOS_MATCH_PROPIEDAD = list(AMPLITUD_PROPIEDAD) + ['estado', 'zona_id']
+CAMPOS_MATCH_CLIENTE = list(AMPLITUD_CLIENTE)
+
+def _combinar(direcciones):
+    direcciones = set(direcciones) - {IGUAL}
+    if not direcciones:
+        return IGUAL
+    return direcciones.pop() if len(direcciones) == 1 else MIXTO
+
+def _comparar(amplitud, antes, despues):
+    direcciones = []
+    for campo, clave in amplitud.items():
+        a, d = clave(antes[campo]), clave(despues[campo])
+        direcciones.append(IGUAL if a == d else AMPLIA if d > a else RESTRINGE)
+    return direcciones
+
+def valores_match(obj, campos):
+    return {campo: getattr(obj, campo) for campo in campos}
+
+def direccion_cambio_propiedad(antes, despues):
+    """
+    'antes' y 'despues' son dicts con CAMPOS_MATCH_PROPIEDAD ('antes' = None si es nueva).
+    """
+    if antes is None or antes['zona_id'] != despues['zona_id'] or antes['estado'] != despues['estado']:
+        return MIXTO
+    return _combinar(_comparar(AMPLITUD_PROPIEDAD, antes, despues))
+
+def direccion_cambio_cliente(antes, despues, ambitos_antes, ambitos_despues):
+    """
+    Igual que direccion_cambio_propiedad, más el conjunto de ámbitos de interés.
+    Añadir ámbitos solo puede añadir zonas cubiertas (y quitar, solo quitarlas).
+    """
+    if antes is None:
+        return MIXTO
+    direcciones = _comparar(AMPLITUD_CLIENTE, antes, despues)
+    ambitos_antes, ambitos_despues = set(ambitos_antes), set(ambitos_despues)
+    if ambitos_antes != ambitos_despues:
+        if ambitos_despues > ambitos_antes:
+            direcciones.append(AMPLIA)
+        elif ambitos_despues < ambitos_antes:
+            direcciones.append(RESTRINGE)
+        else:
+            direcciones.append(MIXTO)
+    return _combinar(direcciones)
+
+def _actualizar_incremental(direccion, match_qs, columna_fija, valor_fijo, columna_variable, guardar_completo):
+    if direccion == IGUAL:
+        return set(), set()
+    if direccion == MIXTO:
+        return guardar_completo(list(match_qs.values_list('pk', flat=True)))
+
+    actuales = MatchThrough.objects.filter(**{columna_fija: valor_fijo}).values(columna_variable)
+
+    with transaction.atomic():
+        if direccion == AMPLIA:
+            # Solo se evalúan los candidatos que aún no estaban emparejados
+            añadidos = set(match_qs.exclude(pk__in=actuales).values_list('pk', flat=True))
+            MatchThrough.objects.bulk_create(
+                [MatchThrough(**{columna_fija: valor_fijo, columna_variable: pk}) for pk in añadidos],
+                ignore_conflicts=True
+            )
+            return añadidos, set()
+
+        # RESTRINGE: solo se re-evalúan los que ya estaban emparejados
+        siguen = set(match_qs.filter(pk__in=actuales).values_list('pk', flat=True))
+        quitados = set(actuales.values_list(columna_variable, flat=True)) - siguen
+        if quitados:
+            MatchThrough.objects.filter(
+                **{columna_fija: valor_fijo, f"{columna_variable}__in": quitados}
+            ).delete()
+        return set(), quitados
+
+def actualizar_matches_propiedad(propiedad, direccion):
+    """
+    Aplica el matching de la propiedad según la dirección del cambio.
+    Devuelve (clientes_añadidos, clientes_quitados).
+    """
+    if direccion != IGUAL:
+        # Con el índice en memoria el conjunto completo sale sin consultar Cliente
+        clientes_ids = clientes_match_ids(propiedad)
+        if clientes_ids is not None:
+            return guardar_matches_propiedad(propiedad, clientes_ids)
+    return _actualizar_incremental(
+        direccion, clientes_para_propiedad(propiedad), 'propiedad_id', propiedad.pk, 'cliente_id',
+        lambda ids: guardar_matches_propiedad(propiedad, ids)
+    )
+
+def actualizar_matches_cliente(cliente, direccion):
+    """
+    Aplica el matching del cliente según la dirección del cambio.
+    Devuelve (propiedades_añadidas, propiedades_quitadas).
+    """
+    return _actualizar_incremental(
+        direccion, propiedades_para_cliente(cliente), 'cliente_id', cliente.pk, 'propiedad_id',
+        lambda ids: guardar_matches_cliente(cliente, ids)
+    )
+
+
+# --- 4. MATCHING MASIVO (UNA SOLA JOIN) ---
+
+def pares_match(agencia_id, propiedades_ids=None, clientes_ids=None):
+    """
+    Pares (cliente_id, propiedad_id) que hacen match en la agencia, calculados en
+    una sola consulta: cliente -> ámbito de interés -> zonas que cubre (tabla de
+    cierre) -> propiedades activas de esas zonas.
+    Mismas reglas que clientes_para_propiedad / propiedades_para_cliente.
+    Opcionalmente se limita a unas propiedades y/o clientes concretos.
+    """
+    # Todo en un único filter() para que las condiciones compartan la misma join
+    pares = AmbitoZona.objects.filter(
+        Q(ambito__clientes__animales=Cliente.Preferencias1.NO) | Q(zona__propiedades__animales=Propiedad.Preferencias1.SI),
+        Q(ambito__clientes__balcon=Cliente.Preferencias2.IND) | Q(zona__propiedades__balcon=Propiedad.Preferencias1.SI),
+        Q(ambito__clientes__garaje=Cliente.Preferencias2.IND) | Q(zona__propiedades__garaje=Propiedad.Preferencias1.SI),
+        Q(ambito__clientes__patioInterior=Cliente.Preferencias2.IND) | Q(zona__propiedades__patioInterior=Propiedad.Preferencias1.SI),
+        Q(zona__propiedades__id__in=propiedades_ids) if propiedades_ids is not None else Q(),
+        Q(ambito__clientes__id__in=clientes_ids) if clientes_ids is not None else Q(),
+
+        ambito__clientes__agencia_id=agencia_id,
+        zona__propiedades__agencia_id=agencia_id,
+        zona__propiedades__estado=Propiedad.estadoPiso.ACTIVO,
+        zona__propiedades__precio__lte=F('ambito__clientes__presupuesto_maximo'),
+        zona__propiedades__habitaciones__gte=F('ambito__clientes__habitaciones_minimas'),
+        zona__propiedades__metros__gte=F('ambito__clientes__metrosMinimo')
+    )
+    # Un cliente con ámbitos solapados (una zona y su provincia) repite pares:
+    # se deduplican en Python (reemplazar_matches hace set()) en vez de con DISTINCT
+    return pares.values_list('ambito__clientes__id', 'zona__propiedades__id')
+
+def reemplazar_matches(agencia_id, propiedades_ids=None, clientes_ids=None, lote=5000):
+    """
+    Recalcula con pares_match() y deja la tabla intermedia exactamente igual al
+    resultado, en una sola transacción (solo se borra/inserta la diferencia).
+    Con propiedades_ids/clientes_ids solo se toca ese subconjunto.
+    Devuelve {propiedad_id: (clientes_añadidos, clientes_quitados)} de las afectadas.
+    """
+    actuales_qs = MatchThrough.objects.filter(cliente__agencia_id=agencia_id)
+    if propiedades_ids is not None:
+        actuales_qs = actuales_qs.filter(propiedad_id__in=propiedades_ids)
+    if clientes_ids is not None:
+        actuales_qs = actuales_qs.filter(cliente_id__in=clientes_ids)
+
+    with transaction.atomic():
+        nuevos = set(pares_match(agencia_id, propiedades_ids, clientes_ids))
+        actuales = {
+            (cliente_id, propiedad_id): pk
+            for pk, cliente_id, propiedad_id in actuales_qs.values_list('pk', 'cliente_id', 'propiedad_id')
+        }
+        añadidos = nuevos - actuales.keys()
+        quitados = actuales.keys() - nuevos
+
+        ids_quitados = [actuales[par] for par in quitados]
+        for i in range(0, len(ids_quitados), lote):
+            MatchThrough.objects.filter(pk__in=ids_quitados[i:i + lote]).delete()
+        MatchThrough.objects.bulk_create(
+            [MatchThrough(cliente_id=c, propiedad_id=p) for c, p in añadidos],
+            batch_size=lote,
+            ignore_conflicts=True
+        )
+
+    cambios = {}
+    for cliente_id, propiedad_id in añadidos:
+        cambios.setdefault(propiedad_id, (set(), set()))[0].add(cliente_id)
+    for cliente_id, propiedad_id in quitados:
+        cambios.setdefault(propiedad_id, (set(), set()))[1].add(cliente_id)
+    return cambios
@@ -0,0 +1,34 @@
+# Generated by Django 4.2.27 on 2026-10-17 19:01
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ghl_middleware', '0011_alter_municipio_nombre_alter_provincia_nombre_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TareaGHL',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('tipo', models.CharField(choices=[('sync_asociaciones', 'Sincronizar asociaciones'), ('zonas', 'Actualizar zonas en GHL')], max_length=30)),
+                ('location_id', models.CharField(blank=True, default='', max_length=255)),
+                ('payload', models.JSONField(default=dict)),
+                ('estado', models.CharField(choices=[('pendiente', 'Pendiente'), ('en_curso', 'En curso'), ('completada', 'Completada'), ('fallida', 'Fallida')], default='pendiente', max_length=12)),
+                ('intentos', models.IntegerField(default=0)),
+                ('max_intentos', models.IntegerField(default=5)),
+                ('ejecutar_despues', models.DateTimeField(default=django.utils.timezone.now, help_text='No se ejecuta antes de esta fecha (backoff)')),
+                ('bloqueada_hasta', models.DateTimeField(blank=True, help_text='Fin del lease del worker que la tiene reclamada', null=True)),
+                ('ultimo_error', models.TextField(blank=True, default='')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['estado', 'ejecutar_despues'], name='ghl_middlew_estado_8b7b2a_idx')],
+            },
+        ),
+    ]
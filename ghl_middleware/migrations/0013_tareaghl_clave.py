@@ -0,0 +1,22 @@
+# Generated by Django 4.2.27 on 2026-10-17 19:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ghl_middleware', '0012_tareaghl'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tareaghl',
+            name='clave',
+            field=models.CharField(blank=True, default='', help_text='Clave de coalescencia: solo puede haber una tarea pendiente por clave', max_length=512),
+        ),
+        migrations.AddConstraint(
+            model_name='tareaghl',
+            constraint=models.UniqueConstraint(condition=models.Q(('estado', 'pendiente'), models.Q(('clave', ''), _negated=True)), fields=('clave',), name='tarea_pendiente_unica_por_clave'),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 4.2.27 on 2026-10-17 19:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ghl_middleware', '0013_tareaghl_clave'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='cliente',
+            index=models.Index(fields=['agencia', 'presupuesto_maximo', 'habitaciones_minimas', 'metrosMinimo'], name='cliente_match_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='propiedad',
+            index=models.Index(condition=models.Q(('estado', 'activo')), fields=['agencia', 'zona', 'precio', 'habitaciones', 'metros'], name='prop_match_activo_idx'),
+        ),
+        # Tablas intermedias automáticas de los M2M: índices "covering" en el orden
+        # en que las recorre el matching (zona -> clientes, propiedad -> interesados),
+        # para poder resolver el join con un index-only scan.
+        migrations.RunSQL(
+            sql='CREATE INDEX IF NOT EXISTS "cli_zona_int_zona_cli_idx" ON "ghl_middleware_cliente_zona_interes" ("zona_id", "cliente_id");',
+            reverse_sql='DROP INDEX IF EXISTS "cli_zona_int_zona_cli_idx";',
+        ),
+        migrations.RunSQL(
+            sql='CREATE INDEX IF NOT EXISTS "cli_prop_int_prop_cli_idx" ON "ghl_middleware_cliente_propiedades_interes" ("propiedad_id", "cliente_id");',
+            reverse_sql='DROP INDEX IF EXISTS "cli_prop_int_prop_cli_idx";',
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 4.2.27 on 2026-10-17 19:27
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ghl_middleware', '0014_indices_matching'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WebhookInbox',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('tipo', models.CharField(choices=[('propiedad', 'Propiedad'), ('cliente', 'Cliente')], max_length=20)),
+                ('clave_idempotencia', models.CharField(help_text='Cabecera Idempotency-Key o sha256 del payload', max_length=128)),
+                ('location_id', models.CharField(blank=True, default='', max_length=255)),
+                ('payload', models.JSONField(default=dict)),
+                ('estado', models.CharField(choices=[('pendiente', 'Pendiente'), ('procesado', 'Procesado'), ('fallido', 'Fallido')], default='pendiente', max_length=12)),
+                ('intentos', models.IntegerField(default=0)),
+                ('procesar_despues', models.DateTimeField(default=django.utils.timezone.now, help_text='No se procesa antes de esta fecha (backoff)')),
+                ('ultimo_error', models.TextField(blank=True, default='')),
+                ('recibido_en', models.DateTimeField(auto_now_add=True)),
+                ('procesado_en', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['estado', 'procesar_despues'], name='ghl_middlew_estado_f02492_idx'), models.Index(fields=['estado', 'procesado_en'], name='ghl_middlew_estado_8ead09_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='webhookinbox',
+            constraint=models.UniqueConstraint(condition=models.Q(('estado', 'pendiente')), fields=('tipo', 'clave_idempotencia'), name='inbox_pendiente_unico_por_clave'),
+        ),
+    ]
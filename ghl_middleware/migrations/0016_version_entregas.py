@@ -0,0 +1,33 @@
+# Generated by Django 4.2.27 on 2026-10-17 19:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ghl_middleware', '0015_webhookinbox'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cliente',
+            name='ghl_updated_at',
+            field=models.DateTimeField(blank=True, help_text='dateUpdated de GHL (o fecha de entrega) de la última entrega aplicada', null=True),
+        ),
+        migrations.AddField(
+            model_name='cliente',
+            name='payload_hash',
+            field=models.CharField(blank=True, default='', help_text='sha256 de los campos de la última entrega aplicada', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='propiedad',
+            name='ghl_updated_at',
+            field=models.DateTimeField(blank=True, help_text='dateUpdated de GHL (o fecha de entrega) de la última entrega aplicada', null=True),
+        ),
+        migrations.AddField(
+            model_name='propiedad',
+            name='payload_hash',
+            field=models.CharField(blank=True, default='', help_text='sha256 de los campos de la última entrega aplicada', max_length=64),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 4.2.27 on 2026-10-17 19:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ghl_middleware', '0016_version_entregas'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='propiedad',
+            index=models.Index(condition=models.Q(('estado', 'activo')), fields=['agencia', 'precio', 'id'], name='prop_publica_precio_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='propiedad',
+            index=models.Index(condition=models.Q(('estado', 'activo')), fields=['agencia', 'id'], name='prop_publica_id_idx'),
+        ),
+    ]
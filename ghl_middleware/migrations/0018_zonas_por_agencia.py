@@ -0,0 +1,44 @@
+# Generated by Django 4.2.27 on 2026-10-17 19:45
+
+from django.db import migrations, models
+
+# IDs que ejecutar_actualizacion_zonas tenía fijos en el código, asignados por posición
+# en Agencia.objects.all(). Ese queryset no tenía orden, así que se copian por orden de
+# location_id (la pk), que es estable en cualquier base de datos. Si en producción el
+# emparejamiento era otro, se corrige a mano en el admin (Agencia -> campos de zona).
+IDS_PROPIEDAD = ["hS4cEeTEOSITPlkOyYx5", "otsVf8GDT9QyqTeVbNs5"]
+IDS_CLIENTE = ["kAMWAxQudbtRtEWWL4eE", "dTS9Cyfwu7pbK28roBMK"]
+
+
+def copiar_ids_fijos(apps, schema_editor):
+    Agencia = apps.get_model('ghl_middleware', 'Agencia')
+    for agencia, id_propiedad, id_cliente in zip(Agencia.objects.order_by('pk'), IDS_PROPIEDAD, IDS_CLIENTE):
+        agencia.zona_field_propiedad_id = id_propiedad
+        agencia.zona_field_cliente_id = id_cliente
+        agencia.save(update_fields=['zona_field_propiedad_id', 'zona_field_cliente_id'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ghl_middleware', '0017_indices_api_publica'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='agencia',
+            name='zona_field_cliente_id',
+            field=models.CharField(blank=True, default='', help_text="ID del custom field 'zona' de los contactos en esta subcuenta", max_length=255),
+        ),
+        migrations.AddField(
+            model_name='agencia',
+            name='zona_field_propiedad_id',
+            field=models.CharField(blank=True, default='', help_text="ID del custom field 'zona' del Custom Object Propiedad en esta subcuenta", max_length=255),
+        ),
+        migrations.AddField(
+            model_name='agencia',
+            name='zonas_hash',
+            field=models.CharField(blank=True, default='', help_text='sha256 de las opciones de zona enviadas por última vez (vacío = nunca)', max_length=64),
+        ),
+        migrations.RunPython(copiar_ids_fijos, migrations.RunPython.noop),
+    ]
@@ -1,4 +1,5 @@
 from django.db import models
+from django.utils import timezone
 
 # --- 1. MODELO DE INFRAESTRUCTURA (CRUZADO / OAUTH) ---
 
@@ -50,6 +51,20 @@ class Agencia(models.Model):
     )
     # ------------------------------------
 
+    # --- DESPLEGABLES DE ZONA EN GHL (ver sync_zonas.py) ---
+    zona_field_propiedad_id = models.CharField(
+        max_length=255, blank=True, default="",
+        help_text="ID del custom field 'zona' del Custom Object Propiedad en esta subcuenta"
+    )
+    zona_field_cliente_id = models.CharField(
+        max_length=255, blank=True, default="",
+        help_text="ID del custom field 'zona' de los contactos en esta subcuenta"
+    )
+    zonas_hash = models.CharField(
+        max_length=64, blank=True, default="",
+        help_text="sha256 de las opciones de zona enviadas por última vez (vacío = nunca)"
+    )
+
     def __str__(self):
         return f"{self.nombre or 'Agencia Sin Nombre'} ({self.location_id})"
 
@@ -76,6 +91,55 @@ class Zona(models.Model):
     def __str__(self):
         return self.nombre
 
+class AmbitoGeografico(models.Model):
+    """
+    Nodo del árbol Provincia -> Municipio -> Zona en el que un cliente puede declarar interés.
+    Exactamente uno de provincia/municipio/zona está informado, el de su 'nivel'.
+    'zonas' es la tabla de cierre: todas las zonas que cubre el nodo (ver ambitos.py).
+    """
+    class Nivel(models.TextChoices):
+        PROVINCIA = "provincia", "Provincia"
+        MUNICIPIO = "municipio", "Municipio"
+        ZONA = "zona", "Zona"
+
+    nivel = models.CharField(max_length=10, choices=Nivel.choices)
+    provincia = models.OneToOneField(Provincia, blank=True, null=True, on_delete=models.CASCADE, related_name="ambito")
+    municipio = models.OneToOneField(Municipio, blank=True, null=True, on_delete=models.CASCADE, related_name="ambito")
+    zona = models.OneToOneField(Zona, blank=True, null=True, on_delete=models.CASCADE, related_name="ambito")
+    zonas = models.ManyToManyField(Zona, through='AmbitoZona', related_name="ambitos", blank=True)
+
+    class Meta:
+        constraints = [
+            models.CheckConstraint(
+                check=(
+                    models.Q(nivel='provincia', provincia__isnull=False, municipio__isnull=True, zona__isnull=True) |
+                    models.Q(nivel='municipio', provincia__isnull=True, municipio__isnull=False, zona__isnull=True) |
+                    models.Q(nivel='zona', provincia__isnull=True, municipio__isnull=True, zona__isnull=False)
+                ),
+                name='ambito_un_solo_nodo'
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.get_nivel_display()}: {self.provincia or self.municipio or self.zona}"
+
+class AmbitoZona(models.Model):
+    """
+    Tabla de cierre del árbol: una fila por cada (ámbito, zona que cubre).
+    Una provincia tiene una fila por cada zona de sus municipios; una zona, solo la suya.
+    """
+    ambito = models.ForeignKey(AmbitoGeografico, on_delete=models.CASCADE, related_name="cierre")
+    zona = models.ForeignKey(Zona, on_delete=models.CASCADE, related_name="+")
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['ambito', 'zona'], name='ambito_zona_unico'),
+        ]
+        indexes = [
+            # Match desde el lado de la propiedad: zona -> ámbitos que la cubren, sin tocar la tabla
+            models.Index(fields=['zona', 'ambito'], name='ambito_zona_zona_idx'),
+        ]
+
 class Propiedad(models.Model):
     """
     Representa el Custom Object 'Propiedad' de GHL.
@@ -103,8 +167,33 @@ class Propiedad(models.Model):
     garaje = models.CharField(max_length=3, choices=Preferencias1.choices, default=Preferencias1.NO) #Default es el indiferente. A la hora de buscar errores, se ha de tener esto en cuenta.
     patioInterior = models.CharField(max_length=3, choices=Preferencias1.choices, default=Preferencias1.NO) #Default es el indiferente. A la hora de buscar errores, se ha de tener esto en cuenta.
 
+    # Versionado de entregas: se descartan los webhooks repetidos o más antiguos que lo guardado
+    payload_hash = models.CharField(max_length=64, blank=True, default="", help_text="sha256 de los campos de la última entrega aplicada")
+    ghl_updated_at = models.DateTimeField(blank=True, null=True, help_text="dateUpdated de GHL (o fecha de entrega) de la última entrega aplicada")
+
     class Meta:
         unique_together = ('agencia', 'ghl_contact_id')
+        indexes = [
+            # Match desde el lado del cliente: agencia + zona (igualdad) y luego precio (rango).
+            # Parcial: solo las activas participan en el matching.
+            models.Index(
+                fields=['agencia', 'zona', 'precio', 'habitaciones', 'metros'],
+                condition=models.Q(estado='activo'),
+                name='prop_match_activo_idx'
+            ),
+            # API pública (GHL_Front): listado de una agencia ordenado por precio o por id,
+            # con los filtros de rango aplicados sobre el propio índice.
+            models.Index(
+                fields=['agencia', 'precio', 'id'],
+                condition=models.Q(estado='activo'),
+                name='prop_publica_precio_idx'
+            ),
+            models.Index(
+                fields=['agencia', 'id'],
+                condition=models.Q(estado='activo'),
+                name='prop_publica_id_idx'
+            ),
+        ]
 
     def __str__(self):
         return f"Propiedad {self.ghl_contact_id} - {self.zona} ({self.habitaciones} habs)"
@@ -127,7 +216,8 @@ class Cliente(models.Model):
     ghl_contact_id = models.CharField(max_length=255, help_text="ID del CONTACTO en GHL")
     nombre = models.CharField(max_length=255, blank=True, default="Desconocido")
     presupuesto_maximo = models.DecimalField(max_digits=12, decimal_places=2, default=0)
-    zona_interes = models.ManyToManyField(Zona,max_length=255, blank=True, null=True, related_name="clientes")
+    # Interés a cualquier nivel del árbol (provincia, municipio o zona), resuelto a zonas con la tabla de cierre
+    ambitos_interes = models.ManyToManyField(AmbitoGeografico, blank=True, related_name="clientes")
 
     # NUEVO CAMPO SOLICITADO:
     habitaciones_minimas = models.IntegerField(default=0, help_text="Nº mínimo de habitaciones que busca el cliente")
@@ -149,8 +239,113 @@ class Cliente(models.Model):
     garaje = models.CharField(max_length=3, choices=Preferencias2.choices, default=Preferencias2.IND) #Default es el indiferente. A la hora de buscar errores, se ha de tener esto en cuenta.
     patioInterior = models.CharField(max_length=3, choices=Preferencias2.choices, default=Preferencias2.IND) #Default es el indiferente. A la hora de buscar errores, se ha de tener esto en cuenta.
 
+    # Versionado de entregas: se descartan los webhooks repetidos o más antiguos que lo guardado
+    payload_hash = models.CharField(max_length=64, blank=True, default="", help_text="sha256 de los campos de la última entrega aplicada")
+    ghl_updated_at = models.DateTimeField(blank=True, null=True, help_text="dateUpdated de GHL (o fecha de entrega) de la última entrega aplicada")
+
     class Meta:
         unique_together = ('agencia', 'ghl_contact_id')
+        indexes = [
+            # Match desde el lado de la propiedad: agencia (igualdad) y presupuesto (rango);
+            # habitaciones y metros van en la clave para que el filtro no toque la tabla.
+            models.Index(
+                fields=['agencia', 'presupuesto_maximo', 'habitaciones_minimas', 'metrosMinimo'],
+                name='cliente_match_idx'
+            ),
+        ]
 
     def __str__(self):
         return f"Cliente {self.nombre}"
+
+
+# --- 3. COLA DE TAREAS EN SEGUNDO PLANO ---
+
+class TareaGHL(models.Model):
+    """
+    Tarea persistente que ejecuta el worker (manage.py run_ghl_worker).
+    Sustituye a los threading.Thread que se lanzaban dentro de gunicorn:
+    si el proceso se reinicia, la tarea sigue en la tabla y se reintenta.
+    """
+    class Tipo(models.TextChoices):
+        SYNC_ASOCIACIONES = "sync_asociaciones", "Sincronizar asociaciones"
+        ZONAS = "zonas", "Actualizar zonas en GHL"
+
+    class Estado(models.TextChoices):
+        PENDIENTE = "pendiente", "Pendiente"
+        EN_CURSO = "en_curso", "En curso"
+        COMPLETADA = "completada", "Completada"
+        FALLIDA = "fallida", "Fallida"
+
+    tipo = models.CharField(max_length=30, choices=Tipo.choices)
+    location_id = models.CharField(max_length=255, blank=True, default="")
+    clave = models.CharField(max_length=512, blank=True, default="", help_text="Clave de coalescencia: solo puede haber una tarea pendiente por clave")
+    payload = models.JSONField(default=dict)
+    estado = models.CharField(max_length=12, choices=Estado.choices, default=Estado.PENDIENTE)
+    intentos = models.IntegerField(default=0)
+    max_intentos = models.IntegerField(default=5)
+    ejecutar_despues = models.DateTimeField(default=timezone.now, help_text="No se ejecuta antes de esta fecha (backoff)")
+    bloqueada_hasta = models.DateTimeField(blank=True, null=True, help_text="Fin del lease del worker que la tiene reclamada")
+    ultimo_error = models.TextField(blank=True, default="")
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['estado', 'ejecutar_despues']),
+        ]
+        constraints = [
+            models.UniqueConstraint(
+                fields=['clave'],
+                condition=models.Q(estado='pendiente') & ~models.Q(clave=''),
+                name='tarea_pendiente_unica_por_clave'
+            ),
+        ]
+
+    def __str__(self):
+        return f"Tarea {self.tipo} #{self.pk} ({self.estado})"
+
+
+# --- 4. BANDEJA DE ENTRADA DE WEBHOOKS ---
+
+class WebhookInbox(models.Model):
+    """
+    Payload crudo de un webhook recibido en modo bandeja (GHL_WEBHOOK_INBOX).
+    El webhook responde 202 nada más guardarlo y manage.py run_inbox_consumer
+    lo procesa después, por lotes de agencia.
+    """
+    class Tipo(models.TextChoices):
+        PROPIEDAD = "propiedad", "Propiedad"
+        CLIENTE = "cliente", "Cliente"
+
+    class Estado(models.TextChoices):
+        PENDIENTE = "pendiente", "Pendiente"
+        PROCESADO = "procesado", "Procesado"
+        FALLIDO = "fallido", "Fallido"
+
+    tipo = models.CharField(max_length=20, choices=Tipo.choices)
+    clave_idempotencia = models.CharField(max_length=128, help_text="Cabecera Idempotency-Key o sha256 del payload")
+    location_id = models.CharField(max_length=255, blank=True, default="")
+    payload = models.JSONField(default=dict)
+    estado = models.CharField(max_length=12, choices=Estado.choices, default=Estado.PENDIENTE)
+    intentos = models.IntegerField(default=0)
+    procesar_despues = models.DateTimeField(default=timezone.now, help_text="No se procesa antes de esta fecha (backoff)")
+    ultimo_error = models.TextField(blank=True, default="")
+    recibido_en = models.DateTimeField(auto_now_add=True)
+    procesado_en = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['estado', 'procesar_despues']),
+            models.Index(fields=['estado', 'procesado_en']),
+        ]
+        constraints = [
+            # Los reenvíos de GHL mientras la entrada sigue pendiente se descartan al insertar
+            models.UniqueConstraint(
+                fields=['tipo', 'clave_idempotencia'],
+                condition=models.Q(estado='pendiente'),
+                name='inbox_pendiente_unico_por_clave'
+            ),
+        ]
+
+    def __str__(self):
+        return f"Webhook {self.tipo} #{self.pk} ({self.estado})"
@@ -0,0 +1,63 @@
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.dispatch import receiver
+from .models import Provincia, Municipio, Zona, AmbitoGeografico, Propiedad, Cliente
+from .zonas import invalidar_arbol_zonas
+from .ambitos import sincronizar_ambitos, asegurar_ambito
+from .indice_match import registrar_cambios
+from .cache_publica import invalidar_propiedades_publicas
+
+
+@receiver([post_save, post_delete], sender=Provincia)
+@receiver([post_save, post_delete], sender=Municipio)
+@receiver([post_save, post_delete], sender=Zona)
+def ubicacion_modificada(sender, instance, signal, created=False, **kwargs):
+    # Ámbitos y tabla de cierre antes de subir la versión: quien reconstruya con la
+    # versión nueva ya los ve. Al borrar, el CASCADE se lleva sus filas.
+    if signal is post_save:
+        if sender is Zona:
+            sincronizar_ambitos([instance.pk])
+        elif sender is Municipio:
+            asegurar_ambito(AmbitoGeografico.Nivel.MUNICIPIO, instance.pk)
+            if not created:
+                # Puede haber cambiado de provincia: sus zonas cuelgan ahora de otra
+                sincronizar_ambitos(list(instance.zonas.values_list('pk', flat=True)))
+        else:
+            asegurar_ambito(AmbitoGeografico.Nivel.PROVINCIA, instance.pk)
+    invalidar_arbol_zonas()
+
+
+# --- CACHÉ DE LA API PÚBLICA ---
+# Los webhooks por lotes usan bulk_create (sin señales): ingerir_propiedades invalida él mismo.
+
+@receiver([post_save, post_delete], sender=Propiedad)
+def propiedad_modificada(sender, instance, **kwargs):
+    # agencia_id es el location_id (pk de Agencia): sin query aunque la agencia no esté cargada
+    invalidar_propiedades_publicas(instance.agencia_id, [instance.ghl_contact_id])
+
+
+# --- ÍNDICE DE MATCHING EN MEMORIA ---
+# Los caminos masivos (bulk_create/update) no disparan señales: llaman a registrar_cambios ellos mismos.
+
+@receiver([post_save, post_delete], sender=Cliente)
+def cliente_modificado(sender, instance, **kwargs):
+    registrar_cambios(instance.agencia_id, [instance.pk])
+
+@receiver(m2m_changed, sender=Cliente.ambitos_interes.through)
+def ambitos_cliente_modificados(sender, instance, action, reverse, pk_set, **kwargs):
+    if not reverse:
+        if action in ("post_add", "post_remove", "post_clear"):
+            registrar_cambios(instance.agencia_id, [instance.pk])
+        return
+
+    # Desde el ámbito (ambito.clientes.add/remove/clear): pk_set son clientes
+    if action in ("post_add", "post_remove"):
+        clientes = Cliente.objects.filter(pk__in=pk_set)
+    elif action == "pre_clear":
+        clientes = instance.clientes.all()
+    else:
+        return
+    por_agencia = {}
+    for agencia_id, cliente_id in clientes.values_list('agencia_id', 'pk'):
+        por_agencia.setdefault(agencia_id, []).append(cliente_id)
+    for agencia_id, clientes_ids in por_agencia.items():
+        registrar_cambios(agencia_id, clientes_ids)
@@ -0,0 +1,47 @@
+from django.http import StreamingHttpResponse
+
+# Modos de ?stream=: array JSON escrito por partes, o NDJSON (un objeto por línea)
+JSON = 'json'
+NDJSON = 'ndjson'
+MODOS = {'1': JSON, 'true': JSON, 'json': JSON, 'ndjson': NDJSON}
+
+# Bytes que se acumulan antes de entregar un trozo al servidor (evita miles de writes de una fila)
+TAMANO_TROZO = 64 * 1024
+
+
+def modo_stream(request):
+    """
+    JSON, NDJSON o None (respuesta normal) según ?stream=.
+    """
+    return MODOS.get(request.GET.get('stream', '').lower())
+
+def _agrupar(partes):
+    buffer, tamano = [], 0
+    for parte in partes:
+        buffer.append(parte)
+        tamano += len(parte)
+        if tamano >= TAMANO_TROZO:
+            yield "".join(buffer)
+            buffer, tamano = [], 0
+    if buffer:
+        yield "".join(buffer)
+
+def _partes_json(filas, inicio, fin):
+    yield inicio
+    for indice, fila in enumerate(filas):
+        yield ("," if indice else "") + fila
+    yield fin
+
+def _partes_ndjson(filas):
+    for fila in filas:
+        yield fila + "\n"
+
+def respuesta_stream(filas, modo, inicio="[", fin="]"):
+    """
+    StreamingHttpResponse a partir de un iterable de objetos ya serializados (str).
+    La memoria no depende del nº de filas: solo se retiene un trozo a la vez.
+    En modo JSON las filas van entre 'inicio' y 'fin' (por defecto, un array).
+    """
+    if modo == NDJSON:
+        return StreamingHttpResponse(_agrupar(_partes_ndjson(filas)), content_type="application/x-ndjson")
+    return StreamingHttpResponse(_agrupar(_partes_json(filas, inicio, fin)), content_type="application/json")
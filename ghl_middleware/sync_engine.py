@@ -0,0 +1,134 @@
+import asyncio
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from functools import partial
+from django.conf import settings
+from .utils import ghl_associate_records, ghl_get_current_associations, ghl_delete_association
+
+logger = logging.getLogger(__name__)
+
+# Las llamadas HTTP van por el GHLClient síncrono (pool keep-alive + token bucket
+# por location) y se ejecutan en este pool de hilos; asyncio solo orquesta el fan-out.
+_executor = ThreadPoolExecutor(max_workers=20, thread_name_prefix="ghl-sync")
+
+# Tope de peticiones simultáneas por location, compartido por todo el proceso: el
+# worker ejecuta varias tareas a la vez, cada una con su MotorSync y su event loop,
+# así que un semáforo de asyncio por instancia no limitaría nada entre ellas.
+_limitadores = {}
+_limitadores_lock = threading.Lock()
+
+def _limitador(location_id, maximo):
+    with _limitadores_lock:
+        return _limitadores.setdefault((location_id, maximo), threading.BoundedSemaphore(maximo))
+
+def _con_limite(limitador, func, *args):
+    with limitador:
+        return func(*args)
+
+
+@dataclass
+class PeticionSync:
+    """
+    Con 'target_ids' se deja en GHL exactamente ese conjunto (GET + diff).
+    Sin él se aplica solo el delta 'add_ids' / 'remove_ids'; el GET de relaciones
+    solo se hace si hay algo que borrar (hace falta el id de la relación).
+    """
+    location_id: str
+    origin_record_id: str
+    association_id: str
+    access_token: str
+    target_ids: list = None
+    add_ids: list = field(default_factory=list)
+    remove_ids: list = field(default_factory=list)
+
+
+@dataclass
+class ResultadoSync:
+    origin_record_id: str
+    added: list = field(default_factory=list)
+    removed: list = field(default_factory=list)
+    failed: list = field(default_factory=list)
+    latency: float = 0.0
+
+    @property
+    def ok(self):
+        return not self.failed
+
+
+class MotorSync:
+    """
+    Sincroniza las asociaciones de una o varias propiedades lanzando los
+    DELETE y POST en paralelo, con un máximo de peticiones simultáneas por location.
+    """
+    def __init__(self, max_concurrencia_por_location=None):
+        self.max_concurrencia = max_concurrencia_por_location or settings.GHL_SYNC_MAX_CONCURRENCY
+
+    async def _llamar(self, location_id, func, *args):
+        limitador = _limitador(location_id, self.max_concurrencia)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_executor, partial(_con_limite, limitador, func, *args))
+
+    async def sincronizar_propiedad(self, p):
+        inicio = time.monotonic()
+        resultado = ResultadoSync(origin_record_id=p.origin_record_id)
+
+        # 1. Estado actual y diferencias
+        # Si el GET falla no se da nada por hecho: todo el delta cuenta como fallido y la cola reintenta
+        if p.target_ids is not None or p.remove_ids:
+            try:
+                current_map = await self._llamar(p.location_id, ghl_get_current_associations, p.access_token, p.location_id, p.origin_record_id)
+            except Exception as e:
+                logger.error(f"❌ Sync Propiedad {p.origin_record_id}: sin relaciones actuales ({e})")
+                resultado.failed = sorted(set(p.target_ids or []) | set(p.add_ids) | set(p.remove_ids)) or [p.origin_record_id]
+                resultado.latency = time.monotonic() - inicio
+                return resultado
+        else:
+            # Solo altas: sin GET, una relación que ya existía cuenta como alta hecha
+            current_map = {}
+
+        if p.target_ids is not None:
+            target_ids = set(p.target_ids)
+            ids_to_add = target_ids - set(current_map.keys())
+            ids_to_remove = set(current_map.keys()) - target_ids
+        else:
+            ids_to_add = set(p.add_ids) - set(current_map.keys())
+            ids_to_remove = set(p.remove_ids) & set(current_map.keys())
+
+        # 2. Borrados y altas a la vez
+        async def borrar(contact_id):
+            rel_id = (current_map.get(contact_id) or {}).get('id')
+            if not rel_id:
+                return
+            ok = await self._llamar(p.location_id, ghl_delete_association, p.access_token, p.location_id, rel_id)
+            (resultado.removed if ok else resultado.failed).append(contact_id)
+
+        async def añadir(contact_id):
+            ok = await self._llamar(p.location_id, ghl_associate_records, p.access_token, p.location_id, p.origin_record_id, contact_id, p.association_id)
+            (resultado.added if ok else resultado.failed).append(contact_id)
+
+        await asyncio.gather(
+            *(borrar(c) for c in ids_to_remove),
+            *(añadir(c) for c in ids_to_add)
+        )
+
+        resultado.latency = time.monotonic() - inicio
+        logger.info(
+            f"🔄 Sync Propiedad {p.origin_record_id}: +{len(resultado.added)} | -{len(resultado.removed)} "
+            f"| ✗{len(resultado.failed)} en {resultado.latency:.2f}s"
+        )
+        return resultado
+
+    async def sincronizar(self, peticiones):
+        return await asyncio.gather(*(self.sincronizar_propiedad(p) for p in peticiones))
+
+
+def sincronizar_asociaciones(peticiones, max_concurrencia_por_location=None):
+    """
+    Punto de entrada síncrono (worker, comandos). Devuelve una lista de ResultadoSync
+    en el mismo orden que 'peticiones'.
+    """
+    motor = MotorSync(max_concurrencia_por_location)
+    return asyncio.run(motor.sincronizar(list(peticiones)))
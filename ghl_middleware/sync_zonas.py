@@ -0,0 +1,108 @@
+import hashlib
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.db import close_old_connections
+from .models import Agencia, Provincia, Municipio, Zona, AmbitoGeografico
+from .ambitos import etiqueta_ambito
+from .utils import ghlActualizarZonaAPI, get_valid_token
+
+logger = logging.getLogger(__name__)
+
+# Sincronización de los desplegables de zona de GHL (Propiedad y contacto).
+# Cada agencia guarda los IDs de sus custom fields y la huella de lo último que se
+# le envió: solo se llama a GHL para las agencias cuya huella ya no coincide.
+
+
+def opciones_zonas():
+    """
+    (opciones del campo de Propiedad, opciones del campo de contacto), en orden estable
+    para que la huella no cambie si no cambian las zonas.
+    El contacto puede elegir además municipios y provincias enteros ('Municipio: X').
+    """
+    nombres = list(Zona.objects.order_by('pk').values_list('nombre', flat=True))
+    opciones_propiedad = [{"label": nombre, "key": nombre.lower().strip().replace(" ", "_")} for nombre in nombres]
+    opciones_cliente = list(nombres)
+    for nivel, modelo in ((AmbitoGeografico.Nivel.MUNICIPIO, Municipio), (AmbitoGeografico.Nivel.PROVINCIA, Provincia)):
+        etiquetas = (etiqueta_ambito(nivel, nombre) for nombre in modelo.objects.order_by('pk').values_list('nombre', flat=True))
+        # dict.fromkeys: un mismo nombre de municipio en dos provincias es una sola opción
+        opciones_cliente.extend(dict.fromkeys(etiquetas))
+    return opciones_propiedad, opciones_cliente
+
+def huella_zonas(agencia, opciones_propiedad, opciones_cliente):
+    # Los IDs de los campos forman parte de la huella: si se cambian, hay que volver a enviar
+    contenido = json.dumps(
+        [agencia.zona_field_propiedad_id, agencia.zona_field_cliente_id, opciones_propiedad, opciones_cliente],
+        sort_keys=True, separators=(",", ":")
+    )
+    return hashlib.sha256(contenido.encode()).hexdigest()
+
+def _enviar(agencia, opciones_propiedad, opciones_cliente, huella):
+    """
+    Envía los dos desplegables de una agencia. Se ejecuta en un hilo del pool.
+    Devuelve True si GHL aceptó todo (y entonces se guarda la huella).
+    """
+    close_old_connections()
+    try:
+        location_id = agencia.location_id
+        token = get_valid_token(location_id)
+        if not token:
+            logger.error(f"❌ Sin token válido para {location_id}: zonas no sincronizadas")
+            return False
+
+        ok = True
+        if agencia.zona_field_propiedad_id:
+            url = f"https://services.leadconnectorhq.com/custom-fields/{agencia.zona_field_propiedad_id}/"
+            ok = ghlActualizarZonaAPI(location_id, opciones_propiedad, token, url, True) is not None and ok
+        if agencia.zona_field_cliente_id:
+            url = f"https://services.leadconnectorhq.com/locations/{location_id}/customFields/{agencia.zona_field_cliente_id}/"
+            ok = ghlActualizarZonaAPI(location_id, opciones_cliente, token, url, False) is not None and ok
+
+        if ok:
+            Agencia.objects.filter(pk=location_id).update(zonas_hash=huella)
+        return ok
+    except Exception:
+        logger.exception(f"❌ Excepción sincronizando zonas de {agencia.location_id}")
+        return False
+    finally:
+        close_old_connections()
+
+def sincronizar_zonas(max_concurrencia=None):
+    """
+    Envía las opciones de zona a las agencias que no las tienen al día, con como mucho
+    'max_concurrencia' agencias a la vez. Devuelve {'enviadas', 'sin_cambios', 'sin_campos', 'fallidas': [location_ids]}.
+    """
+    opciones_propiedad, opciones_cliente = opciones_zonas()
+
+    pendientes, sin_cambios, sin_campos = [], 0, 0
+    for agencia in Agencia.objects.only('location_id', 'zona_field_propiedad_id', 'zona_field_cliente_id', 'zonas_hash'):
+        if not agencia.zona_field_propiedad_id and not agencia.zona_field_cliente_id:
+            sin_campos += 1
+            continue
+        huella = huella_zonas(agencia, opciones_propiedad, opciones_cliente)
+        if huella == agencia.zonas_hash:
+            sin_cambios += 1
+            continue
+        pendientes.append((agencia, huella))
+
+    if sin_campos:
+        logger.warning(f"⚠️ {sin_campos} agencias sin IDs de custom field de zona: no se les envía nada")
+
+    fallidas = []
+    if pendientes:
+        logger.info(f"🗺️ Enviando zonas a {len(pendientes)} agencias ({sin_cambios} ya al día)")
+        concurrencia = max_concurrencia or settings.GHL_ZONAS_SYNC_CONCURRENCY
+        with ThreadPoolExecutor(max_workers=min(concurrencia, len(pendientes)), thread_name_prefix="ghl-zonas") as pool:
+            resultados = list(pool.map(
+                lambda pendiente: _enviar(pendiente[0], opciones_propiedad, opciones_cliente, pendiente[1]),
+                pendientes
+            ))
+        fallidas = [agencia.location_id for (agencia, _), ok in zip(pendientes, resultados) if not ok]
+
+    return {
+        'enviadas': len(pendientes) - len(fallidas),
+        'sin_cambios': sin_cambios,
+        'sin_campos': sin_campos,
+        'fallidas': fallidas,
+    }
@@ -1,68 +1,139 @@
-import threading
 import logging
-from .utils import ghl_associate_records, ghl_get_current_associations, ghl_delete_association, ghlActualizarZonaAPI
-from .models import Zona, Agencia, GHLToken
+from django.conf import settings
+from .utils import get_valid_token
+from .sync_engine import PeticionSync, sincronizar_asociaciones
+from .sync_zonas import sincronizar_zonas
+from .models import TareaGHL
+from .cola import encolar_coalescido, encolar_coalescidos
 
 
 logger = logging.getLogger(__name__)
 
-# MODIFICADO: Se añade 'association_id_val' a los argumentos
-def sync_associations_background(access_token, location_id, origin_record_id, target_ids_list, association_id_val, association_type="contact"):
-    
-    def _worker_process():
-        # 1. Obtener estado actual
-        current_map = ghl_get_current_associations(access_token, location_id, origin_record_id)
-        current_ids = set(current_map.keys()) 
-        target_ids = set(target_ids_list)
-        
-        # 2. Calcular diferencias
-        ids_to_add = target_ids - current_ids
-        ids_to_remove = current_ids - target_ids
-
-        logger.info(f"🔄 Sync Propiedad {origin_record_id}: +{len(ids_to_add)} | -{len(ids_to_remove)}")
-
-        # 3. Borrar excedentes
-        for contact_id in ids_to_remove:
-            rel_info = current_map.get(contact_id)
-            if rel_info and rel_info.get('id'):
-                ghl_delete_association(access_token, location_id, rel_info.get('id'))
-
-        # 4. Añadir faltantes
-        for contact_id in ids_to_add:
-            # MODIFICADO: Se pasa el ID dinámico a la función de utilidad
-            ghl_associate_records(access_token, location_id, origin_record_id, contact_id, association_id_val)
-
-    task_thread = threading.Thread(target=_worker_process)
-    task_thread.start()
+# --- ENCOLADO (lo que llaman los webhooks) ---
+
+def _fusionar_payload_sync(pendiente, nuevo):
+    """
+    Combina dos syncs de la misma propiedad. Un target set completo gana sobre
+    todo lo anterior; un delta se aplica encima de lo pendiente.
+    """
+    if nuevo.get("target_ids") is not None:
+        return nuevo
+
+    añadir, quitar = set(nuevo.get("add_ids", [])), set(nuevo.get("remove_ids", []))
+    fusionado = dict(nuevo)
+
+    if pendiente.get("target_ids") is not None:
+        fusionado["target_ids"] = sorted((set(pendiente["target_ids"]) | añadir) - quitar)
+        fusionado.pop("add_ids", None)
+        fusionado.pop("remove_ids", None)
+    else:
+        fusionado["add_ids"] = sorted((set(pendiente.get("add_ids", [])) - quitar) | añadir)
+        fusionado["remove_ids"] = sorted((set(pendiente.get("remove_ids", [])) - añadir) | quitar)
+    return fusionado
+
+def sync_associations_background(location_id, origin_record_id, target_ids_list=None, association_id_val=None, association_type="contact", add_ids=None, remove_ids=None):
+    """
+    Encola la sincronización de asociaciones de una propiedad con GHL.
+    Con 'target_ids_list' se sincroniza el conjunto completo; si no, solo el
+    delta 'add_ids' / 'remove_ids'.
+    El token se resuelve en el worker al ejecutar, así que no se guarda en la tabla.
+    Los syncs pendientes del mismo registro se fusionan en uno solo
+    (ver GHL_SYNC_COALESCE_SECONDS).
+    """
+    clave, payload = _tarea_sync(location_id, origin_record_id, target_ids_list, association_id_val, association_type, add_ids, remove_ids)
+    return encolar_coalescido(
+        TareaGHL.Tipo.SYNC_ASOCIACIONES,
+        clave=clave,
+        location_id=location_id,
+        ventana=settings.GHL_SYNC_COALESCE_SECONDS,
+        payload=payload,
+        fusionar=_fusionar_payload_sync
+    )
+
+def sync_associations_lote(location_id, association_id_val, syncs, association_type="contact"):
+    """
+    Igual que sync_associations_background() para muchas propiedades de una agencia
+    a la vez. 'syncs' es una lista de dicts con 'origin_record_id' y 'target_ids_list'
+    o 'add_ids' / 'remove_ids'. Devuelve el nº de tareas encoladas o fusionadas.
+    """
+    tareas = dict(
+        _tarea_sync(
+            location_id, sync["origin_record_id"], sync.get("target_ids_list"), association_id_val,
+            association_type, sync.get("add_ids"), sync.get("remove_ids")
+        )
+        for sync in syncs
+    )
+    if not tareas:
+        return 0
+    return encolar_coalescidos(
+        TareaGHL.Tipo.SYNC_ASOCIACIONES,
+        tareas,
+        location_id=location_id,
+        ventana=settings.GHL_SYNC_COALESCE_SECONDS,
+        fusionar=_fusionar_payload_sync
+    )
+
+def _tarea_sync(location_id, origin_record_id, target_ids_list, association_id_val, association_type, add_ids, remove_ids):
+    payload = {
+        "origin_record_id": origin_record_id,
+        "association_id": association_id_val,
+        "association_type": association_type,
+    }
+    if target_ids_list is not None:
+        payload["target_ids"] = list(target_ids_list)
+    else:
+        payload["add_ids"] = sorted(add_ids or [])
+        payload["remove_ids"] = sorted(remove_ids or [])
+    return f"sync:{location_id}:{origin_record_id}", payload
 
 def funcionAsyncronaZonas():
-    def actualizacionZonasAgencias():
-        opcionesPropiedad = []
-        opcionesCliente = []
-        for zona in Zona.objects.all():
-            label = zona.nombre             
-            value = label.lower().strip().replace(" ", "_")
-            
-            opcionesPropiedad.append({
-                "label": label,
-                "key": value
-            })
-            opcionesCliente.append(label)
-
-        # Estos dos de momento están hardcodeados, pero luego se ha de cambiar para que sea automatico y lo lea por agencia
-        idPropiedad = ["hS4cEeTEOSITPlkOyYx5","otsVf8GDT9QyqTeVbNs5"]
-        idCliente = ["kAMWAxQudbtRtEWWL4eE","dTS9Cyfwu7pbK28roBMK"]
-
-        for i, agencia in enumerate(Agencia.objects.all()):
-            locationId = agencia.location_id
-            if locationId:
-                token = GHLToken.objects.get(location_id = locationId).access_token
-                urlPropiedad = f"https://services.leadconnectorhq.com/custom-fields/{idPropiedad[i]}/"
-                urlCliente = f"https://services.leadconnectorhq.com/locations/{locationId}/customFields/{idCliente[i]}/"
-                ghlActualizarZonaAPI(locationId, opcionesPropiedad, token, urlPropiedad, True)
-                ghlActualizarZonaAPI(locationId, opcionesCliente, token, urlCliente, False)
-            else:
-                print("No existe location ID. Por lo que se presupone que no existe la agencia")
-
-    task_thread = threading.Thread(target=actualizacionZonasAgencias)
-    task_thread.start()
\ No newline at end of file
+    # Varias zonas creadas seguidas -> una sola tarea: el handler envía el estado actual
+    return encolar_coalescido(TareaGHL.Tipo.ZONAS, "zonas", ventana=settings.GHL_SYNC_COALESCE_SECONDS)
+
+
+# --- EJECUCIÓN (lo que llama el worker) ---
+# Cada handler lanza una excepción si algo falla para que la cola lo reintente.
+
+def ejecutar_sync_asociaciones(tarea):
+    location_id = tarea.location_id
+
+    access_token = get_valid_token(location_id)
+    if not access_token:
+        raise RuntimeError(f"No token valid found for {location_id}")
+
+    [resultado] = sincronizar_asociaciones([
+        PeticionSync(
+            location_id=location_id,
+            origin_record_id=tarea.payload["origin_record_id"],
+            association_id=tarea.payload["association_id"],
+            access_token=access_token,
+            target_ids=tarea.payload.get("target_ids"),
+            add_ids=tarea.payload.get("add_ids", []),
+            remove_ids=tarea.payload.get("remove_ids", []),
+        )
+    ])
+
+    if not resultado.ok:
+        raise RuntimeError(f"{len(resultado.failed)} operaciones fallidas sincronizando {resultado.origin_record_id}")
+
+def ejecutar_actualizacion_zonas(tarea):
+    # Solo se envía a las agencias cuyas opciones cambiaron; las que fallen hacen
+    # reintentar la tarea, y en el reintento las ya enviadas se saltan por su huella
+    resultado = sincronizar_zonas()
+    logger.info(
+        f"🗺️ Zonas: {resultado['enviadas']} agencias actualizadas, {resultado['sin_cambios']} sin cambios, "
+        f"{resultado['sin_campos']} sin campos configurados"
+    )
+    if resultado['fallidas']:
+        raise RuntimeError(f"Zonas no sincronizadas en {len(resultado['fallidas'])} agencias: {resultado['fallidas'][:10]}")
+
+HANDLERS = {
+    TareaGHL.Tipo.SYNC_ASOCIACIONES: ejecutar_sync_asociaciones,
+    TareaGHL.Tipo.ZONAS: ejecutar_actualizacion_zonas,
+}
+
+# Cómo fusionar el payload de una tarea fallida con la pendiente de su misma clave
+# (ver cola.reintentar_o_fallar). Sin entrada, gana el payload de la pendiente.
+FUSIONES = {
+    TareaGHL.Tipo.SYNC_ASOCIACIONES: _fusionar_payload_sync,
+}
@@ -1,3 +1,674 @@
-from django.test import TestCase
+import json
+import threading
+import time
+from datetime import datetime, timedelta, timezone as dt_timezone
+from decimal import Decimal
+from unittest import mock, skipIf
+from django.core.cache import cache
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from . import indice_match
+from .ambitos import resolver_ambitos, sincronizar_ambitos
+from .ghl_service import GHLClient, TokenBucket
+from .cola import encolar, reclamar, reintentar_o_fallar
+from .inbox import MAX_INTENTOS, procesar_bandeja, purgar_bandeja
+from .ingesta import datos_cliente, ingerir_clientes, procesar_lote, upsert_versionado, OBSOLETO
+from .matching import clientes_para_propiedad, propiedades_para_cliente, pares_match
+from .models import TareaGHL, WebhookInbox, GHLToken, Agencia, Provincia, Municipio, Zona, Propiedad, Cliente
+from .sync_engine import PeticionSync, sincronizar_asociaciones
+from .sync_zonas import huella_zonas, opciones_zonas, sincronizar_zonas
+from .tasks import sync_associations_background, FUSIONES
+from .utils import get_valid_token, invalidar_token_cache
+from .zonas import resolver_zona
 
-# Create your tests here.
+
+# --- COLA DE TAREAS ---
+
+class ColaTests(TestCase):
+
+    def _encolar(self, **kwargs):
+        return encolar(TareaGHL.Tipo.SYNC_ASOCIACIONES, location_id="LOC", **kwargs)
+
+    def _adelantar(self, campo):
+        # Simula que ha llegado la fecha guardada en 'campo'
+        TareaGHL.objects.update(**{campo: timezone.now() - timedelta(seconds=1)})
+
+    def test_reclamar_respeta_ejecutar_despues_y_lease(self):
+        lista = self._encolar()
+        self._encolar(retraso=60)
+
+        self.assertEqual([tarea.pk for tarea in reclamar(10, 300)], [lista.pk])
+        lista.refresh_from_db()
+        self.assertEqual((lista.estado, lista.intentos), (TareaGHL.Estado.EN_CURSO, 1))
+        # En curso con el lease vigente y la otra aún no lista: nada que reclamar
+        self.assertEqual(reclamar(10, 300), [])
+
+    def test_lease_caducado_se_vuelve_a_reclamar(self):
+        tarea = self._encolar()
+        reclamar(10, 300)
+        self._adelantar('bloqueada_hasta')
+
+        [reclamada] = reclamar(10, 300)
+        self.assertEqual((reclamada.pk, reclamada.intentos), (tarea.pk, 2))
+
+    def test_lease_caducado_con_intentos_agotados_falla(self):
+        self._encolar()
+        reclamar(10, 300)
+        TareaGHL.objects.update(max_intentos=1)
+        self._adelantar('bloqueada_hasta')
+
+        self.assertEqual(reclamar(10, 300), [])
+        self.assertEqual(TareaGHL.objects.get().estado, TareaGHL.Estado.FALLIDA)
+
+    def test_backoff_crece_hasta_fallida(self):
+        tarea = self._encolar()
+        esperas = []
+        with self.assertLogs("ghl_middleware.cola", "WARNING"):
+            for _ in range(tarea.max_intentos):
+                [reclamada] = reclamar(10, 300)
+                antes = timezone.now()
+                reintentar_o_fallar(reclamada, RuntimeError("GHL caído"))
+                tarea.refresh_from_db()
+                if tarea.estado == TareaGHL.Estado.PENDIENTE:
+                    esperas.append((tarea.ejecutar_despues - antes).total_seconds())
+                    self._adelantar('ejecutar_despues')
+
+        self.assertEqual(tarea.estado, TareaGHL.Estado.FALLIDA)
+        self.assertEqual(tarea.intentos, tarea.max_intentos)
+        self.assertEqual(len(esperas), tarea.max_intentos - 1)
+        # 10s, 20s, 40s... con un jitter de ±20%
+        self.assertTrue(all(b > a for a, b in zip(esperas, esperas[1:])), esperas)
+        self.assertAlmostEqual(esperas[0], 10, delta=2.5)
+
+
+@override_settings(GHL_SYNC_COALESCE_SECONDS=0)
+class ReintentoConPendienteTests(TestCase):
+
+    def test_fallo_con_otra_pendiente_de_la_misma_clave_se_fusiona(self):
+        # A se reclama (en curso) y, mientras se ejecuta, llega B para el mismo registro
+        sync_associations_background("LOC", "REC-1", association_id_val="ASSOC", add_ids=["c1"], remove_ids=["c2"])
+        [a] = reclamar(10, 300)
+        b = sync_associations_background("LOC", "REC-1", association_id_val="ASSOC", add_ids=["c3"])
+        self.assertNotEqual(a.pk, b.pk)
+
+        reintentar_o_fallar(a, RuntimeError("GHL caído"), fusionar=FUSIONES[a.tipo])
+
+        a.refresh_from_db()
+        b.refresh_from_db()
+        self.assertEqual(a.estado, TareaGHL.Estado.COMPLETADA)
+        self.assertIn(f"#{b.pk}", a.ultimo_error)
+        self.assertEqual(b.estado, TareaGHL.Estado.PENDIENTE)
+        # El delta de A no se pierde: queda aplicado debajo del de B
+        self.assertEqual(b.payload["add_ids"], ["c1", "c3"])
+        self.assertEqual(b.payload["remove_ids"], ["c2"])
+        self.assertEqual(TareaGHL.objects.filter(estado=TareaGHL.Estado.PENDIENTE).count(), 1)
+
+    def test_fallo_sin_otra_pendiente_vuelve_a_pendiente(self):
+        sync_associations_background("LOC", "REC-1", association_id_val="ASSOC", add_ids=["c1"])
+        [a] = reclamar(10, 300)
+
+        reintentar_o_fallar(a, RuntimeError("GHL caído"), fusionar=FUSIONES[a.tipo])
+
+        a.refresh_from_db()
+        self.assertEqual(a.estado, TareaGHL.Estado.PENDIENTE)
+        self.assertEqual(a.payload["add_ids"], ["c1"])
+
+
+# --- CLIENTE HTTP DE GHL ---
+
+@mock.patch("ghl_middleware.ghl_service.time.sleep")
+class GHLClientTests(SimpleTestCase):
+
+    def _cliente(self, *respuestas):
+        cliente = GHLClient(max_reintentos=3)
+        cliente.session = mock.Mock()
+        cliente.session.request.side_effect = list(respuestas)
+        return cliente
+
+    def _respuesta(self, status_code, **headers):
+        return mock.Mock(status_code=status_code, headers=headers)
+
+    def test_429_pausa_la_location_y_reintenta(self, dormir):
+        cliente = self._cliente(self._respuesta(429, **{"Retry-After": "2"}), self._respuesta(200))
+        with mock.patch.object(TokenBucket, "pausar", autospec=True) as pausar, self.assertLogs("ghl_middleware.ghl_service", "WARNING"):
+            response = cliente.get("/contacts/", location_id="LOC")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(cliente.session.request.call_count, 2)
+        pausar.assert_called_once_with(cliente.bucket("LOC"), 2.0)
+        dormir.assert_not_called()  # espera el cubo, no un sleep fijo
+
+    def test_5xx_para_tras_max_reintentos(self, dormir):
+        cliente = self._cliente(*[self._respuesta(503) for _ in range(4)])
+        with self.assertLogs("ghl_middleware.ghl_service", "WARNING"):
+            response = cliente.get("/contacts/", location_id="LOC")
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(cliente.session.request.call_count, 4)  # 1 + max_reintentos
+        self.assertEqual(dormir.call_count, 3)
+
+    def test_sin_reintentos_no_reintenta(self, dormir):
+        # Es lo que usa el refresh del token: repetirlo invalidaría el refresh_token
+        cliente = self._cliente(self._respuesta(503), self._respuesta(200))
+        response = cliente.post("/oauth/token", reintentos=0)
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(cliente.session.request.call_count, 1)
+        dormir.assert_not_called()
+
+    def test_cabeceras_rate_limit_ajustan_el_cubo(self, dormir):
+        cliente = self._cliente(self._respuesta(200, **{
+            "X-RateLimit-Max": "50", "X-RateLimit-Remaining": "3", "X-RateLimit-Interval-Milliseconds": "5000",
+        }))
+        cliente.get("/contacts/", location_id="LOC")
+
+        bucket = cliente.bucket("LOC")
+        self.assertEqual(bucket.capacidad, 50)
+        self.assertEqual(bucket.tasa, 10)
+        self.assertLessEqual(bucket.tokens, 3)
+
+
+# --- TOKENS DE GHL ---
+
+class TokenRefrescoTests(TransactionTestCase):
+    """
+    TransactionTestCase: los hilos usan su propia conexión y han de ver el token guardado.
+    """
+
+    def setUp(self):
+        invalidar_token_cache("LOC")
+        GHLToken.objects.create(location_id="LOC", access_token="viejo", refresh_token="r1", token_type="Bearer", scope="")
+        self.cliente_http = mock.Mock()
+        self.cliente_http.post.side_effect = self._refrescar
+
+    def tearDown(self):
+        invalidar_token_cache("LOC")
+
+    def _refrescar(self, *args, **kwargs):
+        time.sleep(0.05)  # el otro hilo llega mientras GHL responde
+        return mock.Mock(status_code=200, json=mock.Mock(return_value={"access_token": "nuevo", "refresh_token": "r2", "expires_in": 86400}))
+
+    def _caducar(self):
+        GHLToken.objects.update(updated_at=timezone.now() - timedelta(days=2))
+
+    def test_cache_no_consulta_la_bbdd(self):
+        self.assertEqual(get_valid_token("LOC"), "viejo")
+        with self.assertNumQueries(0):
+            self.assertEqual(get_valid_token("LOC"), "viejo")
+
+    def test_token_caducado_se_refresca_una_sola_vez(self):
+        self._caducar()
+        tokens = []
+
+        def pedir():
+            tokens.append(get_valid_token("LOC"))
+            connection.close()
+
+        with mock.patch("ghl_middleware.utils.get_ghl_client", return_value=self.cliente_http):
+            hilos = [threading.Thread(target=pedir) for _ in range(2)]
+            for hilo in hilos:
+                hilo.start()
+            for hilo in hilos:
+                hilo.join()
+            # Una tercera llamada ya sale de la caché
+            tokens.append(get_valid_token("LOC"))
+
+        self.assertEqual(tokens, ["nuevo"] * 3)
+        self.assertEqual(self.cliente_http.post.call_count, 1)
+        self.assertEqual(GHLToken.objects.get().refresh_token, "r2")
+
+
+# --- SYNC DE ASOCIACIONES ---
+
+class SyncAsociacionesTests(TestCase):
+
+    def _sync(self, cliente_http, **delta):
+        with mock.patch("ghl_middleware.utils.get_ghl_client", return_value=cliente_http):
+            [resultado] = sincronizar_asociaciones([
+                PeticionSync(location_id="LOC", origin_record_id="REC-1", association_id="ASSOC", access_token="tok", **delta)
+            ])
+        return resultado
+
+    def test_get_fallido_no_da_los_borrados_por_hechos(self):
+        cliente_http = mock.Mock()
+        cliente_http.get.return_value = mock.Mock(status_code=500)
+        resultado = self._sync(cliente_http, add_ids=["c1"], remove_ids=["c2"])
+        self.assertFalse(resultado.ok)
+        self.assertEqual(resultado.failed, ["c1", "c2"])
+        cliente_http.delete.assert_not_called()
+        cliente_http.post.assert_not_called()
+
+    def test_alta_ya_asociada_cuenta_como_hecha(self):
+        cliente_http = mock.Mock()
+        cliente_http.post.return_value = mock.Mock(status_code=400, text='{"message": "Relation already exists"}')
+        resultado = self._sync(cliente_http, add_ids=["c1"])
+        self.assertTrue(resultado.ok)
+        self.assertEqual(resultado.added, ["c1"])
+        cliente_http.get.assert_not_called()
+
+    def test_limite_por_location_compartido_entre_tareas(self):
+        # Dos tareas del worker a la vez (un hilo y un MotorSync cada una) contra la misma location
+        en_vuelo, maximo, lock = [0], [0], threading.Lock()
+
+        def asociar(*args):
+            with lock:
+                en_vuelo[0] += 1
+                maximo[0] = max(maximo[0], en_vuelo[0])
+            time.sleep(0.05)
+            with lock:
+                en_vuelo[0] -= 1
+            return True
+
+        def tarea(origen):
+            sincronizar_asociaciones([
+                PeticionSync(location_id="LOC-LIMITE", origin_record_id=origen, association_id="ASSOC", access_token="tok", add_ids=["c1", "c2", "c3"])
+            ], max_concurrencia_por_location=2)
+
+        with mock.patch("ghl_middleware.sync_engine.ghl_associate_records", side_effect=asociar):
+            hilos = [threading.Thread(target=tarea, args=(f"REC-{i}",)) for i in range(2)]
+            for hilo in hilos:
+                hilo.start()
+            for hilo in hilos:
+                hilo.join()
+        self.assertEqual(maximo[0], 2)
+
+
+# --- MATCHING ---
+
+class ArbolMatchingMixin:
+    """
+    Dos provincias con dos municipios y clientes interesados a todos los niveles.
+    Las señales crean los ámbitos y la tabla de cierre.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.agencia = Agencia.objects.create(location_id="LOC")
+        barcelona = Provincia.objects.create(nombre="Barcelona")
+        girona = Provincia.objects.create(nombre="Girona")
+        bcn = Municipio.objects.create(provincia=barcelona, nombre="Barcelona")
+        hospitalet = Municipio.objects.create(provincia=barcelona, nombre="Hospitalet")
+        gi = Municipio.objects.create(provincia=girona, nombre="Girona")
+        self.gracia = Zona.objects.create(municipio=bcn, nombre="Gràcia")
+        self.sants = Zona.objects.create(municipio=bcn, nombre="Sants")
+        self.centre = Zona.objects.create(municipio=hospitalet, nombre="Centre")
+        self.barri_vell = Zona.objects.create(municipio=gi, nombre="Barri Vell")
+
+        ambitos = {
+            "prov_bcn": barcelona.ambito, "muni_bcn": bcn.ambito, "sants": self.sants.ambito,
+            "prov_girona": girona.ambito, "centre": self.centre.ambito,
+        }
+        intereses = [
+            ["prov_bcn"], ["muni_bcn"], ["sants", "prov_girona"], ["sants", "prov_bcn"], ["centre"], [],
+        ]
+        for i, claves in enumerate(intereses):
+            cliente = Cliente.objects.create(
+                agencia=self.agencia, ghl_contact_id=f"C{i}", presupuesto_maximo=Decimal(300_000 + i * 50_000)
+            )
+            cliente.ambitos_interes.set([ambitos[clave].pk for clave in claves])
+
+        for i, zona in enumerate([self.gracia, self.sants, self.centre, self.barri_vell, None, self.sants]):
+            Propiedad.objects.create(
+                agencia=self.agencia, ghl_contact_id=f"P{i}", zona=zona, precio=Decimal(250_000 + i * 40_000),
+                habitaciones=2, metros=80
+            )
+
+
+class MatchingCoherenteTests(ArbolMatchingMixin, TestCase):
+
+    def _por_propiedad(self):
+        return {
+            (cliente_id, propiedad.pk)
+            for propiedad in Propiedad.objects.filter(estado=Propiedad.estadoPiso.ACTIVO)
+            for cliente_id in clientes_para_propiedad(propiedad).values_list('pk', flat=True)
+        }
+
+    def test_los_tres_caminos_dan_los_mismos_pares(self):
+        por_cliente = {
+            (cliente.pk, propiedad_id)
+            for cliente in Cliente.objects.all()
+            for propiedad_id in propiedades_para_cliente(cliente).values_list('pk', flat=True)
+        }
+        masivo = set(pares_match(self.agencia.pk))
+        self.assertTrue(masivo)
+        self.assertEqual(self._por_propiedad(), masivo)
+        self.assertEqual(por_cliente, masivo)
+
+    def test_provincia_cubre_todas_sus_zonas(self):
+        cliente = Cliente.objects.get(ghl_contact_id="C0")
+        zonas = set(propiedades_para_cliente(cliente).values_list('zona_id', flat=True))
+        self.assertEqual(zonas, {self.gracia.pk, self.sants.pk})  # Centre queda fuera de presupuesto
+
+    def test_propiedad_sin_zona_no_casa_con_nadie(self):
+        propiedad = Propiedad.objects.get(zona=None)
+        # El cliente C5 no tiene ningún ámbito: antes casaba solo por el camino del webhook
+        self.assertEqual(list(clientes_para_propiedad(propiedad)), [])
+        self.assertEqual(list(pares_match(self.agencia.pk, propiedades_ids=[propiedad.pk])), [])
+
+
+@skipIf(indice_match.np is None, "numpy no está instalado")
+@override_settings(GHL_MATCH_INDEX_MIN_CLIENTES=1, CACHE_COMPARTIDA=True)
+class IndiceMatchTests(ArbolMatchingMixin, TestCase):
+    """
+    El SQL (pares_match) es el oráculo del índice en memoria.
+    """
+
+    def setUp(self):
+        cache.clear()
+        indice_match._indices.clear()
+        super().setUp()
+
+    def _comparar_con_sql(self):
+        esperados = {}
+        for cliente_id, propiedad_id in pares_match(self.agencia.pk):
+            esperados.setdefault(propiedad_id, set()).add(cliente_id)
+        for propiedad in Propiedad.objects.filter(agencia=self.agencia, estado=Propiedad.estadoPiso.ACTIVO):
+            self.assertEqual(set(indice_match.clientes_match_ids(propiedad)), esperados.get(propiedad.pk, set()), propiedad)
+
+    def test_indice_igual_que_sql(self):
+        self._comparar_con_sql()
+
+    def test_indice_igual_que_sql_tras_cambios_incrementales(self):
+        self._comparar_con_sql()
+        cliente = Cliente.objects.get(ghl_contact_id="C5")
+        cliente.ambitos_interes.set([self.gracia.municipio.provincia.ambito.pk])
+        Cliente.objects.get(ghl_contact_id="C0").delete()
+        self._comparar_con_sql()
+
+    def test_cambio_incremental_de_cliente_sin_ambitos(self):
+        self._comparar_con_sql()
+        cliente = Cliente.objects.get(ghl_contact_id="C5")
+        cliente.presupuesto_maximo = Decimal(900_000)
+        cliente.save()
+        self._comparar_con_sql()
+
+    def test_indice_igual_que_sql_tras_mover_una_zona(self):
+        self._comparar_con_sql()
+        self.barri_vell.municipio = self.centre.municipio
+        self.barri_vell.save()
+        self._comparar_con_sql()
+
+    @override_settings(CACHE_COMPARTIDA=False)
+    def test_sin_cache_compartida_no_hay_indice(self):
+        self.assertFalse(indice_match.disponible())
+        self.assertIsNone(indice_match.clientes_match_ids(Propiedad.objects.first()))
+
+
+# --- INGESTA POR LOTES ---
+
+class LoteClientesTests(TestCase):
+
+    def test_cliente_sin_nombre_no_tumba_el_lote(self):
+        Agencia.objects.create(location_id="LOC")
+        registros = [
+            {"id": "C1", "location": {"id": "LOC"}, "customData": {"full_name": "Ana"}},
+            {"id": "C2", "location": {"id": "LOC"}, "customData": {"presupuesto": "300000"}},
+        ]
+        resultado = procesar_lote(registros, datos_cliente, ingerir_clientes)
+        self.assertEqual(resultado["status"], "success")
+        self.assertEqual(resultado["agencias"]["LOC"]["creados"], 2)
+        self.assertEqual(Cliente.objects.get(ghl_contact_id="C2").nombre, "Desconocido")
+
+
+# --- BANDEJA DE WEBHOOKS ---
+
+@override_settings(GHL_WEBHOOK_INBOX=True)
+class BandejaWebhooksTests(TestCase):
+
+    def setUp(self):
+        Agencia.objects.create(location_id="LOC")
+
+    def _payload(self, contact_id, **custom_data):
+        return {"id": contact_id, "location": {"id": "LOC"}, "customData": {"full_name": contact_id, **custom_data}}
+
+    def _recibir(self, payload, **headers):
+        return self.client.post("/webhooks/cliente/", payload, content_type="application/json", **headers)
+
+    def test_webhook_responde_202_y_guarda_la_entrada(self):
+        response = self._recibir(self._payload("C1"))
+        self.assertEqual(response.status_code, 202)
+        entrada = WebhookInbox.objects.get()
+        self.assertEqual((entrada.tipo, entrada.location_id, entrada.estado), (WebhookInbox.Tipo.CLIENTE, "LOC", WebhookInbox.Estado.PENDIENTE))
+        self.assertFalse(Cliente.objects.exists())
+
+    def test_reenvio_pendiente_no_inserta_nada(self):
+        self._recibir(self._payload("C1"))
+        self._recibir(self._payload("C1"))
+        self.assertEqual(WebhookInbox.objects.count(), 1)
+
+        self._recibir(self._payload("C2"), HTTP_IDEMPOTENCY_KEY="entrega-1")
+        self._recibir(self._payload("C2", presupuesto="1"), HTTP_IDEMPOTENCY_KEY="entrega-1")
+        self.assertEqual(WebhookInbox.objects.count(), 2)
+
+    def test_grupo_que_falla_reintenta_con_backoff_hasta_fallido(self):
+        self._recibir(self._payload("C1"))
+        with mock.patch("ghl_middleware.inbox.procesar_lote", side_effect=RuntimeError("BBDD caída")), \
+                self.assertLogs("ghl_middleware.inbox", "ERROR"):
+            antes = timezone.now()
+            procesar_bandeja()
+            entrada = WebhookInbox.objects.get()
+            self.assertEqual((entrada.estado, entrada.intentos), (WebhookInbox.Estado.PENDIENTE, 1))
+            self.assertGreater(entrada.procesar_despues, antes)
+            self.assertIn("BBDD caída", entrada.ultimo_error)
+
+            esperas = [entrada.procesar_despues - antes]
+            for intento in range(2, MAX_INTENTOS + 1):
+                # Se adelanta el backoff para no esperarlo
+                WebhookInbox.objects.update(procesar_despues=timezone.now() - timedelta(seconds=1))
+                antes = timezone.now()
+                procesar_bandeja()
+                entrada.refresh_from_db()
+                self.assertEqual(entrada.intentos, intento)
+                if entrada.estado == WebhookInbox.Estado.PENDIENTE:
+                    esperas.append(entrada.procesar_despues - antes)
+
+        self.assertEqual(entrada.estado, WebhookInbox.Estado.FALLIDO)
+        self.assertEqual(len(esperas), MAX_INTENTOS - 1)
+        self.assertGreater(esperas[-1], esperas[0])
+
+    def test_registro_invalido_solo_falla_su_entrada(self):
+        self._recibir(self._payload("C1"))
+        self._recibir({"location": {"id": "LOC"}, "customData": {"full_name": "Sin id"}})
+        self._recibir(self._payload("C2"))
+
+        self.assertEqual(procesar_bandeja(), 3)
+
+        estados = list(WebhookInbox.objects.order_by('id').values_list('estado', flat=True))
+        self.assertEqual(estados, [WebhookInbox.Estado.PROCESADO, WebhookInbox.Estado.FALLIDO, WebhookInbox.Estado.PROCESADO])
+        self.assertEqual(set(Cliente.objects.values_list('ghl_contact_id', flat=True)), {"C1", "C2"})
+
+    def test_purgar_conserva_las_fallidas(self):
+        self._recibir(self._payload("C1"))
+        self._recibir({"location": {"id": "LOC"}, "customData": {}})
+        procesar_bandeja()
+        WebhookInbox.objects.update(procesado_en=timezone.now() - timedelta(hours=48))
+
+        self.assertEqual(purgar_bandeja(24), 1)
+        self.assertEqual(list(WebhookInbox.objects.values_list('estado', flat=True)), [WebhookInbox.Estado.FALLIDO])
+
+
+# --- VERSIONADO DE ENTREGAS ---
+
+class UpsertVersionadoTests(TestCase):
+
+    def setUp(self):
+        self.agencia = Agencia.objects.create(location_id="LOC")
+        self.vieja = datetime(2026, 1, 1, tzinfo=dt_timezone.utc)
+        self.nueva = datetime(2026, 1, 2, tzinfo=dt_timezone.utc)
+
+    def test_entrega_nueva_creada_a_la_vez_gana_a_la_vieja(self):
+        # La entrega vieja lee "no existe" y, antes de crearlo, otra más nueva crea el registro
+        Cliente.objects.create(agencia=self.agencia, ghl_contact_id="C1", nombre="Nuevo", payload_hash="h2", ghl_updated_at=self.nueva)
+        bloquear = Cliente.objects.select_for_update
+        lecturas = []
+
+        def leer(*args):
+            lecturas.append(args)
+            return Cliente.objects.none() if len(lecturas) == 1 else bloquear(*args)
+
+        with mock.patch.object(Cliente.objects, "select_for_update", side_effect=leer):
+            antes, cliente, motivo = upsert_versionado(Cliente, self.agencia, "C1", {"nombre": "Viejo"}, "h1", self.vieja)
+
+        self.assertEqual(len(lecturas), 2)
+        self.assertEqual(motivo, OBSOLETO)
+        self.assertIsNone(cliente)
+        self.assertEqual(Cliente.objects.get(ghl_contact_id="C1").nombre, "Nuevo")
+
+    def test_entrega_vieja_tras_la_nueva_se_descarta(self):
+        upsert_versionado(Cliente, self.agencia, "C1", {"nombre": "Nuevo"}, "h2", self.nueva)
+        _, _, motivo = upsert_versionado(Cliente, self.agencia, "C1", {"nombre": "Viejo"}, "h1", self.vieja)
+        self.assertEqual(motivo, OBSOLETO)
+        self.assertEqual(Cliente.objects.get(ghl_contact_id="C1").nombre, "Nuevo")
+
+
+# --- WEBHOOKS ---
+
+@override_settings(GHL_WEBHOOK_INBOX=False, GHL_SYNC_COALESCE_SECONDS=0)
+class WebhookClienteTests(TestCase):
+
+    def _queries_webhook(self, n_propiedades):
+        location_id = f"LOC-{n_propiedades}"
+        agencia = Agencia.objects.create(location_id=location_id, association_type_id="ASSOC")
+        municipio = Municipio.objects.create(provincia=Provincia.objects.get_or_create(nombre="Barcelona")[0], nombre=location_id)
+        zona = Zona.objects.create(municipio=municipio, nombre=f"Zona {location_id}")
+        for i in range(n_propiedades):
+            Propiedad.objects.create(agencia=agencia, ghl_contact_id=f"{location_id}-P{i}", zona=zona, precio=100_000)
+
+        payload = {"id": f"{location_id}-C", "location": {"id": location_id}, "customData": {"zona_interes": zona.nombre, "presupuesto": "500000"}}
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post("/webhooks/cliente/", payload, content_type="application/json")
+        self.assertEqual(response.json()["matches_found"], n_propiedades)
+        self.assertEqual(TareaGHL.objects.filter(location_id=location_id).count(), n_propiedades)
+        return len(queries)
+
+    def test_syncs_encolados_en_un_solo_lote(self):
+        # Las consultas no crecen con el nº de propiedades afectadas
+        self.assertEqual(self._queries_webhook(2), self._queries_webhook(8))
+
+
+# --- ÁRBOL DE ZONAS ---
+
+class ArbolZonasTests(TestCase):
+    """
+    bulk_create no sube la versión del árbol: es el alta hecha en otro proceso.
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.municipio = Municipio.objects.create(provincia=Provincia.objects.create(nombre="Barcelona"), nombre="Barcelona")
+        Zona.objects.create(municipio=self.municipio, nombre="Gràcia")
+
+    def _zonas(self, response):
+        return response.json()["zonas"][0]["municipios"][0]["zonas"]
+
+    @override_settings(CACHE_COMPARTIDA=False)
+    def test_sin_cache_compartida_se_construye_siempre(self):
+        primera = self.client.get("/webhooks/zonasprovincia/")
+        self.assertNotIn("ETag", primera)
+        Zona.objects.bulk_create([Zona(municipio=self.municipio, nombre="Sants")])
+        segunda = self.client.get("/webhooks/zonasprovincia/", HTTP_IF_MODIFIED_SINCE=primera.get("Last-Modified", ""))
+        self.assertEqual(segunda.status_code, 200)
+        self.assertEqual(self._zonas(segunda), ["Gràcia", "Sants"])
+
+    @override_settings(CACHE_COMPARTIDA=True)
+    def test_con_cache_compartida_hay_etag_y_304(self):
+        primera = self.client.get("/webhooks/zonasprovincia/")
+        segunda = self.client.get("/webhooks/zonasprovincia/", HTTP_IF_NONE_MATCH=primera["ETag"])
+        self.assertEqual(segunda.status_code, 304)
+        Zona.objects.create(municipio=self.municipio, nombre="Sants")
+        tercera = self.client.get("/webhooks/zonasprovincia/", HTTP_IF_NONE_MATCH=primera["ETag"])
+        self.assertEqual(self._zonas(tercera), ["Gràcia", "Sants"])
+
+    def _arbol_completo(self):
+        Zona.objects.create(municipio=self.municipio, nombre="Sants")
+        girona = Provincia.objects.create(nombre="Girona")
+        Zona.objects.create(municipio=Municipio.objects.create(provincia=girona, nombre="Girona"), nombre="Barri Vell")
+        Municipio.objects.create(provincia=girona, nombre="Figueres")  # municipio sin zonas
+        Provincia.objects.create(nombre="Lleida")  # provincia sin municipios
+        return self.client.get("/webhooks/zonasprovincia/").json()
+
+    def _stream(self, modo):
+        with mock.patch("ghl_middleware.streaming.TAMANO_TROZO", 20):
+            response = self.client.get("/webhooks/zonasprovincia/", {"stream": modo})
+            return b"".join(response.streaming_content).decode()
+
+    def test_stream_json_igual_que_la_respuesta_normal(self):
+        esperado = self._arbol_completo()
+        self.assertEqual(json.loads(self._stream("json")), esperado)
+
+    def test_stream_ndjson_una_provincia_por_linea(self):
+        esperado = self._arbol_completo()
+        lineas = self._stream("ndjson").splitlines()
+        self.assertEqual([json.loads(linea) for linea in lineas], esperado["zonas"])
+
+
+# --- SINCRONIZACIÓN DE ZONAS CON GHL ---
+
+class SincronizarZonasTests(TransactionTestCase):
+    """
+    TransactionTestCase: cada agencia se envía desde un hilo del pool con su propia conexión.
+    """
+
+    def setUp(self):
+        Zona.objects.create(municipio=Municipio.objects.create(provincia=Provincia.objects.create(nombre="Barcelona"), nombre="Barcelona"), nombre="Gràcia")
+        campos = {"zona_field_propiedad_id": "FP", "zona_field_cliente_id": "FC"}
+        Agencia.objects.create(location_id="NUEVA", **campos)
+        Agencia.objects.create(location_id="CAIDA", **campos)
+        Agencia.objects.create(location_id="SIN_CAMPOS")
+        al_dia = Agencia.objects.create(location_id="AL_DIA", **campos)
+        al_dia.zonas_hash = huella_zonas(al_dia, *opciones_zonas())
+        al_dia.save()
+
+    def _sincronizar(self):
+        # GHL rechaza todo lo de CAIDA
+        def actualizar(location_id, *args):
+            return None if location_id == "CAIDA" else True
+
+        with mock.patch("ghl_middleware.sync_zonas.get_valid_token", return_value="tok"), \
+                mock.patch("ghl_middleware.sync_zonas.ghlActualizarZonaAPI", side_effect=actualizar) as api:
+            resultado = sincronizar_zonas(max_concurrencia=2)
+        return resultado, sorted({llamada.args[0] for llamada in api.call_args_list})
+
+    def _huella(self, location_id):
+        return Agencia.objects.get(pk=location_id).zonas_hash
+
+    def test_solo_se_envia_a_las_agencias_con_la_huella_cambiada(self):
+        huella_al_dia = self._huella("AL_DIA")
+        resultado, enviadas = self._sincronizar()
+
+        self.assertEqual(enviadas, ["CAIDA", "NUEVA"])
+        self.assertEqual(resultado, {'enviadas': 1, 'sin_cambios': 1, 'sin_campos': 1, 'fallidas': ["CAIDA"]})
+        self.assertEqual(self._huella("NUEVA"), huella_al_dia)
+        self.assertEqual(self._huella("AL_DIA"), huella_al_dia)
+        # Un envío fallido no guarda la huella: se reintenta en la siguiente pasada
+        self.assertEqual(self._huella("CAIDA"), "")
+
+        resultado, enviadas = self._sincronizar()
+        self.assertEqual(enviadas, ["CAIDA"])
+        self.assertEqual(resultado['sin_cambios'], 2)
+
+
+# --- RESOLUTORES DE NOMBRES ---
+
+class ResolutorOtroProcesoTests(TestCase):
+    """
+    bulk_create no lanza señales ni sube la versión del árbol: es lo que ve un
+    proceso con caché propia cuando la zona se crea en otro.
+    """
+
+    def setUp(self):
+        self.municipio = Municipio.objects.create(provincia=Provincia.objects.create(nombre="Barcelona"), nombre="Barcelona")
+        Zona.objects.create(municipio=self.municipio, nombre="Gràcia")
+
+    def test_zona_creada_en_otro_proceso_se_resuelve(self):
+        self.assertIsNone(resolver_zona("sant_andreu"))  # carga el mapa sin la zona
+        [zona] = Zona.objects.bulk_create([Zona(municipio=self.municipio, nombre="Sant Andreu")])
+        self.assertEqual(resolver_zona("sant_andreu"), zona.pk)
+
+    def test_ambito_creado_en_otro_proceso_se_resuelve(self):
+        self.assertEqual(resolver_ambitos(["Sant Andreu"]), [])
+        [zona] = Zona.objects.bulk_create([Zona(municipio=self.municipio, nombre="Sant Andreu")])
+        sincronizar_ambitos([zona.pk])
+        self.assertEqual(resolver_ambitos(["sant_andreu"]), [zona.ambito.pk])
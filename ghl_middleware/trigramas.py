@@ -0,0 +1,107 @@
+import re
+
+# Índice de trigramas en memoria con la misma idea que pg_trgm: cada palabra se
+# rellena ("  gracia ") y se trocea en grupos de 3 letras; dos palabras se parecen
+# según la proporción de trigramas que comparten. Sirve para buscar con errores
+# de escritura donde no hay Postgres (SQLite en desarrollo) y para el buscador de zonas.
+
+PALABRA = re.compile(r"[a-z0-9]+")
+
+# Palabras vacías que no aportan nada a la búsqueda (el texto ya viene normalizado, sin acentos)
+VACIAS = {"a", "al", "con", "de", "del", "el", "en", "la", "las", "los", "por", "un", "una", "y"}
+
+# Similitud mínima para aceptar una palabra como "la misma mal escrita" (el umbral por defecto de pg_trgm)
+UMBRAL = 0.3
+
+
+def palabras(texto):
+    """
+    Palabras de un texto ya normalizado (minúsculas y sin acentos, ver zonas.normalizar_nombre).
+    """
+    return [palabra for palabra in PALABRA.findall(texto) if palabra not in VACIAS]
+
+def trigramas(palabra):
+    relleno = f"  {palabra} "
+    return {relleno[i:i + 3] for i in range(len(relleno) - 2)}
+
+def similitud(trigramas_a, trigramas_b):
+    union = len(trigramas_a | trigramas_b)
+    return len(trigramas_a & trigramas_b) / union if union else 0.0
+
+
+class IndiceTrigramas:
+    """
+    Índice invertido palabra -> documentos, más trigrama -> palabras del vocabulario.
+    Una búsqueda solo compara contra el vocabulario (unos pocos miles de palabras
+    aunque haya cientos de miles de documentos) y después cruza listas de ids.
+    """
+
+    def __init__(self, documentos):
+        """
+        'documentos' es un iterable de (id, texto normalizado).
+        """
+        self._documentos = {}   # palabra -> {ids}
+        for doc_id, texto in documentos:
+            for palabra in palabras(texto):
+                self._documentos.setdefault(palabra, set()).add(doc_id)
+
+        self._trigramas = {}    # palabra -> trigramas
+        self._vocabulario = {}  # trigrama -> [palabras]
+        for palabra in self._documentos:
+            self._trigramas[palabra] = trigramas(palabra)
+            for trigrama in self._trigramas[palabra]:
+                self._vocabulario.setdefault(trigrama, []).append(palabra)
+
+    def _parecidas(self, termino):
+        """
+        {palabra del vocabulario: similitud} para las que superan el umbral.
+        """
+        buscados = trigramas(termino)
+        candidatas = set()
+        for trigrama in buscados:
+            candidatas.update(self._vocabulario.get(trigrama, ()))
+        parecidas = {}
+        for palabra in candidatas:
+            valor = similitud(buscados, self._trigramas[palabra])
+            if valor >= UMBRAL:
+                parecidas[palabra] = valor
+        return parecidas
+
+    def buscar(self, texto):
+        """
+        [(id, puntuación)] de los documentos que contienen todas las palabras buscadas
+        (o una parecida), de más a menos relevante; a igualdad, el id más alto primero.
+        La puntuación es la media, por palabra buscada, de la mejor similitud encontrada.
+        """
+        terminos = list(dict.fromkeys(palabras(texto)))
+        if not terminos:
+            return []
+
+        # El término más selectivo primero: los siguientes solo recorren los documentos
+        # que siguen en juego (intersección de sets) en vez de sus listas completas
+        parecidas = [self._parecidas(termino) for termino in terminos]
+        parecidas.sort(key=lambda palabras_termino: sum(len(self._documentos[palabra]) for palabra in palabras_termino))
+
+        puntuaciones = None
+        for palabras_termino in parecidas:
+            por_documento = {}
+            # De más a menos parecida: cada documento se queda con la mejor similitud
+            for palabra, valor in sorted(palabras_termino.items(), key=lambda item: -item[1]):
+                documentos = self._documentos[palabra]
+                if puntuaciones is not None:
+                    documentos = documentos & puntuaciones.keys() if len(documentos) < len(puntuaciones) else {
+                        doc_id for doc_id in puntuaciones if doc_id in documentos
+                    }
+                for doc_id in documentos:
+                    por_documento.setdefault(doc_id, valor)
+            if puntuaciones is None:
+                puntuaciones = por_documento
+            else:
+                puntuaciones = {doc_id: puntuaciones[doc_id] + valor for doc_id, valor in por_documento.items()}
+            if not puntuaciones:
+                return []
+
+        return sorted(
+            ((doc_id, total / len(terminos)) for doc_id, total in puntuaciones.items()),
+            key=lambda resultado: (-resultado[1], -resultado[0])
+        )
@@ -1,6 +1,6 @@
 from django.urls import path
 # Importamos también la vista del OAuth (GHLOAuthCallbackView) y la nueva GHLLaunchView
-from .views import WebhookPropiedadView, WebhookClienteView, GHLOAuthCallbackView
+from .views import WebhookPropiedadView, WebhookClienteView, WebhookPropiedadBatchView, WebhookClienteBatchView, GHLOAuthCallbackView
 from . import views
 urlpatterns = [
     
@@ -12,7 +12,10 @@ urlpatterns = [
     # --- 3. TUS WEBHOOKS DE NEGOCIO ---
     path('webhooks/propiedad/', WebhookPropiedadView.as_view(), name='webhook_propiedad'),
     path('webhooks/cliente/', WebhookClienteView.as_view(), name='webhook_cliente'),
+    path('webhooks/propiedad/batch/', WebhookPropiedadBatchView.as_view(), name='webhook_propiedad_batch'),
+    path('webhooks/cliente/batch/', WebhookClienteBatchView.as_view(), name='webhook_cliente_batch'),
     path('webhooks/zonasprovincia/', views.api_get_zonas_tree, name='get_zonas_tree'),
+    path('webhooks/zonasprovincia/buscar/', views.api_buscar_zonas, name='buscar_zonas'),
     path('webhooks/zonasprovincia/nuevo/', views.registrar_ubicacion, name='add_zonas_tree')
 ]
 
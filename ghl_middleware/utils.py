@@ -1,41 +1,104 @@
-import requests
 import logging
+import threading
 import time
 from datetime import timedelta
+from django.db import transaction
 from django.utils import timezone
 from django.conf import settings
 from .models import GHLToken
+from .ghl_service import get_ghl_client
 
 logger = logging.getLogger(__name__)
 
 # --- NUEVAS FUNCIONES PARA TOKEN AUTO-REFRESH ---
 
+# Margen de seguridad: un token se considera caducado 10 min antes de tiempo
+MARGEN_CADUCIDAD_SEGUNDOS = 600
+
+# Caché en memoria por proceso: location_id -> (access_token, caduca_en, leido_en)
+_tokens_cache = {}
+_tokens_locks = {}
+_tokens_locks_lock = threading.Lock()
+
+def _lock_location(location_id):
+    with _tokens_locks_lock:
+        return _tokens_locks.setdefault(location_id, threading.RLock())
+
+def _caducidad(token_obj, margen=MARGEN_CADUCIDAD_SEGUNDOS):
+    # Calculamos cuándo caduca (updated_at + expires_in) con el margen de seguridad
+    return token_obj.updated_at + timedelta(seconds=token_obj.expires_in - margen)
+
+def _guardar_en_cache(token_obj):
+    _tokens_cache[token_obj.location_id] = (token_obj.access_token, _caducidad(token_obj), time.monotonic())
+
+def _leer_cache(location_id):
+    entrada = _tokens_cache.get(location_id)
+    if not entrada:
+        return None
+    access_token, caduca_en, leido_en = entrada
+    if time.monotonic() - leido_en > settings.GHL_TOKEN_CACHE_TTL or timezone.now() > caduca_en:
+        return None
+    return access_token
+
+def invalidar_token_cache(location_id):
+    """Olvida el token cacheado (p. ej. tras reinstalar la app y guardar uno nuevo)."""
+    _tokens_cache.pop(location_id, None)
+
 def get_valid_token(location_id):
     """
     Recupera el token. Si ha caducado (o está a punto), lo refresca automáticamente.
+    Lectura desde caché en memoria; el refresco es "single-flight": un solo hilo
+    por proceso (lock) y un solo proceso (select_for_update) refresca cada location,
+    el resto espera y reutiliza el resultado.
     """
-    try:
-        token_obj = GHLToken.objects.get(location_id=location_id)
-    except GHLToken.DoesNotExist:
-        logger.error(f"❌ No se encontró token para location_id: {location_id}")
-        return None
+    access_token = _leer_cache(location_id)
+    if access_token:
+        return access_token
+
+    with _lock_location(location_id):
+        # Otro hilo puede haberlo cargado/refrescado mientras esperábamos
+        access_token = _leer_cache(location_id)
+        if access_token:
+            return access_token
+
+        try:
+            token_obj = GHLToken.objects.get(location_id=location_id)
+        except GHLToken.DoesNotExist:
+            logger.error(f"❌ No se encontró token para location_id: {location_id}")
+            invalidar_token_cache(location_id)
+            return None
+
+        if timezone.now() <= _caducidad(token_obj):
+            _guardar_en_cache(token_obj)
+            return token_obj.access_token
 
-    # Calculamos cuándo caduca (updated_at + expires_in)
-    # Le restamos 600 segundos (10 min) de margen de seguridad para no apurar
-    expiration_time = token_obj.updated_at + timedelta(seconds=token_obj.expires_in - 600)
-    
-    if timezone.now() > expiration_time:
         logger.info(f"🔄 El token de {location_id} ha caducado. Refrescando...")
-        return refresh_ghl_token(token_obj)
-    
-    # Si es válido, devolvemos el access_token actual
-    return token_obj.access_token
+        return refrescar_token_si_caduca(location_id)
+
+def refrescar_token_si_caduca(location_id, horizonte_segundos=MARGEN_CADUCIDAD_SEGUNDOS):
+    """
+    Refresca el token si caduca dentro de 'horizonte_segundos'. Mismo single-flight
+    que get_valid_token; lo usa también el comando refresh_ghl_tokens.
+    """
+    with _lock_location(location_id):
+        with transaction.atomic():
+            # Bloqueamos la fila: si otro proceso está refrescando, esperamos a que acabe
+            try:
+                token_obj = GHLToken.objects.select_for_update().get(location_id=location_id)
+            except GHLToken.DoesNotExist:
+                invalidar_token_cache(location_id)
+                return None
+
+            if timezone.now() <= _caducidad(token_obj, horizonte_segundos):
+                _guardar_en_cache(token_obj)
+                return token_obj.access_token
+
+            return refresh_ghl_token(token_obj)
 
 def refresh_ghl_token(token_obj):
     """
     Solicita un nuevo access_token a GHL usando el refresh_token guardado.
     """
-    url = "https://services.leadconnectorhq.com/oauth/token"
     payload = {
         'client_id': settings.GHL_CLIENT_ID,
         'client_secret': settings.GHL_CLIENT_SECRET,
@@ -45,7 +108,8 @@ def refresh_ghl_token(token_obj):
     }
     
     try:
-        response = requests.post(url, data=payload, timeout=10)
+        # Sin reintentos: repetir un refresh que GHL sí procesó invalidaría el refresh_token
+        response = get_ghl_client().post("/oauth/token", data=payload, reintentos=0)
         new_data = response.json()
         
         if response.status_code == 200:
@@ -54,6 +118,7 @@ def refresh_ghl_token(token_obj):
             token_obj.refresh_token = new_data.get('refresh_token')
             token_obj.expires_in = new_data.get('expires_in', 86400)
             token_obj.save() # Esto actualiza 'updated_at' automáticamente
+            _guardar_en_cache(token_obj)
             logger.info(f"✅ Token refrescado correctamente para {token_obj.location_id}")
             return token_obj.access_token
         else:
@@ -67,15 +132,16 @@ def refresh_ghl_token(token_obj):
 # --- FUNCIONES EXISTENTES (Asociaciones) ---
 
 def ghl_get_current_associations(access_token, location_id, property_id):
-    time.sleep(0.5)
-    headers = { "Authorization": f"Bearer {access_token}", "Version": "2021-07-28", "Accept": "application/json" }
-    
-    url = f"https://services.leadconnectorhq.com/associations/relations/{property_id}"
+    """
+    {contact_id: relación} de la propiedad. Si GHL falla lanza excepción: un mapa
+    vacío haría que los borrados se dieran por buenos sin haberse hecho.
+    """
+    url = f"/associations/relations/{property_id}"
     params = { "locationId": location_id }
     found_relations_map = {}
 
     try:
-        response = requests.get(url, headers=headers, params=params, timeout=10)
+        response = get_ghl_client().get(url, access_token=access_token, location_id=location_id, params=params)
         if response.status_code == 200:
             data = response.json()
             relations_list = data.get('relations', [])
@@ -94,35 +160,23 @@ def ghl_get_current_associations(access_token, location_id, property_id):
         elif response.status_code == 404:
              return {}
         else:
-            logger.error(f"⚠️ Error GHL GET Associations: {response.status_code}")
-            return {}
+            raise RuntimeError(f"GET Associations de {property_id} respondió {response.status_code}")
     except Exception as e:
         logger.error(f"❌ Excepción GET Associations: {str(e)}")
-        return {}
+        raise
 
 def ghl_delete_association(access_token, location_id, relation_id):
-    time.sleep(0.2)
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-        "Version": "2021-07-28",
-        "Content-Type": "application/json",
-        "Accept": "application/json"
-    }
-    url = f"https://services.leadconnectorhq.com/associations/relations/{relation_id}"
+    url = f"/associations/relations/{relation_id}"
     params = { "locationId": location_id }
 
     try:
-        response = requests.delete(url, headers=headers, params=params, timeout=10)
+        response = get_ghl_client().delete(url, access_token=access_token, location_id=location_id, params=params)
         return response.status_code in [200, 204]
     except Exception as e:
         logger.error(f"❌ Excepción DELETE Association: {str(e)}")
         return False
 
 def ghl_associate_records(access_token, location_id, property_id, contact_id, association_id):
-    time.sleep(0.2)
-    headers = { "Authorization": f"Bearer {access_token}", "Version": "2021-07-28", "Content-Type": "application/json", "Accept": "application/json" }
-    url = "https://services.leadconnectorhq.com/associations/relations"
-    
     payload = {
         "locationId": location_id,
         "associationId": association_id, 
@@ -131,8 +185,11 @@ def ghl_associate_records(access_token, location_id, property_id, contact_id, as
     }
 
     try:
-        response = requests.post(url, json=payload, headers=headers, timeout=10)
-        return response.status_code in [200, 201]
+        response = get_ghl_client().post("/associations/relations", access_token=access_token, location_id=location_id, json=payload)
+        if response.status_code in [200, 201]:
+            return True
+        # Los deltas de alta no consultan antes a GHL: si la relación ya existía, el alta está hecha
+        return response.status_code in [400, 409, 422] and "already" in response.text.lower()
     except:
         return False
 
@@ -142,15 +199,8 @@ def get_association_type_id(access_token, location_id, object_key="propiedad"):
     Busca el ID de asociación entre Contacto y el Custom Object.
     MEJORA: Ahora busca 'propiedad', 'propiedades' y 'custom_objects.propiedades'.
     """
-    url = "https://services.leadconnectorhq.com/associations/types"
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-        "Version": "2021-07-28",
-        "Accept": "application/json"
-    }
-    
     try:
-        response = requests.get(url, headers=headers, params={"locationId": location_id}, timeout=10)
+        response = get_ghl_client().get("/associations/types", access_token=access_token, location_id=location_id, params={"locationId": location_id})
         
         if response.status_code == 200:
             types = response.json().get('associationTypes', [])
@@ -198,42 +248,36 @@ def get_association_type_id(access_token, location_id, object_key="propiedad"):
         return None
 
 def ghlActualizarZonaAPI(locationId, opciones, token, url, prop):
-    headers = {
-        "Authorization": f"Bearer {token}",
-        "Version": "2021-07-28",
-        "Content-Type": "application/json",
-        "Accept": "application/json"
-    }
-    print(f'"options":{opciones}')
+    logger.debug(f"🗺️ {locationId}: {len(opciones)} opciones de zona -> {url}")
     try:
         # Enviamos la petición
         if prop:
-            response = requests.put(
+            response = get_ghl_client().put(
                 url, 
-                headers=headers, 
+                access_token=token,
+                location_id=locationId,
                 json={
                     "locationId":locationId,
                     "showInForms": True,
                     "options":opciones
-                    },  
-                timeout=10
+                    }
             )
         else:
-            response = requests.put(
+            response = get_ghl_client().put(
                 url, 
-                headers=headers, 
-                json={"options":opciones}, 
-                timeout=10
+                access_token=token,
+                location_id=locationId,
+                json={"options":opciones}
             )
         
         # Verificamos si GHL aceptó el cambio (200 OK o 204 No Content)
         if response.status_code in [200, 204]:
-            print("✅ Actualización exitosa")
+            logger.info(f"✅ Zonas actualizadas en {locationId}")
             return response.json() if response.text else True
         else:
-            print(f"❌ Error {response.status_code}: {response.text}")
+            logger.error(f"❌ Error {response.status_code} actualizando zonas de {locationId}: {response.text[:500]}")
             return None
 
     except Exception as e:
-        print(f"💥 Error de conexión: {e}")
+        logger.error(f"💥 Error de conexión actualizando zonas de {locationId}: {e}")
         return None
\ No newline at end of file
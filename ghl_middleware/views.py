@@ -6,15 +6,30 @@ from django.shortcuts import get_object_or_404
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
-from django.db.models import Q
-from django.http import JsonResponse
+from django.http import JsonResponse, HttpResponse
+from django.views.decorators.http import condition
+from django.core.serializers.json import DjangoJSONEncoder
 
 from django.views.decorators.csrf import csrf_exempt
-from .models import Agencia, Propiedad, Cliente, GHLToken
-from .tasks import sync_associations_background, funcionAsyncronaZonas
+from .models import Agencia, Propiedad, Cliente, GHLToken, WebhookInbox
+from .tasks import sync_associations_background, sync_associations_lote, funcionAsyncronaZonas
 # IMPORTANTE: AÑADIDA LA NUEVA FUNCIÓN A LOS IMPORTS
-from .utils import get_valid_token, get_association_type_id 
+from .utils import get_association_type_id, invalidar_token_cache
+from .matching import (
+    interesados_por_propiedad, valores_match, IGUAL, MIXTO,
+    CAMPOS_MATCH_PROPIEDAD, CAMPOS_MATCH_CLIENTE, direccion_cambio_propiedad, direccion_cambio_cliente,
+    actualizar_matches_propiedad, actualizar_matches_cliente
+)
 from .models import Provincia, Municipio, Zona
+from .zonas import arbol_zonas_json, iterar_arbol_zonas, buscar_zonas, etag_arbol_zonas, last_modified_arbol_zonas, resolver_zona
+from .ambitos import resolver_ambitos
+from .streaming import modo_stream, respuesta_stream
+from .inbox import guardar_en_bandeja
+from .ingesta import (
+    clean_currency, clean_int, preferenciasTraductor1, preferenciasTraductor2, estadoPropTrad, guardadorURL,
+    datos_propiedad, datos_cliente, procesar_lote, ingerir_propiedades, ingerir_clientes, MAX_REGISTROS_LOTE,
+    fecha_payload, huella_payload, upsert_versionado
+)
 
 logger = logging.getLogger(__name__)
 
@@ -24,48 +39,6 @@ class HomeView(APIView):
     def get(self, request):
         return Response({"message": "Server is running 🚀"}, status=200)
 
-def clean_currency(value):
-    if not value: return 0.0
-    try: return float(str(value).replace('$', '').replace(',', '').strip())
-    except ValueError: return 0.0
-
-def clean_int(value):
-    if not value: return 0
-    try: return int(float(str(value)))
-    except ValueError: return 0
-
-def preferenciasTraductor1(value):
-    mapa = {
-        "si": Cliente.Preferencias1.SI,
-        "no": Cliente.Preferencias1.NO,
-    }
-    value = (value or "").lower()
-    return mapa.get(value, Cliente.Preferencias1.NO)
-
-def preferenciasTraductor2(value):
-    mapa = {
-        "si": Cliente.Preferencias2.SI,
-        "indiferente": Cliente.Preferencias2.IND
-    }
-    value = value.lower()
-    return mapa.get(value, Cliente.Preferencias2.IND)
-
-def estadoPropTrad(value):
-    mapa = {
-        "vendido": Propiedad.estadoPiso.VENDIDO,
-        "a la venta": Propiedad.estadoPiso.ACTIVO,
-        "no es oficial": Propiedad.estadoPiso.NoOficial
-    }
-    value = str(value or "").replace("_"," ").lower()
-    return mapa.get(value, Propiedad.estadoPiso.NoOficial)
-
-def guardadorURL(value):
-    lista = []
-    if value and value != "null":
-        if isinstance(value, list):
-            lista = [data.get('url') for data in value if isinstance(data, dict) and data.get('url')]
-    return lista
-
 # -------------------------------------------------------------------------
 # VISTA 1: OAUTH CALLBACK (MODIFICADA PARA AUTO-DETECTAR ID)
 # -------------------------------------------------------------------------
@@ -101,6 +74,7 @@ class GHLOAuthCallbackView(APIView):
                         'scope': tokens['scope']
                     }
                 )
+                invalidar_token_cache(location_id)
                 
                 # 2. Crear Agencia si no existe
                 agencia, created = Agencia.objects.get_or_create(location_id=location_id, defaults={'active': True})
@@ -137,92 +111,80 @@ class WebhookPropiedadView(APIView):
     def post(self, request):
         data = request.data
         logger.info(f"📥 Webhook Propiedad: {data}")
+
+        if settings.GHL_WEBHOOK_INBOX:
+            # Modo bandeja: se guarda el payload crudo y se responde al momento
+            guardar_en_bandeja(WebhookInbox.Tipo.PROPIEDAD, data, request.headers.get('Idempotency-Key'))
+            return Response({'status': 'accepted'}, status=202)
         
-        custom_data = data.get('customData', {})
-        location_data = data.get('location', {})
-        location_id = location_data.get('id') or custom_data.get('location_id')
+        location_id, ghl_record_id, prop_data, zona = datos_propiedad(data)
         
         if not location_id:
             return Response({'error': 'Missing location_id'}, status=400)
             
         agencia = get_object_or_404(Agencia, location_id=location_id)
-        ghl_record_id = custom_data.get('contact_id') or data.get('id')
         
         if not ghl_record_id:
              return Response({'error': 'Missing Record ID'}, status=400)
 
-        prop_data = {
-            'agencia': agencia, 
-            'ghl_contact_id': ghl_record_id,
-            'precio': clean_currency(custom_data.get('precio') or data.get('precio')),
-            'habitaciones': clean_int(custom_data.get('habitaciones') or data.get('habitaciones')),
-            'estado': estadoPropTrad(custom_data.get("estado")),
-            'animales': preferenciasTraductor1(custom_data.get('animales')),        
-            'metros': clean_int(custom_data.get('metros')),        
-            'balcon': preferenciasTraductor1(custom_data.get('balcon')),        
-            'garaje': preferenciasTraductor1(custom_data.get('garaje')),
-            'patioInterior': preferenciasTraductor1(custom_data.get('patioInterior')),
-            'imagenesUrl':guardadorURL(custom_data.get('imagenesUrl')),
-        }
-        
-        propiedad, created = Propiedad.objects.update_or_create(
-            agencia=agencia, 
-            ghl_contact_id=ghl_record_id, 
-            defaults=prop_data
-        )
+        # Versión de esta entrega: huella de los campos y dateUpdated (o fecha de recepción)
+        huella = huella_payload(prop_data, zona)
+        fecha = fecha_payload(data)
 
-        zona = custom_data.get("zona")
+        # La zona se resuelve en memoria (sin query) y se guarda en el mismo upsert
         if (zona):
-            zonaLimpio = zona.replace("_"," ").lower().strip()
-            zonaObj = Zona.objects.filter(nombre__iexact=zonaLimpio).first()
-            if (zonaObj):
-                propiedad.zona = zonaObj
-                propiedad.save()
+            zona_id = resolver_zona(zona)
+            if (zona_id):
+                prop_data['zona_id'] = zona_id
+
+        # Upsert con la fila bloqueada: 'antes' son los valores guardados, para saber qué ha cambiado.
+        # Reenvíos y entregas desordenadas se descartan antes de escribir nada
+        antes, propiedad, motivo = upsert_versionado(
+            Propiedad, agencia, ghl_record_id, prop_data, huella, fecha, CAMPOS_MATCH_PROPIEDAD
+        )
+        if motivo:
+            logger.info(f"⏭️ Entrega {motivo} de la propiedad {ghl_record_id} descartada")
+            return Response({'status': 'success', 'ignored': motivo})
 
         # Añadir que solo se haga el match si es estado = activo
         if (propiedad.estado == Propiedad.estadoPiso.ACTIVO):
-            # 1. BUSCAR NUEVOS MATCHES
-            clientes_match = Cliente.objects.filter(
-                Q(animales = Cliente.Preferencias1.NO) if propiedad.animales == Propiedad.Preferencias1.NO else Q(),
-                Q(balcon = Cliente.Preferencias2.IND) if propiedad.balcon == Propiedad.Preferencias1.NO else Q(),
-                Q(garaje = Cliente.Preferencias2.IND) if propiedad.garaje == Propiedad.Preferencias1.NO else Q(),
-                Q(patioInterior = Cliente.Preferencias2.IND) if propiedad.patioInterior == Propiedad.Preferencias1.NO else Q(),
-
-                agencia=agencia,
-                zona_interes=propiedad.zona,
-                presupuesto_maximo__gte=propiedad.precio,
-                habitaciones_minimas__lte=propiedad.habitaciones,
-                metrosMinimo__lte=propiedad.metros
-            ).distinct()
-
-            # 2. ACTUALIZACIÓN LOCAL
-            propiedad.interesados.clear() 
-            for cliente in clientes_match:
-                cliente.propiedades_interes.add(propiedad)
+            # 1. MATCHING INCREMENTAL: si no cambió nada relevante no se recalcula;
+            # si el cambio solo puede añadir (o quitar) clientes, solo se evalúa ese sentido
+            direccion = direccion_cambio_propiedad(antes, valores_match(propiedad, CAMPOS_MATCH_PROPIEDAD))
+            if direccion == IGUAL:
+                logger.info(f"⏭️ Propiedad {ghl_record_id} sin cambios relevantes para el matching")
+                return Response({'status': 'success', 'matches_found': propiedad.interesados.count()})
+
+            # 2. ACTUALIZACIÓN LOCAL (solo el delta, en una transacción)
+            añadidos, quitados = actualizar_matches_propiedad(propiedad, direccion)
 
             # 3. SINCRONIZACIÓN CON GHL
-            matches_count = clientes_match.count()
+            matches_count = propiedad.interesados.count()
             
-            if matches_count >= 0: 
+            if direccion == MIXTO or añadidos or quitados: 
                 # VALIDAR ID DE ASOCIACIÓN
                 if not agencia.association_type_id:
                     logger.warning(f"⚠️ Agencia {location_id} no tiene 'association_type_id'. Cruzado saltado.")
                     return Response({'status': 'warning', 'msg': 'Falta Association ID', 'matches_found': matches_count})
 
-                access_token = get_valid_token(location_id)
-                
-                if access_token:
-                    target_ids = [c.ghl_contact_id for c in clientes_match]
-                    
+                # Solo se encola: el worker resuelve el token y llama a GHL.
+                # Recálculo completo -> conjunto completo; incremental -> solo el delta.
+                if direccion == MIXTO:
                     sync_associations_background(
-                        access_token=access_token,
                         location_id=location_id,
                         origin_record_id=propiedad.ghl_contact_id,
-                        target_ids_list=target_ids, 
+                        target_ids_list=interesados_por_propiedad([propiedad.pk])[propiedad.pk], 
                         association_id_val=agencia.association_type_id 
                     )
                 else:
-                    logger.warning(f"⚠️ No token valid found for {location_id}")
+                    ghl_ids = dict(Cliente.objects.filter(pk__in=añadidos | quitados).values_list('pk', 'ghl_contact_id'))
+                    sync_associations_background(
+                        location_id=location_id,
+                        origin_record_id=propiedad.ghl_contact_id,
+                        association_id_val=agencia.association_type_id,
+                        add_ids=[ghl_ids[pk] for pk in añadidos],
+                        remove_ids=[ghl_ids[pk] for pk in quitados]
+                    )
 
             return Response({'status': 'success', 'matches_found': matches_count})
         return Response({'status': 'success'})
@@ -237,114 +199,143 @@ class WebhookClienteView(APIView):
     def post(self, request):
         data = request.data
         logger.info(f"📥 Webhook Cliente: {data}")
+
+        if settings.GHL_WEBHOOK_INBOX:
+            # Modo bandeja: se guarda el payload crudo y se responde al momento
+            guardar_en_bandeja(WebhookInbox.Tipo.CLIENTE, data, request.headers.get('Idempotency-Key'))
+            return Response({'status': 'accepted'}, status=202)
         
-        custom_data = data.get('customData', {}) 
-        location_data = data.get('location', {})
-        location_id = location_data.get('id') or custom_data.get('location_id')
+        location_id, ghl_contact_id, cliente_data, zona_nombre = datos_cliente(data)
     
         if not location_id: return Response({'error': 'Missing location_id'}, status=400)
             
         agencia = get_object_or_404(Agencia, location_id=location_id)
-        ghl_contact_id = data.get('id') or custom_data.get('contact_id')
         if not ghl_contact_id: return Response({'error': 'Missing Contact ID'}, status=400)
 
-        cliente_data = {
-            'agencia': agencia, 
-            'ghl_contact_id': ghl_contact_id,
-            'nombre': custom_data.get('full_name'),
-            'presupuesto_maximo': clean_currency(custom_data.get('presupuesto') or data.get('presupuesto')),
-            'habitaciones_minimas': clean_int(custom_data.get('habitaciones') or data.get('habitaciones_min')),
-            'animales': preferenciasTraductor1(custom_data.get('animales')),        
-            'metrosMinimo': clean_int(custom_data.get('metros')),        
-            'balcon': preferenciasTraductor2(custom_data.get('balcon')),        
-            'garaje': preferenciasTraductor2(custom_data.get('garaje')),
-            'patioInterior': preferenciasTraductor2(custom_data.get('patioInterior')), 
-        }
+        # Versión de esta entrega: huella de los campos y dateUpdated (o fecha de recepción)
+        huella = huella_payload(cliente_data, zona_nombre)
+        fecha = fecha_payload(data)
 
-        cliente, created = Cliente.objects.update_or_create(
-            agencia=agencia, 
-            ghl_contact_id=ghl_contact_id, 
-            defaults=cliente_data
+        # Upsert con la fila bloqueada: 'antes' son los valores guardados, para saber qué ha cambiado.
+        # Reenvíos y entregas desordenadas se descartan antes de escribir nada
+        antes, cliente, motivo = upsert_versionado(
+            Cliente, agencia, ghl_contact_id, cliente_data, huella, fecha, CAMPOS_MATCH_CLIENTE
         )
-
-        zona_nombre = custom_data.get("zona_interes")
+        if motivo:
+            logger.info(f"⏭️ Entrega {motivo} del cliente {ghl_contact_id} descartada")
+            return Response({'status': 'success', 'ignored': motivo})
+        ambitos_antes = set(
+            Cliente.ambitos_interes.through.objects.filter(cliente_id=antes['pk']).values_list('ambitogeografico_id', flat=True)
+        ) if antes else set()
+
+        # Zonas, municipios o provincias: cada nombre se resuelve a su ámbito geográfico
+        ambitos_despues = ambitos_antes
         if (zona_nombre):
-            zona_lista = [z.strip() for z in str(zona_nombre).split(",")]
-            zonas = Zona.objects.filter(nombre__in = zona_lista)
-            cliente.zona_interes.set(zonas)
-            cliente.save()
-
-        # 1. BUSCAR MATCHES
-        propiedades_match = Propiedad.objects.filter(
-            Q(animales = Propiedad.Preferencias1.SI) if cliente.animales == Cliente.Preferencias1.SI else Q(),
-            Q(balcon = Propiedad.Preferencias1.SI) if cliente.balcon == Cliente.Preferencias2.SI else Q(),
-            Q(garaje = Propiedad.Preferencias1.SI) if cliente.garaje == Cliente.Preferencias2.SI else Q(),
-            Q(patioInterior = Propiedad.Preferencias1.SI) if cliente.garaje == Cliente.Preferencias2.SI else Q(),
-
-            agencia=agencia,
-            precio__lte=cliente.presupuesto_maximo,
-            habitaciones__gte=cliente.habitaciones_minimas,
-            metros__gte = cliente.metrosMinimo,
-            estado='activo',
-            zona__in = cliente.zona_interes.all()
-        ).distinct()
-
-        # 2. ACTUALIZACIÓN LOCAL
-        cliente.propiedades_interes.clear()
-        for prop in propiedades_match:
-            cliente.propiedades_interes.add(prop)
+            zona_lista = str(zona_nombre).split(",")
+            ambitos_despues = set(resolver_ambitos(zona_lista))
+            if ambitos_despues != ambitos_antes:
+                cliente.ambitos_interes.set(ambitos_despues)
+
+        # 1. MATCHING INCREMENTAL: si no cambió nada relevante (p. ej. solo el nombre)
+        # no se recalcula; si el cambio solo puede añadir (o quitar) propiedades,
+        # solo se evalúa ese sentido
+        direccion = direccion_cambio_cliente(
+            antes, valores_match(cliente, CAMPOS_MATCH_CLIENTE), ambitos_antes, ambitos_despues
+        )
+        if direccion == IGUAL:
+            logger.info(f"⏭️ Cliente {ghl_contact_id} sin cambios relevantes para el matching")
+            return Response({'status': 'success', 'matches_found': cliente.propiedades_interes.count()})
+
+        # 2. ACTUALIZACIÓN LOCAL (solo el delta, en una transacción)
+        añadidas, quitadas = actualizar_matches_cliente(cliente, direccion)
             
         # 3. SINCRONIZACIÓN CON GHL
-        matches_count = propiedades_match.count()
-        if matches_count > 0:
+        # A cada propiedad afectada solo se le envía el delta de este contacto
+        matches_count = cliente.propiedades_interes.count()
+        afectadas = añadidas | quitadas
+        if afectadas:
             
             # VALIDAR ID DE ASOCIACIÓN
             if not agencia.association_type_id:
                 logger.warning(f"⚠️ Agencia {location_id} no tiene 'association_type_id'. Cruzado saltado.")
                 return Response({'status': 'warning', 'msg': 'Falta Association ID', 'matches_found': matches_count})
 
-            access_token = get_valid_token(location_id)
+            # Todas las propiedades afectadas se encolan (o fusionan) en un solo lote
+            props_ghl = Propiedad.objects.filter(pk__in=afectadas).values_list('pk', 'ghl_contact_id')
+            sync_associations_lote(location_id, agencia.association_type_id, [
+                {
+                    'origin_record_id': prop_ghl_id,
+                    'add_ids': [cliente.ghl_contact_id] if prop_pk in añadidas else [],
+                    'remove_ids': [cliente.ghl_contact_id] if prop_pk in quitadas else [],
+                }
+                for prop_pk, prop_ghl_id in props_ghl
+            ])
+
+        return Response({'status': 'success', 'matches_found': matches_count})
 
-            if access_token:
-                # Esto podría saturar railway. OJO
-                for prop in propiedades_match:
-                    todos_los_interesados = prop.interesados.all()
-                    target_ids = [c.ghl_contact_id for c in todos_los_interesados]
+# -------------------------------------------------------------------------
+# VISTAS 4 Y 5: WEBHOOKS POR LOTES (IMPORTACIONES MASIVAS)
+# -------------------------------------------------------------------------
+# Aceptan una lista de payloads con la misma forma que los webhooks individuales
+# (o {"records": [...]}): un upsert masivo por agencia, el matching de todo el
+# lote de una vez y una sola sincronización encolada por propiedad afectada.
+
+def _registros_lote(request):
+    data = request.data
+    registros = data.get('records') if isinstance(data, dict) else data
+    if not isinstance(registros, list):
+        return None, Response({'error': 'Se esperaba una lista de registros'}, status=400)
+    if len(registros) > MAX_REGISTROS_LOTE:
+        return None, Response({'error': f'Máximo {MAX_REGISTROS_LOTE} registros por lote'}, status=413)
+    return registros, None
+
+class WebhookPropiedadBatchView(APIView):
+    authentication_classes = []
+    permission_classes = []
 
-                    sync_associations_background(
-                        access_token=access_token,
-                        location_id=location_id,
-                        origin_record_id=prop.ghl_contact_id, 
-                        target_ids_list=target_ids,
-                        association_id_val=agencia.association_type_id
-                    )
-            else:
-                logger.warning(f"⚠️ No token valid found for {location_id}")
+    def post(self, request):
+        registros, error = _registros_lote(request)
+        if error: return error
+        logger.info(f"📥 Webhook Propiedad (lote): {len(registros)} registros")
+        return Response(procesar_lote(registros, datos_propiedad, ingerir_propiedades))
 
-        return Response({'status': 'success', 'matches_found': matches_count})
+class WebhookClienteBatchView(APIView):
+    authentication_classes = []
+    permission_classes = []
+
+    def post(self, request):
+        registros, error = _registros_lote(request)
+        if error: return error
+        logger.info(f"📥 Webhook Cliente (lote): {len(registros)} registros")
+        return Response(procesar_lote(registros, datos_cliente, ingerir_clientes))
 
 # ghl_middleware/views.py (Solo cambia esta clase al final del archivo)
 
 # Llamada de un formulario para recibir la lista de zonas
 
+@condition(etag_func=etag_arbol_zonas, last_modified_func=last_modified_arbol_zonas)
 def api_get_zonas_tree(request):
-    provincias = Provincia.objects.prefetch_related('municipios__zonas').all()
-    
-    arbol = []
-    for p in provincias:
-        municipios_p = []
-        for m in p.municipios.all():
-            municipios_p.append({
-                "nombre": m.nombre,
-                "zonas": list(m.zonas.values_list('nombre', flat=True))
-            })
-        arbol.append({
-            "provincia": p.nombre,
-            "municipios": municipios_p
-        })
-    
-    # Envolvemos en un diccionario. safe=True es el valor por defecto.
-    return JsonResponse({"zonas": arbol})
+    # El árbol serializado se cachea por versión; los GET condicionales
+    # (If-None-Match / If-Modified-Since) reciben un 304 sin tocar la BBDD.
+    # Solo con CACHE_COMPARTIDA: si no, se construye en cada petición (ver zonas.py).
+    modo = modo_stream(request)
+    if modo:
+        # ?stream=1 / ?stream=ndjson: el árbol se escribe provincia a provincia
+        provincias = (json.dumps(provincia, cls=DjangoJSONEncoder) for provincia in iterar_arbol_zonas())
+        response = respuesta_stream(provincias, modo, inicio='{"zonas":[', fin=']}')
+    else:
+        response = HttpResponse(arbol_zonas_json(), content_type="application/json")
+    response["Cache-Control"] = "no-cache"
+    return response
+
+# Buscador de zonas para formularios: ?q=grasia -> Gràcia (Barcelona), aunque esté mal escrito
+def api_buscar_zonas(request):
+    texto = request.GET.get('q', '').strip()
+    try:
+        limite = min(int(request.GET.get('limite', 10)), 50)
+    except ValueError:
+        return JsonResponse({'error': 'limite debe ser un número'}, status=400)
+    return JsonResponse({'zonas': buscar_zonas(texto, limite) if texto else []})
 
 @csrf_exempt
 def registrar_ubicacion(request):
@@ -0,0 +1,202 @@
+import json
+import threading
+import time
+import unicodedata
+from django.conf import settings
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Prefetch
+from django.utils import timezone
+from .models import Provincia, Municipio, Zona
+from .trigramas import IndiceTrigramas
+
+# Metadatos del árbol: (versión, fecha de la última modificación).
+# La versión es un contador que arranca en un timestamp en ms: así, si la clave
+# desaparece de la caché, la nueva versión nunca coincide con un ETag antiguo.
+CLAVE_META_ARBOL = "zonas:arbol:meta"
+
+
+def _clave_arbol(version):
+    return f"zonas:arbol:v{version}"
+
+def meta_arbol_zonas():
+    """
+    Devuelve (version, last_modified) sin tocar la base de datos.
+    """
+    meta = cache.get(CLAVE_META_ARBOL)
+    if meta is None:
+        cache.add(CLAVE_META_ARBOL, (int(time.time() * 1000), timezone.now()), settings.ZONAS_CACHE_TTL)
+        meta = cache.get(CLAVE_META_ARBOL) or (int(time.time() * 1000), timezone.now())
+    return meta
+
+def invalidar_arbol_zonas():
+    """
+    Sube la versión del árbol. Se llama al crear/modificar provincias, municipios o zonas.
+    """
+    version, _ = meta_arbol_zonas()
+    nueva = max(version + 1, int(time.time() * 1000))
+    cache.set(CLAVE_META_ARBOL, (nueva, timezone.now()), settings.ZONAS_CACHE_TTL)
+
+def construir_arbol_zonas():
+    # Mismo orden (por pk) que iterar_arbol_zonas(): el ?stream=1 devuelve el mismo árbol
+    provincias = Provincia.objects.order_by('pk').prefetch_related(
+        Prefetch('municipios', queryset=Municipio.objects.order_by('pk')),
+        Prefetch('municipios__zonas', queryset=Zona.objects.order_by('pk')),
+    )
+    
+    arbol = []
+    for p in provincias:
+        municipios_p = []
+        for m in p.municipios.all():
+            municipios_p.append({
+                "nombre": m.nombre,
+                # m.zonas.all() reutiliza el prefetch (values_list lanzaba una query por municipio)
+                "zonas": [z.nombre for z in m.zonas.all()]
+            })
+        arbol.append({
+            "provincia": p.nombre,
+            "municipios": municipios_p
+        })
+    return arbol
+
+def iterar_arbol_zonas(chunk_size=2000):
+    """
+    Mismo árbol que construir_arbol_zonas(), pero provincia a provincia: una sola
+    consulta (LEFT JOIN provincia -> municipios -> zonas) leída con .iterator(),
+    así que en memoria solo está la provincia en curso.
+    """
+    filas = (
+        Provincia.objects
+        .order_by('pk', 'municipios__pk', 'municipios__zonas__pk')
+        .values_list('pk', 'nombre', 'municipios__pk', 'municipios__nombre', 'municipios__zonas__nombre')
+        .iterator(chunk_size=chunk_size)
+    )
+    provincia, provincia_pk, municipio_pk = None, None, None
+    for prov_pk, prov_nombre, muni_pk, muni_nombre, zona_nombre in filas:
+        if prov_pk != provincia_pk:
+            if provincia is not None:
+                yield provincia
+            provincia, provincia_pk, municipio_pk = {"provincia": prov_nombre, "municipios": []}, prov_pk, None
+        if muni_pk is None:
+            continue  # provincia sin municipios
+        if muni_pk != municipio_pk:
+            provincia["municipios"].append({"nombre": muni_nombre, "zonas": []})
+            municipio_pk = muni_pk
+        if zona_nombre is not None:
+            provincia["municipios"][-1]["zonas"].append(zona_nombre)
+    if provincia is not None:
+        yield provincia
+
+def arbol_zonas_json():
+    """
+    JSON serializado del árbol para la versión actual; solo se reconstruye
+    cuando cambia la versión (o caduca la caché). Sin caché compartida se
+    reconstruye siempre: la versión no vería los cambios hechos en otro proceso.
+    """
+    if not settings.CACHE_COMPARTIDA:
+        return json.dumps({"zonas": construir_arbol_zonas()}, cls=DjangoJSONEncoder)
+    version, _ = meta_arbol_zonas()
+    clave = _clave_arbol(version)
+    contenido = cache.get(clave)
+    if contenido is None:
+        # Envolvemos en un diccionario, igual que hacía el JsonResponse original
+        contenido = json.dumps({"zonas": construir_arbol_zonas()}, cls=DjangoJSONEncoder)
+        cache.set(clave, contenido, settings.ZONAS_CACHE_TTL)
+    return contenido
+
+# Sin caché compartida no hay ETag ni Last-Modified (None): un 304 con la versión
+# de este proceso podría confirmar un árbol ya modificado desde otro
+
+def etag_arbol_zonas(request, *args, **kwargs):
+    if not settings.CACHE_COMPARTIDA:
+        return None
+    version, _ = meta_arbol_zonas()
+    return f'"zonas-{version}"'
+
+def last_modified_arbol_zonas(request, *args, **kwargs):
+    if not settings.CACHE_COMPARTIDA:
+        return None
+    _, last_modified = meta_arbol_zonas()
+    return last_modified
+
+
+# --- RESOLUTOR DE NOMBRES DE ZONA EN MEMORIA ---
+# nombre normalizado -> [ids de Zona]. Se carga una vez por proceso y se
+# recarga cuando cambia la versión de ubicaciones (las mismas señales que el árbol).
+# Con una caché por proceso (LocMemCache) la versión no ve las zonas creadas en
+# otro proceso: por eso un nombre desconocido se comprueba en la base de datos y,
+# si existe, se recarga el mapa en el momento.
+
+_resolutor = {"version": None, "cargado_en": 0.0, "mapa": {}}
+_resolutor_lock = threading.Lock()
+
+def normalizar_nombre(valor):
+    """
+    'Sant_Andreu', 'sant andreu ' y 'Sant Andréu' -> 'sant andreu'.
+    Minúsculas, '_' como espacio y sin acentos.
+    """
+    texto = unicodedata.normalize("NFKD", str(valor or ""))
+    texto = "".join(c for c in texto if not unicodedata.combining(c))
+    return " ".join(texto.replace("_", " ").lower().split())
+
+def existe_nombre(modelo, nombre):
+    """
+    True si en la base de datos hay algún 'modelo' (Zona, Municipio, Provincia) con
+    ese nombre tal y como lo manda GHL ('sant_andreu' -> 'Sant Andreu').
+    """
+    texto = " ".join(str(nombre or "").replace("_", " ").split())
+    return bool(texto) and modelo.objects.filter(nombre__iexact=texto).exists()
+
+def _mapa_zonas(forzar=False):
+    version, _ = meta_arbol_zonas()
+    caducado = time.monotonic() - _resolutor["cargado_en"] > settings.ZONAS_CACHE_TTL
+    if forzar or _resolutor["version"] != version or caducado:
+        with _resolutor_lock:
+            if forzar or _resolutor["version"] != version or time.monotonic() - _resolutor["cargado_en"] > settings.ZONAS_CACHE_TTL:
+                mapa = {}
+                for pk, nombre in Zona.objects.order_by('pk').values_list('pk', 'nombre'):
+                    mapa.setdefault(normalizar_nombre(nombre), []).append(pk)
+                _resolutor.update(version=version, cargado_en=time.monotonic(), mapa=mapa)
+    return _resolutor["mapa"]
+
+def resolver_zona(nombre):
+    """
+    Id de la zona con ese nombre (la más antigua si hay varias con el mismo), o None.
+    """
+    clave = normalizar_nombre(nombre)
+    ids = _mapa_zonas().get(clave)
+    if not ids and existe_nombre(Zona, nombre):
+        # Creada en otro proceso después de cargar el mapa
+        ids = _mapa_zonas(forzar=True).get(clave)
+    return ids[0] if ids else None
+
+# --- BUSCADOR DE ZONAS CON ERRORES DE ESCRITURA ---
+# resolver_zona() solo acepta el nombre exacto (normalizado). Para sugerir zonas a partir
+# de lo que teclea un usuario ('grasia', 'sant andreu barna') se usa un índice de trigramas
+# sobre "zona municipio provincia", recargado con la misma versión que el árbol.
+
+_buscador = {"version": None, "indice": None, "zonas": {}}
+
+def buscar_zonas(texto, limite=10):
+    """
+    Zonas que se parecen a 'texto', de más a menos parecida:
+    [{"id", "zona", "municipio", "provincia", "similitud"}].
+    """
+    version, _ = meta_arbol_zonas()
+    if _buscador["version"] != version:
+        with _resolutor_lock:
+            if _buscador["version"] != version:
+                zonas = {
+                    pk: (zona, municipio, provincia)
+                    for pk, zona, municipio, provincia in Zona.objects.values_list(
+                        'pk', 'nombre', 'municipio__nombre', 'municipio__provincia__nombre'
+                    )
+                }
+                indice = IndiceTrigramas((pk, normalizar_nombre(" ".join(nombres))) for pk, nombres in zonas.items())
+                _buscador.update(version=version, indice=indice, zonas=zonas)
+
+    resultados = []
+    for pk, similitud in _buscador["indice"].buscar(normalizar_nombre(texto))[:limite]:
+        zona, municipio, provincia = _buscador["zonas"][pk]
+        resultados.append({"id": pk, "zona": zona, "municipio": municipio, "provincia": provincia, "similitud": round(similitud, 3)})
+    return resultados